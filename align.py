@@ -1,68 +1,140 @@
-from Bio import pairwise2
-
 from language import Language
 
 import math
 
+import numpy as np
+
+import instrumentation
+from needleman_wunsch import SCALAR_PAIRS, align_batch, align_pair, align_scores, encode_pairs, identity_array, \
+    pmi_array, score_pair
+from wordstore import CHAR_CODES, decode_word
+
 num = 10
 
+# needleman-wunsch with match=0, mismatch=-1 (the default alignment, before there is a PMI matrix)
+LEVENSHTEIN_SCORES = identity_array(0, -1)
+
 
 def levenshtein_align(pairing: tuple[str, str]):
-    alignments = pairwise2.align.globalms(pairing[0], pairing[1],
-                                          match=0, mismatch=-1,
-                                          open=-1, extend=-1)
-    best_alignment = alignments[0]
-    aligned1, aligned2, _, _, _ = best_alignment
+    return levenshtein_align_batch([pairing])[0]
 
-    return (aligned1, aligned2)
 
+def levenshtein_align_batch(pairings: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """
+    Align every pair of words with Levenshtein scores (match=0, mismatch=-1, open=-1, extend=-1).
+    """
+    _, aligned_pairs = align_pairs(pairings, LEVENSHTEIN_SCORES, -1, -1)
+    return aligned_pairs
 
-def align_w_prev_matrix(potential_cognates: list[tuple[str, str]], pmi_matrix: dict[tuple[str, str], float], open_gap_score: float, extend_gap_score: float):
-    aligned_cognates = []
 
-    for cognate_pair in potential_cognates:
-        word1, word2 = cognate_pair
-        alignments = pairwise2.align.globalcs(
-            word1, word2,
-            open=open_gap_score,
-            extend=extend_gap_score,
-            match_fn=lambda *args: custom_score(*args, pmi_matrix=pmi_matrix)
-        )
+def align_pairs(word_pairs: list[tuple[str, str]], pmi_matrix, open_gap_score: float, extend_gap_score: float):
+    """
+    Align a batch of word pairs with a single traceback each.
+
+    Parameters:
+    - word_pairs (list[tuple[str, str]]): the pairs of words to align
+    - pmi_matrix: PMI matrix as a `PMIMatrix`, a dict of sorted character pairs, or a dense array (see `needleman_wunsch.pmi_array`)
+    - open_gap_score, extend_gap_score (float): gap penalties
 
-        if alignments:
-            alignment = alignments[0]  # Consider the first alignment result
-            aligned_word1, aligned_word2, _, _, _ = alignment
-            aligned_cognates.append((aligned_word1, aligned_word2))
+    Returns:
+    tuple[np.ndarray, list]: score of every pair, and the aligned words of every pair (None if it has no alignment)
+    """
+    codes1, lengths1, codes2, lengths2 = encode_pairs(word_pairs)
+    scores, aligned1, aligned2, aligned_lengths, found = align_batch(
+        codes1, lengths1, codes2, lengths2, pmi_array(pmi_matrix), open_gap_score, extend_gap_score)
 
-    return aligned_cognates
+    aligned_pairs = [(decode_word(aligned1[pair, :length]), decode_word(aligned2[pair, :length]))
+                     if has_alignment else None
+                     for pair, (length, has_alignment) in enumerate(zip(aligned_lengths.tolist(), found.tolist()))]
+    return scores, aligned_pairs
 
 
-def custom_score(match_char, ref_char, pmi_matrix: dict[tuple, float]):
-    sorted_c1, sorted_c2 = tuple(sorted([match_char, ref_char]))
-    score = pmi_matrix.get((sorted_c1, sorted_c2))
-    if not score:
-        print(
-            f"No value in pmi_matrix for:\n   match_char: {match_char}, ref_char: {ref_char}")
-    return score
+def align_w_prev_matrix(potential_cognates: list[tuple[str, str]], pmi_matrix: dict[tuple[str, str], float], open_gap_score: float, extend_gap_score: float):
+    _, aligned_pairs = align_pairs(
+        potential_cognates, pmi_matrix, open_gap_score, extend_gap_score)
+
+    return [aligned_pair for aligned_pair in aligned_pairs if aligned_pair is not None]
 
 
 # this is meant to align my potential cognates and get a PMI score
 def get_PMI(potential_cognate1: str, potential_cognate2: str, pmi_matrix: dict[tuple, float], open_gap_score, extend_gap_score):
-    alignments = pairwise2.align.globalcs(
-        potential_cognate1, potential_cognate2, open=open_gap_score, extend=extend_gap_score, match_fn=lambda *args: custom_score(*args, pmi_matrix=pmi_matrix))
-    if not alignments:
+    match = __match_scores(potential_cognate1, potential_cognate2, pmi_matrix)
+    if match is not None:
+        if instrumentation.enabled:
+            instrumentation.count('alignments')
+        score, aligned1, aligned2, found = align_pair(potential_cognate1, potential_cognate2, match,
+                                                      open_gap_score, extend_gap_score, gap='-')
+        if found:
+            return score, (''.join(aligned1), ''.join(aligned2))
+        return -200, (potential_cognate1, potential_cognate2)
+
+    # empty words, missing PMI entries and unknown symbols take the batch path, which handles (or reports) them
+    scores, aligned_pairs = align_pairs([(potential_cognate1, potential_cognate2)],
+                                        pmi_matrix, open_gap_score, extend_gap_score)
+    if aligned_pairs[0] is None:
         return -200, (potential_cognate1, potential_cognate2)
-    alignment = alignments[0]
-    aligned_word1, aligned_word2, _, _, _ = alignment
-    score = alignment.score
-    return score, (aligned_word1, aligned_word2)
+    return float(scores[0]), aligned_pairs[0]
+
+
+def get_PMI_scores(word_pairs: list[tuple[str, str]], pmi_matrix, open_gap_score, extend_gap_score) -> np.ndarray:
+    """
+    Score-only version of `get_PMI` for a batch of word pairs.
+    """
+    if len(word_pairs) <= SCALAR_PAIRS:
+        matches = [__match_scores(word1, word2, pmi_matrix) for word1, word2 in word_pairs]
+        if all(match is not None for match in matches):
+            if instrumentation.enabled:
+                instrumentation.count('alignments', len(matches))
+            return np.array([score_pair(match, open_gap_score, extend_gap_score) for match in matches])
+    pmi_values = align_scores(*encode_pairs(word_pairs), pmi_array(pmi_matrix),
+                              open_gap_score, extend_gap_score)
+    return np.where(np.isnan(pmi_values), -200, pmi_values)
+
+
+def get_encoded_PMI_matrix(codes1: np.ndarray, lengths1: np.ndarray, codes2: np.ndarray, lengths2: np.ndarray,
+                           pmi_matrix, open_gap_score, extend_gap_score) -> np.ndarray:
+    """
+    Align every (encoded) word of the first batch with every word of the second batch and return the PMI scores as a matrix.
+    """
+    rows = np.repeat(np.arange(len(lengths1)), len(lengths2))
+    cols = np.tile(np.arange(len(lengths2)), len(lengths1))
+    pmi_values = align_scores(codes1[rows], lengths1[rows], codes2[cols], lengths2[cols],
+                              pmi_array(pmi_matrix), open_gap_score, extend_gap_score)
+    return np.where(np.isnan(pmi_values), -200, pmi_values).reshape(len(lengths1), len(lengths2))
 
 
 def calculate_PMI(word_list1, word_list2, pmi_matrix, open_gap_score, extend_gap_score, average=True):
-    pmi_values = [get_PMI(word1, word2, pmi_matrix, open_gap_score, extend_gap_score)[0]
-                  for word1 in word_list1 for word2 in word_list2]
+    pmi_values = get_PMI_scores([(word1, word2) for word1 in word_list1 for word2 in word_list2],
+                                pmi_matrix, open_gap_score, extend_gap_score).tolist()
 
     if average:
         return sum(pmi_values) / len(pmi_values)
     else:
         return max(pmi_values)
+
+
+def __match_scores(word1: str, word2: str, pmi_matrix) -> list[list[float]]:
+    """
+    The PMI of every character of word1 with every character of word2, for `needleman_wunsch.align_pair`.
+
+    A dict is looked up directly, on the sorted character pairs: converting it to an array (`pmi_array`) costs far
+    more than the few lookups of a single pair.
+
+    Returns:
+    - `list[list[float]]`: one row per character of word1. None if a word is empty, has a non-ASCIIPMA symbol, or
+            a score is missing or not finite
+    """
+    if not word1 or not word2 or not CHAR_CODES.keys() >= set(word1 + word2):
+        return None
+    if isinstance(pmi_matrix, dict):
+        get = pmi_matrix.get
+        match = [[get((char1, char2) if char1 <= char2 else (char2, char1)) for char2 in word2] for char1 in word1]
+        if any(None in row for row in match):
+            return None
+    else:
+        scores = pmi_array(pmi_matrix)
+        match = scores[[CHAR_CODES[char] for char in word1]][:, [CHAR_CODES[char] for char in word2]].tolist()
+    # a sum that is not finite has a term that is not (or overflowed, which the batch path handles as well)
+    if not math.isfinite(sum(map(sum, match))):
+        return None
+    return match
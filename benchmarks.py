@@ -0,0 +1,306 @@
+import argparse
+import ast
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import numpy as np
+
+import align
+import pmi_matrix_generator
+from cognate_corpus import CognateCorpus
+from corpus_file import TRAINING_SET_PATH, load_corpus, load_corpus_store
+from dERC_LDNcalculator import calculate_dERC_LDN
+from dERC_PMIcalculator import calculate_dERC_PMI
+from levenshtein import calculate_LDN, get_LDN
+from pmi_matrix import PMIMatrix
+from potential_cognates_generator import generate_potential_cognates
+from wordstore import CHARS, store_languages
+
+
+BENCHMARK_RESULTS_PATH = "./materials/benchmark_results.json"
+BENCHMARK_BASELINE_PATH = "./materials/benchmark_baseline.json"
+# the PMI matrix and gap scores found by the optimization, the PMI benchmarks align with them
+OUTPUT_PATH = "./materials/output.txt"
+
+DEFAULT_REPEAT = 5
+# a benchmark regresses when its throughput drops, or its peak memory grows, by more than this fraction
+DEFAULT_TOLERANCE = 0.2
+# the environment entries that must match the baseline's for the timings to be comparable
+COMPARED_ENVIRONMENT = ('python', 'numpy', 'machine', 'cpus')
+
+
+def run_benchmarks(names: list[str] = None, repeat: int = DEFAULT_REPEAT, seed: int = 0) -> dict:
+    """
+    Run the benchmarks of the hot paths on a seeded sample of the training set.
+
+    Every benchmark is timed `repeat` times (the best time counts), then run once more under `tracemalloc` for its
+    peak memory, which numpy's allocations are part of.
+
+    Parameters:
+    - `names (list[str], optional)`: the benchmarks to run (see `BENCHMARKS`), all by default
+    - `repeat (int, optional)`: timed runs per benchmark
+    - `seed (int, optional)`: seed of the sample of languages and pairs
+
+    Returns:
+    - `dict`: the environment and, for every benchmark, its best time, the number and unit of the items it
+            processes, items per second and peak memory in bytes
+    """
+    names = names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks: {unknown}. Known: {list(BENCHMARKS)}.")
+    context = __build_context(seed)
+
+    results = {}
+    for name in names:
+        run, num_items, unit = BENCHMARKS[name](context)
+        best_seconds = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with redirect_stdout(None):
+                run()
+            best_seconds = min(best_seconds, time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            with redirect_stdout(None):
+                run()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        results[name] = {
+            'seconds': best_seconds,
+            'items': num_items,
+            'unit': unit,
+            'items_per_second': num_items / best_seconds,
+            'peak_bytes': peak_bytes,
+        }
+        print(f"{name}: {num_items / best_seconds:,.0f} {unit}/s ({best_seconds * 1000:.1f} ms), "
+              f"peak {peak_bytes / 1024 / 1024:.1f} MB")
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'benchmarks': results,
+    }
+
+
+def save_results(results: dict, path: str = BENCHMARK_RESULTS_PATH):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+
+
+def load_results(path: str = BENCHMARK_BASELINE_PATH) -> dict:
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def environment_differences(results: dict, baseline: dict) -> list[str]:
+    """
+    List the `COMPARED_ENVIRONMENT` entries in which the results and the baseline differ.
+
+    Returns:
+    - `list[str]`: a description of every difference, empty if the timings are comparable
+    """
+    environment, reference = results.get('environment', {}), baseline.get('environment', {})
+    return [f"{key}: {environment.get(key)}, baseline {reference.get(key)}"
+            for key in COMPARED_ENVIRONMENT if environment.get(key) != reference.get(key)]
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE,
+                     ignore_environment: bool = False) -> list[str]:
+    """
+    Compare benchmark results against a baseline (both as returned by `run_benchmarks`).
+
+    Only benchmarks in both are compared, and only with the same number of items: the throughput of a different
+    workload is not comparable. Neither is that of another environment: if python, numpy, the machine or the
+    number of CPUs differ from the baseline's (see `environment_differences`), a warning is printed and nothing
+    is compared, unless `ignore_environment` is set.
+
+    Returns:
+    - `list[str]`: a description of every regression, empty if there are none
+    """
+    differences = environment_differences(results, baseline)
+    if differences and not ignore_environment:
+        print(f"WARNING the environment differs from the baseline's, regressions are not checked: "
+              f"{'; '.join(differences)}")
+        return []
+
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        reference = baseline['benchmarks'].get(name)
+        if reference is None or reference['items'] != result['items']:
+            continue
+        if result['items_per_second'] < reference['items_per_second'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['items_per_second']:,.0f} {result['unit']}/s, baseline "
+                               f"{reference['items_per_second']:,.0f} "
+                               f"({result['items_per_second'] / reference['items_per_second'] - 1:+.0%})")
+        if result['peak_bytes'] > reference['peak_bytes'] * (1 + tolerance):
+            regressions.append(f"{name}: peak {result['peak_bytes']:,} bytes, baseline {reference['peak_bytes']:,} "
+                               f"({result['peak_bytes'] / reference['peak_bytes'] - 1:+.0%})")
+    return regressions
+
+
+def load_output_parameters(path: str = OUTPUT_PATH) -> tuple[dict[tuple[str, str], float], float, float, float]:
+    """
+    Read the result of the optimization as printed by driver.py.
+
+    Returns:
+    - `tuple[dict, float, float, float]`: the PMI matrix, open_gap_score, extend_gap_score and theta_pmi
+    """
+    with open(path, 'r') as file:
+        lines = [line.strip() for line in file if line.strip()]
+    parameters = lines[0][lines[0].index('[') + 1:lines[0].index(']')].split()
+    pmi_matrix = ast.literal_eval(next(line for line in lines if line.startswith('{')))
+    return pmi_matrix, float(parameters[0]), float(parameters[1]), float(parameters[2])
+
+
+def __build_context(seed: int) -> dict:
+    """The sample every benchmark draws from, the same for the same seed."""
+    generator = random.Random(seed)
+    training_set = load_corpus(TRAINING_SET_PATH)
+    languages = [language for family in training_set.values() for language in family]
+    families = [family for family in training_set.values() if len(family) >= 2]
+
+    sample = generator.sample(languages, 40)
+    language_pairs = [(sample[i], sample[j]) for i in range(len(sample)) for j in range(i + 1, len(sample))]
+    # pairs within a family stand in for the probably related pairs
+    related_pairs = []
+    while len(related_pairs) < 300:
+        related_pairs.append(tuple(generator.sample(generator.choice(families), 2)))
+
+    # every concept both languages attest, as (words of L1, words of L2)
+    concept_pairs = [(concept1, concept2)
+                     for L1, L2 in language_pairs[:100]
+                     for concept1, concept2 in zip(L1.word_list, L2.word_list)
+                     if 'XXX' not in concept1 and 'XXX' not in concept2]
+    word_pairs = [(concept1[0], concept2[0]) for concept1, concept2 in concept_pairs]
+
+    pmi_matrix, open_gap_score, extend_gap_score, theta_pmi = load_output_parameters()
+    store, _ = store_languages(languages)
+    return {
+        'language_pairs': language_pairs,
+        'related_pairs': related_pairs,
+        'concept_pairs': concept_pairs,
+        'word_pairs': word_pairs,
+        'cognates': CognateCorpus.from_pairs(generate_potential_cognates(related_pairs)),
+        'pmi_matrix': PMIMatrix.from_dict(pmi_matrix),
+        'open_gap_score': open_gap_score,
+        'extend_gap_score': extend_gap_score,
+        'theta_pmi': theta_pmi,
+        'char_counts': dict(zip(CHARS, np.bincount(store.symbols, minlength=len(CHARS)).tolist())),
+        'num_characters': len(store.symbols),
+    }
+
+
+def __get_LDN(context: dict):
+    word_pairs = context['word_pairs']
+    return (lambda: [get_LDN(word1, word2) for word1, word2 in word_pairs]), len(word_pairs), 'word pairs'
+
+
+def __calculate_LDN(context: dict):
+    concept_pairs = context['concept_pairs']
+    return ((lambda: [calculate_LDN(concept1, concept2) for concept1, concept2 in concept_pairs]),
+            len(concept_pairs), 'concept pairs')
+
+
+def __calculate_dERC_LDN(context: dict):
+    language_pairs = context['language_pairs'][:200]
+    return (lambda: [calculate_dERC_LDN(L1, L2) for L1, L2 in language_pairs]), len(language_pairs), 'language pairs'
+
+
+def __get_PMI(context: dict):
+    word_pairs = context['word_pairs'][:200]
+    arguments = context['pmi_matrix'], context['open_gap_score'], context['extend_gap_score']
+    return ((lambda: [align.get_PMI(word1, word2, *arguments) for word1, word2 in word_pairs]),
+            len(word_pairs), 'word pairs')
+
+
+def __get_PMI_scores(context: dict):
+    word_pairs = context['word_pairs'][:200]
+    arguments = context['pmi_matrix'], context['open_gap_score'], context['extend_gap_score']
+    return (lambda: align.get_PMI_scores(word_pairs, *arguments)), len(word_pairs), 'word pairs'
+
+
+def __calculate_dERC_PMI(context: dict):
+    language_pairs = context['language_pairs'][:20]
+    arguments = context['pmi_matrix'], context['open_gap_score'], context['extend_gap_score']
+    return ((lambda: [calculate_dERC_PMI(L1, L2, *arguments) for L1, L2 in language_pairs]),
+            len(language_pairs), 'language pairs')
+
+
+def __generate_potential_cognates(context: dict):
+    related_pairs = context['related_pairs']
+    return (lambda: generate_potential_cognates(related_pairs)), len(related_pairs), 'language pairs'
+
+
+def __reestimate_pmi_matrix(context: dict):
+    cognates = context['cognates']
+
+    def run():
+        pmi_matrix_generator.reestimate_pmi_matrix(
+            cognates, context['open_gap_score'], context['extend_gap_score'], context['theta_pmi'],
+            context['char_counts'], context['num_characters'], context['pmi_matrix'].copy(), num_remaining=1)
+    return run, len(cognates), 'cognate pairs'
+
+
+def __load_corpus(context: dict):
+    # loading, and reading every word list back
+    def run():
+        for family in load_corpus(TRAINING_SET_PATH).values():
+            for language in family:
+                language.word_list
+    return run, len(load_corpus_store(TRAINING_SET_PATH)), 'languages'
+
+
+# name -> function of the benchmark context, returning the run to time, its number of items and their unit
+BENCHMARKS = {
+    'get_LDN': __get_LDN,
+    'calculate_LDN': __calculate_LDN,
+    'calculate_dERC_LDN': __calculate_dERC_LDN,
+    'get_PMI': __get_PMI,
+    'get_PMI_scores': __get_PMI_scores,
+    'calculate_dERC_PMI': __calculate_dERC_PMI,
+    'generate_potential_cognates': __generate_potential_cognates,
+    'reestimate_pmi_matrix (1 iteration)': __reestimate_pmi_matrix,
+    'load_corpus': __load_corpus,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths on the materials/ corpora.")
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run, all by default: {list(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=BENCHMARK_RESULTS_PATH)
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--ignore-environment', action='store_true',
+                        help="compare against a baseline taken with another python, numpy, machine or CPU count")
+    arguments = parser.parse_args()
+
+    results = run_benchmarks(arguments.names, repeat=arguments.repeat, seed=arguments.seed)
+    save_results(results, arguments.output)
+    if arguments.save_baseline:
+        save_results(results, arguments.baseline)
+    elif os.path.exists(arguments.baseline):
+        regressions = find_regressions(results, load_results(arguments.baseline), arguments.tolerance,
+                                       ignore_environment=arguments.ignore_environment)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,87 @@
+from collections import Counter
+
+import numpy as np
+
+from wordstore import decode_word, encode_word
+
+
+COGNATE_CORPUS_PATH = "./materials/potential_cognates.npz"
+
+
+class CognateCorpus:
+    """
+    This class holds the potential cognates as a set of distinct word pairs with the number of times each appears.
+
+    Every pair is canonical (its two words in sorted order, like the alignment cache of the PMI re-estimation)
+    and the pairs are sorted, so the same cognates always give the same corpus. The same word in two close
+    dialects appears in many language pairings, and is only kept (and aligned) once.
+
+    State:
+    - `pairs (list[tuple[str, str]])`: the distinct canonical pairs, sorted
+    - `counts (np.ndarray)`: number of times every pair appears among the potential cognates
+
+    Constructor:
+    - `pairs: list[tuple[str, str]]`
+    - `counts: np.ndarray`
+
+    Example:
+    ```py
+    corpus = CognateCorpus.from_pairs([('mano', 'man'), ('man', 'mano'), ('pan', 'pane')])
+    print(corpus.pairs, corpus.counts)  # [('man', 'mano'), ('pan', 'pane')] [2 1]
+    corpus.save(COGNATE_CORPUS_PATH)
+    ```
+    """
+
+    def __init__(self, pairs: list[tuple[str, str]], counts) -> None:
+        self.pairs = list(pairs)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        if len(self.pairs) != len(self.counts):
+            raise ValueError(f"{len(self.pairs)} pairs but {len(self.counts)} counts.")
+
+    @classmethod
+    def from_pairs(cls, word_pairs: list[tuple[str, str]]) -> 'CognateCorpus':
+        """Count the canonical form of every pair of a flat list of potential cognates."""
+        multiplicity = Counter(tuple(sorted(word_pair)) for word_pair in word_pairs)
+        pairs = sorted(multiplicity)
+        return cls(pairs, [multiplicity[pair] for pair in pairs])
+
+    @classmethod
+    def load(cls, path: str = COGNATE_CORPUS_PATH) -> 'CognateCorpus':
+        """Read a corpus written by `save`."""
+        with np.load(path) as file:
+            symbols, lengths, counts = file['symbols'], file['lengths'].astype(np.int64), file['counts']
+        ends = np.cumsum(lengths.reshape(-1))
+        words = [decode_word(symbols[end - length:end]) for end, length in zip(ends.tolist(), lengths.reshape(-1).tolist())]
+        return cls(list(zip(words[0::2], words[1::2])), counts)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @property
+    def total(self) -> int:
+        """Number of potential cognates, duplicates included."""
+        return int(self.counts.sum())
+
+    def expand(self) -> list[tuple[str, str]]:
+        """The flat list of (canonical) potential cognates, every pair repeated as often as it appears."""
+        return [pair for pair, count in zip(self.pairs, self.counts.tolist()) for _ in range(count)]
+
+    def merged(self, other: 'CognateCorpus') -> 'CognateCorpus':
+        """
+        The corpus of the potential cognates of both corpora: counts add up, so the cognates of new language pairs
+        can be merged into a corpus instead of collecting every pair again.
+        """
+        multiplicity = Counter(dict(zip(self.pairs, self.counts.tolist())))
+        multiplicity.update(dict(zip(other.pairs, other.counts.tolist())))
+        pairs = sorted(multiplicity)
+        return CognateCorpus(pairs, [multiplicity[pair] for pair in pairs])
+
+    def save(self, path: str = COGNATE_CORPUS_PATH):
+        """
+        Write the corpus as a compressed `.npz`: the symbol codes of all words in one buffer (first and second word
+        of every pair in turn), the length of every word and the count of every pair.
+        """
+        words = [encode_word(word) for pair in self.pairs for word in pair]
+        symbols = np.concatenate(words) if words else np.zeros(0, dtype=np.uint8)
+        lengths = np.array([len(word) for word in words], dtype=np.uint8).reshape(-1, 2)
+        np.savez_compressed(path, symbols=symbols, lengths=lengths, counts=self.counts.astype(np.uint32))
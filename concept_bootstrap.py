@@ -0,0 +1,230 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from align import get_encoded_PMI_matrix
+from dERC_batch import aggregate_concept_scores, dERC_from_log_ranks, log_normalized_ranks
+from distance_matrix_generator import DistanceMatrix, condensed_index, condensed_size
+from language import Language
+from ldn_cache import LDNCache
+from levenshtein import get_encoded_LDN_matrix
+from tree_builder import Tree, neighbor_joining, split_support
+from wordstore import NUM_SYMBOLS, store_languages
+
+
+DEFAULT_NUM_REPLICATES = 100
+# interval counts of at most this many (pair, interval, replicate) entries are held at once by bootstrap_dERC
+__MAX_BATCH_ELEMENTS = 1 << 23
+
+
+def bootstrap_samples(num_replicates: int = DEFAULT_NUM_REPLICATES, num_concepts: int = 40,
+                      seed: int = 0) -> np.ndarray:
+    """
+    Draw the concepts of every bootstrap replicate: `num_concepts` concepts with replacement.
+
+    Returns:
+    - `np.ndarray`: (replicates x concepts) concept indices. Concept k of replicate b is concept `samples[b, k]`.
+    """
+    return np.random.default_rng(seed).integers(0, num_concepts, size=(num_replicates, num_concepts))
+
+
+def concept_score_matrices(L1: Language, languages: list[Language], measure: str = 'LDN', pmi_matrix=None,
+                           open_gap_score: float = None, extend_gap_score: float = None,
+                           cache: LDNCache = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The concept by concept scores of one language against many others, everything the dERC of any resampling
+    of the concepts is made of.
+
+    Scores are oriented like the dERC/LDN: lower means more similar (PMI scores are negated).
+
+    Parameters:
+    - `L1 (Language)`: the language to be compared
+    - `languages (list[Language])`: the languages to compare L1 against
+    - `measure (str, optional)`: 'LDN' (see `dERC_LDNcalculator.calculate_dERC_LDN_batch`) or 'PMI' (see
+            `dERC_PMIcalculator.calculate_dERC_PMI_batch`, which takes the PMI matrix and the gap scores)
+    - `cache (LDNCache, optional)`: word-pair LDN cache of the store of the languages, for 'LDN'
+
+    Returns:
+    - `tuple[np.ndarray, np.ndarray]`: (pairs x concepts) best score of the words of every concept (the on-diagonal
+            scores), and (pairs x concepts x concepts) average score of the words of every two concepts, the same
+            concept included. NaN where a concept is 'XXX'. Both are over the concepts of L1.
+    """
+    store, indices = store_languages([L1] + list(languages))
+    layout1 = store.layout(indices[:1])
+    layout2 = store.layout(indices[1:])
+    if measure == 'LDN':
+        if cache is not None and cache.store is store:
+            word_scores = cache.LDN_matrix(layout1.vocabulary, layout2.vocabulary)
+        else:
+            word_scores = get_encoded_LDN_matrix(*layout1.codes, *layout2.codes, alphabet_size=NUM_SYMBOLS)
+        diagonal, sign = np.minimum, 1
+    elif measure == 'PMI':
+        word_scores = get_encoded_PMI_matrix(*layout1.codes, *layout2.codes,
+                                             pmi_matrix, open_gap_score, extend_gap_score)
+        diagonal, sign = np.maximum, -1
+    else:
+        raise ValueError(f"measure is 'LDN' or 'PMI', not {measure!r}.")
+
+    same_concept, cells = aggregate_concept_scores(word_scores, layout1, layout2, diagonal=diagonal,
+                                                   same_concept_cells=True)
+    num_pairs, concepts1 = same_concept.shape
+    cells = cells.reshape(num_pairs, concepts1, -1)
+    # concepts of the other languages past L1's last concept are not resampled (ASJP lists all have 40)
+    square_cells = np.full((num_pairs, concepts1, concepts1), np.nan)
+    shared = min(concepts1, cells.shape[2])
+    square_cells[:, :, :shared] = cells[:, :, :shared]
+    return sign * same_concept, sign * square_cells
+
+
+def bootstrap_dERC(same_concept: np.ndarray, cells: np.ndarray, samples: np.ndarray,
+                   num_concepts: int = None) -> np.ndarray:
+    """
+    The dERC of every language pair in every bootstrap replicate, from the concept score matrices of the pairs
+    (see `concept_score_matrices`), without scoring a single word pair again.
+
+    A replicate's word lists hold concept `samples[b, k]` in slot k, for both languages. Its on-diagonal scores are
+    the same-concept scores of the sampled concepts, and its off-diagonal cells are the cells (i, j) of the sampled
+    concepts, every cell counted `c_i * c_j` times (`c` the number of times each concept was sampled), minus its
+    `c_i` same-slot entries on the diagonal. The rank of an on-diagonal score only depends on how many of those
+    cells are below or equal to it, so every cell of a pair is put, once, in the interval between the pair's
+    same-concept scores it falls in. The counts of every interval in every replicate are then one sparse
+    (pairs * intervals x cells) by (cells x replicates) product. The result is bit for bit what the calculators give
+    on the resampled word lists.
+
+    Parameters:
+    - `same_concept (np.ndarray)`: (pairs x concepts) on-diagonal scores, NaN where skipped
+    - `cells (np.ndarray)`: (pairs x concepts x concepts) average scores, NaN where skipped
+    - `samples (np.ndarray)`: (replicates x concepts) sampled concepts, see `bootstrap_samples`
+    - `num_concepts (int, optional)`: Nmax of the dERC, the number of concepts by default
+
+    Returns:
+    - `np.ndarray`: (replicates x pairs) dERC of every pair in every replicate
+    """
+    samples = np.atleast_2d(samples)
+    num_pairs, concepts = same_concept.shape
+    num_replicates = len(samples)
+    num_cells = concepts * concepts
+    # cells below the first score, equal to it, between it and the second, ..., above the last
+    num_intervals = 2 * concepts + 1
+    if num_concepts is None:
+        num_concepts = concepts
+    dERC = np.empty((num_replicates, num_pairs))
+    if num_pairs == 0:
+        return dERC
+
+    # the multiplicity of every cell in every replicate, c_i * c_j off the diagonal and c_i * (c_i - 1) on it. The
+    #   multiplicities of a replicate add up to concepts * (concepts - 1), so the counts fit in int16
+    sampled = np.zeros((num_replicates, concepts), dtype=np.int64)
+    np.add.at(sampled, (np.arange(num_replicates)[:, None], samples), 1)
+    multiplicity = sampled[:, :, None] * sampled[:, None, :]
+    multiplicity[:, np.arange(concepts), np.arange(concepts)] -= sampled
+    multiplicity = np.ascontiguousarray(multiplicity.reshape(num_replicates, num_cells).T.astype(np.int16))
+
+    # per pair, once: the interval of every cell, 2k below the k-th smallest same-concept score (and above the one
+    #   before), 2k + 1 equal to it, and where every same-concept score sits among them
+    flat_cells = cells.reshape(num_pairs, num_cells)
+    thresholds = np.sort(same_concept, axis=1)  # NaN goes last
+    interval = np.empty((num_pairs, num_cells), dtype=np.int64)
+    score_position = np.empty((num_pairs, concepts), dtype=np.int64)
+    for pair in range(num_pairs):
+        position = np.searchsorted(thresholds[pair], flat_cells[pair], side='left')
+        equal = thresholds[pair, np.minimum(position, concepts - 1)] == flat_cells[pair]
+        interval[pair] = 2 * position + equal
+        score_position[pair] = np.searchsorted(thresholds[pair], same_concept[pair], side='left')
+    finite = ~np.isnan(flat_cells)
+
+    pairs_per_batch = max(1, __MAX_BATCH_ELEMENTS // (num_replicates * num_intervals))
+    replicates = np.arange(num_replicates)[:, None, None]
+    for start in range(0, num_pairs, pairs_per_batch):
+        pairs = np.arange(start, min(start + pairs_per_batch, num_pairs))
+        batch_finite = finite[pairs]
+        rows = (np.arange(len(pairs))[:, None] * num_intervals + interval[pairs])[batch_finite]
+        columns = np.broadcast_to(np.arange(num_cells), batch_finite.shape)[batch_finite]
+        membership = csr_matrix((np.ones(len(rows), dtype=np.int16), (rows, columns)),
+                                shape=(len(pairs) * num_intervals, num_cells))
+        # (pairs x intervals + 1 x replicates) number of sampled cells in the intervals before every interval
+        cumulative = np.zeros((len(pairs), num_intervals + 1, num_replicates), dtype=np.int16)
+        np.cumsum((membership @ multiplicity).reshape(len(pairs), num_intervals, num_replicates), axis=1,
+                  out=cumulative[:, 1:])
+
+        batch = np.arange(len(pairs))[None, :, None]
+        first_interval = 2 * score_position[pairs[None, :, None], samples[:, None, :]]
+        less_than = cumulative[batch, first_interval + 1, replicates]
+        less_than_or_equal = cumulative[batch, first_interval + 2, replicates]
+        total_entries = cumulative[:, num_intervals].T
+        valid = ~np.isnan(same_concept[pairs[None, :, None], samples[:, None, :]])
+
+        log_normalized_rank = log_normalized_ranks(less_than.reshape(-1, concepts).astype(np.int64),
+                                                   less_than_or_equal.reshape(-1, concepts).astype(np.int64),
+                                                   total_entries.reshape(-1).astype(np.int64))
+        dERC[:, pairs] = dERC_from_log_ranks(log_normalized_rank, valid.reshape(-1, concepts),
+                                             num_concepts).reshape(num_replicates, len(pairs))
+    return dERC
+
+
+def bootstrap_distance_matrices(languages: list[Language], samples: np.ndarray, measure: str = 'LDN',
+                                pmi_matrix=None, open_gap_score: float = None, extend_gap_score: float = None,
+                                out: np.ndarray = None) -> np.ndarray:
+    """
+    The condensed dERC distance matrix of the languages in every bootstrap replicate. The concept score matrices
+    of every row of pairs are computed once (see `concept_score_matrices`) and every replicate is derived from them
+    (see `bootstrap_dERC`), so B replicates cost one scan plus the ranking.
+
+    Parameters:
+    - `languages (list[Language])`: the languages, in the order of the matrices
+    - `samples (np.ndarray)`: (replicates x concepts) sampled concepts, see `bootstrap_samples`
+    - `measure, pmi_matrix, open_gap_score, extend_gap_score`: see `concept_score_matrices`
+    - `out (np.ndarray, optional)`: (replicates x pairs) array to write the distances into, e.g. memory-mapped:
+            the matrices take `8 * replicates * pairs` bytes
+
+    Returns:
+    - `np.ndarray`: (replicates x pairs) condensed distance matrix of every replicate
+    """
+    num_languages = len(languages)
+    samples = np.atleast_2d(samples)
+    distances = np.empty((len(samples), condensed_size(num_languages))) if out is None else out
+    store, indices = store_languages(list(languages))
+    indices = indices.tolist()
+    languages = [store[index] for index in indices]
+    cache = LDNCache(store) if measure == 'LDN' else None
+    for row in range(num_languages - 1):
+        same_concept, cells = concept_score_matrices(languages[row], languages[row + 1:], measure, pmi_matrix,
+                                                     open_gap_score, extend_gap_score, cache=cache)
+        start = condensed_index(row, row + 1, num_languages)
+        distances[:, start:start + num_languages - row - 1] = bootstrap_dERC(
+            same_concept, cells, samples, num_concepts=store.num_concepts(indices[row]))
+    return distances
+
+
+def bootstrap_tree(languages: list[Language], num_replicates: int = DEFAULT_NUM_REPLICATES, build=neighbor_joining,
+                   measure: str = 'LDN', pmi_matrix=None, open_gap_score: float = None,
+                   extend_gap_score: float = None, seed: int = 0) -> tuple[Tree, np.ndarray]:
+    """
+    Build the tree of the languages and the bootstrap support of its branches, resampling the concepts.
+
+    The tree of the original word lists and the trees of the `num_replicates` replicates are all built from one
+    scan (see `bootstrap_distance_matrices`, the original is the replicate that samples every concept once).
+
+    Parameters:
+    - `languages (list[Language])`: the languages
+    - `num_replicates (int, optional)`: number of bootstrap replicates
+    - `build (callable, optional)`: builds a Tree of a DistanceMatrix, `tree_builder.neighbor_joining` by default
+    - `measure, pmi_matrix, open_gap_score, extend_gap_score`: see `concept_score_matrices`
+    - `seed (int, optional)`: seed of the samples
+
+    Returns:
+    - `tuple[Tree, np.ndarray]`: the tree and the support of every node (see `tree_builder.split_support`)
+
+    Example:
+    ```py
+    tree, support = bootstrap_tree(languages, num_replicates=200)
+    print(tree.to_newick(support=support))  # ((A:0.1,B:0.2)87:0.05,...);
+    ```
+    """
+    names = [language.name for language in languages]
+    num_concepts = max((len(language.word_list) for language in languages), default=0)
+    samples = np.vstack((np.arange(num_concepts), bootstrap_samples(num_replicates, num_concepts, seed)))
+    distances = bootstrap_distance_matrices(languages, samples, measure, pmi_matrix, open_gap_score,
+                                            extend_gap_score)
+    tree = build(DistanceMatrix(names, distances[0]))
+    replicate_trees = [build(DistanceMatrix(names, replicate)) for replicate in distances[1:]]
+    return tree, split_support(tree, replicate_trees)
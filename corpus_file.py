@@ -0,0 +1,222 @@
+import json
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+from language import Language
+from wordstore import StoredLanguage, WordStore
+
+
+TRAINING_SET_PATH = "./materials/training_set.corpus"
+TEST_SET_PATH = "./materials/test_set.corpus"
+
+MAGIC = b'ASJPCORP'
+VERSION = 1
+# magic, version, families, languages, concepts per language (most), concept slots, words, symbols,
+#   distinct words, bytes per word id
+__HEADER = struct.Struct('<8sIIIIQQQQQ')
+# every section starts at a multiple of this, so it can be viewed as an array of any type in place
+__ALIGNMENT = 8
+
+
+def save_corpus(language_set: dict[str, list[Language]], path: str):
+    """
+    Write a set of languages grouped by family as a corpus file.
+
+    A corpus file is a header followed by aligned sections:
+    - the family table: the end of every family name in the names buffer, and the names (UTF-8)
+    - the language table: the end of every language name, the names, and the family and number of concepts
+            of every language
+    - the word buffer: the number of words of every concept slot (0 for 'XXX'), the length and vocabulary id
+            of every word, and the symbol codes of all words back to back
+
+    Everything else a WordStore holds is derived from these on load, and all counts are stored in their
+    narrowest type, which makes the file smaller than the JSON it replaces.
+
+    Parameters:
+    - `language_set (dict[str, list[Language]])`: the languages, by family (as `dictionaryhandler.get_split_sets`
+            returns them)
+    - `path (str)`: where to write the file
+    """
+    store = WordStore.from_sets(language_set)
+    family_names, family_name_ends = __encode_names(store.family_names)
+    names, name_ends = __encode_names(store.names)
+    word_id_type = __word_id_type(len(store.vocabulary_lengths))
+    sections = [
+        family_name_ends, family_names,
+        name_ends, names,
+        store.family.astype(np.uint32),
+        __narrow(np.diff(store.language_offsets), np.uint8, "concepts of a language"),
+        __narrow(np.diff(store.concept_offsets), np.uint8, "words of a concept"),
+        __narrow(np.diff(store.word_offsets), np.uint8, "symbols of a word"),
+        store.word_ids.astype(word_id_type),
+        store.symbols,
+    ]
+    header = __HEADER.pack(MAGIC, VERSION, len(store.family_names), len(store.names), store.missing.shape[1],
+                           len(store.concept_offsets) - 1, len(store.word_ids), len(store.symbols),
+                           len(store.vocabulary_lengths), np.dtype(word_id_type).itemsize)
+
+    # written next to the file and moved over it once complete: stores loaded from the old file keep their
+    #   memory-mapped view of it, and an interrupted save leaves the old file as it was
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, 'wb') as file:
+            file.write(header)
+            position = len(header)
+            for section in sections:
+                padding = -position % __ALIGNMENT
+                file.write(bytes(padding))
+                data = np.ascontiguousarray(section).tobytes()
+                file.write(data)
+                position += padding + len(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def load_corpus_store(path: str, memory_map: bool = True) -> WordStore:
+    """
+    Open a corpus file written by `save_corpus` as a WordStore.
+
+    No word is parsed or encoded: the symbol codes are a read-only view into the file, and the offset arrays,
+    the missing mask and the vocabulary are rebuilt from the stored counts with a few array operations.
+
+    Parameters:
+    - `path (str)`: the corpus file
+    - `memory_map (bool, optional)`: map the file instead of reading it, so only the pages that are used are read
+
+    Returns:
+    - `WordStore`: the store
+    """
+    if memory_map:
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        with open(path, 'rb') as file:
+            buffer = file.read()
+
+    (magic, version, num_families, num_languages, max_concepts, num_slots, num_words, num_symbols,
+     vocabulary_size, word_id_bytes) = __HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a corpus file.")
+    if version != VERSION:
+        raise ValueError(f"{path} is a version {version} corpus file, only version {VERSION} can be read.")
+
+    position = __HEADER.size
+
+    def read(dtype, count: int) -> np.ndarray:
+        nonlocal position
+        array, position = __read_section(buffer, position, dtype, count)
+        return array
+
+    family_name_ends = read(np.uint32, num_families)
+    family_names = __decode_names(read(np.uint8, int(family_name_ends[-1]) if num_families else 0),
+                                  family_name_ends)
+    name_ends = read(np.uint32, num_languages)
+    names = __decode_names(read(np.uint8, int(name_ends[-1]) if num_languages else 0), name_ends)
+    family = read(np.uint32, num_languages)
+    num_concepts = read(np.uint8, num_languages)
+    concept_sizes = read(np.uint8, num_slots)
+    word_lengths = read(np.uint8, num_words)
+    word_ids = read({2: np.uint16, 4: np.uint32}[word_id_bytes], num_words)
+    symbols = read(np.uint8, num_symbols)
+
+    # a concept is missing if it has no words ('XXX'), or if its language has fewer concepts
+    language_offsets = __offsets(num_concepts)
+    slot_language = np.repeat(np.arange(num_languages), num_concepts)
+    missing = np.ones((num_languages, max_concepts), dtype=bool)
+    missing[slot_language, np.arange(num_slots) - language_offsets[slot_language]] = concept_sizes == 0
+
+    return WordStore.from_arrays(names, family_names, family.astype(np.int64), symbols,
+                                 __offsets(word_lengths), __offsets(concept_sizes), language_offsets,
+                                 missing, word_ids.astype(np.int64), vocabulary_size)
+
+
+def load_corpus(path: str, memory_map: bool = True) -> dict[str, list[StoredLanguage]]:
+    """
+    Open a corpus file written by `save_corpus`, grouped by family like the set it was written from.
+
+    Returns:
+    - `dict[str, list[StoredLanguage]]`: the languages, as lazy views into the store (see `load_corpus_store`)
+    """
+    return load_corpus_store(path, memory_map).as_sets()
+
+
+def benchmark_loading(corpus_path: str = TRAINING_SET_PATH, json_path: str = "./materials/training_set.json",
+                      repeat: int = 5) -> dict[str, float]:
+    """
+    Time loading the same set from its corpus file (into a WordStore, what `driver.load_sets` returns) and from the
+    JSON it was converted from (into plain Language objects, as `driver.load_json_sets` still does), and reading
+    every word list back.
+
+    Returns:
+    - `dict[str, float]`: the best time in seconds of every way of loading
+    """
+    def load_json():
+        with open(json_path, 'r') as file:
+            serialized_set = json.load(file)
+        return {key: [Language(**language_dict) for language_dict in value] for key, value in serialized_set.items()}
+
+    loaders = {
+        'json': load_json,
+        'corpus (read)': lambda: load_corpus(corpus_path, memory_map=False),
+        'corpus (memory-mapped)': lambda: load_corpus(corpus_path),
+    }
+    timings = {}
+    for name, loader in loaders.items():
+        best_load, best_word_lists = float('inf'), float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            language_set = loader()
+            loaded = time.perf_counter()
+            for family in language_set.values():
+                for language in family:
+                    language.word_list
+            best_load = min(best_load, loaded - start)
+            best_word_lists = min(best_word_lists, time.perf_counter() - loaded)
+        timings[f"{name}: load"] = best_load
+        timings[f"{name}: word lists"] = best_word_lists
+    return timings
+
+
+def __read_section(buffer, position: int, dtype, count: int) -> tuple[np.ndarray, int]:
+    """View the aligned section at `position` as an array without copying it, and return where the next one starts."""
+    position += -position % __ALIGNMENT
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=position)
+    return array, position + array.nbytes
+
+
+def __encode_names(names: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    encoded = [name.encode() for name in names]
+    return (np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            np.cumsum([len(name) for name in encoded], dtype=np.int64).astype(np.uint32))
+
+
+def __decode_names(buffer: np.ndarray, ends: np.ndarray) -> list[str]:
+    data = buffer.tobytes()
+    starts = [0] + ends[:-1].tolist()
+    return [data[start:end].decode() for start, end in zip(starts, ends.tolist())]
+
+
+def __narrow(array: np.ndarray, dtype, what: str) -> np.ndarray:
+    if len(array) and array.max() > np.iinfo(dtype).max:
+        raise ValueError(f"A corpus file holds at most {np.iinfo(dtype).max} {what}.")
+    return array.astype(dtype)
+
+
+def __word_id_type(vocabulary_size: int):
+    return np.uint16 if vocabulary_size <= np.iinfo(np.uint16).max else np.uint32
+
+
+def __offsets(sizes: np.ndarray) -> np.ndarray:
+    return np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+
+
+if __name__ == '__main__':
+    for name, seconds in benchmark_loading().items():
+        print(f"{name}: {seconds * 1000:.1f} ms")
@@ -1,9 +1,17 @@
-import bisect
-import math
-from itertools import product
+from collections import Counter
 
+import numpy as np
+
+from dERC_batch import aggregate_concept_scores, count_ranks, dERC_from_concept_scores, dERC_from_log_ranks, \
+    log_normalized_ranks
 from language import Language
-from levenshtein import calculate_LDN
+from ldn_cache import LDNCache
+from levenshtein import get_encoded_LDN_matrix, get_paired_edit_distances
+from wordstore import NUM_SYMBOLS, WordLayout, store_languages
+
+# bounds have to clear theta_dERC by this much before a pair is rejected on them, so that rounding in the
+#   bound arithmetic can never decide a pair differently from the exact dERC
+__DECISION_MARGIN = 1e-9
 
 
 def calculate_dERC_LDN(L1: Language, L2: Language) -> float:
@@ -25,6 +33,8 @@ def calculate_dERC_LDN(L1: Language, L2: Language) -> float:
     - This function calculates the distance between L1 and L2 using the Levenshtein Distance Normalized (LDN) measure.
     - The dERC/LDN distance reflects the evidence of relatedness between the two languages based on their word lists.
     - The function handles missing or incomplete word lists ('XXX' entries) to ensure accurate calculations.
+    - The words are read from the WordStore behind L1 and L2 (see `wordstore.store_languages`), so languages
+          loaded as store views are scored without any string handling.
 
     Algorithm Steps:
     1. Calculate LDN for on-diagonal entries (concepts in the same position) without 'XXX' entries.
@@ -48,79 +58,215 @@ def calculate_dERC_LDN(L1: Language, L2: Language) -> float:
 
     """
 
-    L1_words: list[list[str]] = L1.word_list
-    L2_words: list[list[str]] = L2.word_list
-
-    on_diagonal = [calculate_LDN(concepts1, concepts2, average=False)
-                   for concepts1, concepts2 in zip(L1_words, L2_words)
-                   if 'XXX' not in concepts1 and 'XXX' not in concepts2]
+    return float(calculate_dERC_LDN_batch(L1, [L2])[0])
 
-    off_diagonal = [calculate_LDN(concepts1, concepts2, average=True)
-                    for (i, concepts1), (j, concepts2) in product(enumerate(L1_words), enumerate(L2_words))
-                    if i != j and 'XXX' not in concepts1 and 'XXX' not in concepts2]
 
-    off_diagonal.sort()
-
-    normalized_ranks = [__calculate_normalized_rank(diagonal_entry=diagonal,
-                                                    off_diagonal_list=off_diagonal
-                                                    ) for diagonal in on_diagonal]
+def calculate_dERC_LDN_batch(L1: Language, languages: list[Language], cache: LDNCache = None) -> np.ndarray:
+    """
+    Calculate the dERC/LDN between one language and many others in a single call.
 
-    N = len(on_diagonal)
+    The LDN of every word pair is computed at once (`get_LDN_matrix`), the on-diagonal and off-diagonal matrices are built as arrays,
+    and the rank, ER, ERC and dERC steps are evaluated for all pairs together (`dERC_from_concept_scores`).
 
-    # NOTE: this should never prock
-    if N == 0:
-        print("ERROR")
-        return 1
+    Parameters:
+    - L1 (Language): The language to be compared.
+    - languages (list[Language]): The languages to compare L1 against.
+    - cache (LDNCache, optional): If given, and it belongs to the store of the languages, word pairs already
+        measured in this run are looked up in it instead of measured again.
 
-    ER = -sum(math.log(normalized_rank)
-              for normalized_rank in normalized_ranks) / N
+    Returns:
+    - np.ndarray: The dERC/LDN distance between L1 and each language in `languages`.
 
-    Nmax = len(L1_words)  # should be 40 always
-    ERmax = -(math.log(1 / ((Nmax * Nmax) - Nmax + 1)))
-    ERmin = 0
+    Example:
+    ```py
+    distances = calculate_dERC_LDN_batch(L1, [L2, L3, L4])
+    print(distances)  # Output could be [0.8315 0.5487 0.9012] (example values).
+    ```
+    """
+    store, indices = store_languages([L1] + list(languages))
+    layout1 = store.layout(indices[:1])
+    layout2 = store.layout(indices[1:])
 
-    ERC = math.sqrt(N) * (ER - 1)
-    ERCmax = math.sqrt(Nmax) * (ERmax - 1)
-    ERCmin = math.sqrt(Nmax) * (ERmin - 1)
+    if __uses_cache(cache, store):
+        word_LDN = cache.LDN_matrix(layout1.vocabulary, layout2.vocabulary)
+    else:
+        word_LDN = get_encoded_LDN_matrix(*layout1.codes, *layout2.codes, alphabet_size=NUM_SYMBOLS)
+    on_diagonal, off_diagonal = aggregate_concept_scores(
+        word_LDN, layout1, layout2, diagonal=np.minimum)
 
-    dERC = (ERCmax - ERC) / (ERCmax - ERCmin)
-    return dERC
+    return dERC_from_concept_scores(on_diagonal, off_diagonal, num_concepts=int(layout1.num_concepts[0]))
 
 
-def __calculate_normalized_rank(diagonal_entry: float, off_diagonal_list: list[float]) -> float:
+def calculate_dERC_LDN_within(L1: Language, languages: list[Language], theta_dERC: float, num_blocks: int = 4,
+                              statistics: Counter = None, cache: LDNCache = None) -> np.ndarray:
     """
-    Calculate the normalized rank for a diagonal entry in a matrix representation.
+    Decide which of `languages` have a dERC/LDN with L1 below or equal to `theta_dERC`, without computing
+    the full dERC/LDN when cheaper bounds already settle it.
+
+    The result is exactly `calculate_dERC_LDN_batch(L1, languages) <= theta_dERC`. Every pair goes through these
+    stages until it is decided:
+    1. on-diagonal: the on-diagonal LDN values are computed exactly (only same-concept word pairs). No
+        off-diagonal value is known yet, but a value of 1 is the highest LDN there is, so every off-diagonal
+        cell ranks below or with it.
+    2. block k of `num_blocks`: the off-diagonal cells of the next block of L1's concepts are computed exactly,
+        for the pairs that are still undecided. After the last block every cell is known and the exact dERC decides.
 
-    This function calculates the normalized rank for a diagonal entry in a matrix represented by the 'off_diagonal_list'.
-    The 'off_diagonal_list' must be sorted in ascending order.
+    The normalized rank grows with both rank counts, so counting only the known cells gives a lower bound
+    on every rank, hence an upper bound on ER and a lower bound on dERC: a pair whose lowest possible dERC is
+    already above `theta_dERC` is rejected. (Most pairs are unrelated, and those are rejected early.)
 
     Parameters:
-    - `diagonal_entry`: The diagonal entry for which the normalized rank needs to be calculated.
-    - `off_diagonal_list (list)`: A sorted list of off-diagonal entries in the matrix.
+    - L1 (Language): The language to be compared.
+    - languages (list[Language]): The languages to compare L1 against.
+    - theta_dERC (float): The threshold.
+    - num_blocks (int, optional): Number of blocks the off-diagonal cells are computed in.
+    - statistics (Counter, optional): If given, the number of pairs rejected at every stage, and accepted or
+        rejected by the exact dERC, is added to it, under keys like `'rejected: block 1/4'`.
+    - cache (LDNCache, optional): see `calculate_dERC_LDN_batch`
 
     Returns:
-    - `float`: The calculated normalized rank for the diagonal entry.
+    - np.ndarray: True for every language within `theta_dERC` of L1.
 
     Example:
+    ```py
+    statistics = Counter()
+    related = calculate_dERC_LDN_within(L1, [L2, L3, L4], 0.65, statistics=statistics)
+    print(related, statistics)  # [ True False False] Counter({'rejected: block 1/4': 2, 'accepted: exact': 1})
     ```
-    diagonal_entry = 5
-    off_diagonal_list = [1, 3, 5, 7, 9]
-    normalized_rank = __calculate_normalized_rank(diagonal_entry, off_diagonal_list)
-    print(normalized_rank)  # Output: 0.3548350710659892 (example value, actual value may vary)
-    ```
     """
-    less_than_or_equal_count = bisect.bisect_right(
-        off_diagonal_list, diagonal_entry)
-    less_than_count = bisect.bisect_left(
-        off_diagonal_list, diagonal_entry)
+    if statistics is None:
+        statistics = Counter()
+    store, indices = store_languages([L1] + list(languages))
+    layout1 = store.layout(indices[:1])
+    layout2 = store.layout(indices[1:])
+    num_concepts = int(layout1.num_concepts[0])
+    num_languages, concepts2 = layout2.valid.shape
+    concepts1 = layout1.valid.shape[1]
+
+    related = np.zeros(num_languages, dtype=bool)
+
+    # off-diagonal cells that count, as in aggregate_concept_scores
+    off_valid = layout1.valid[0][None, :, None] & layout2.valid[:, None, :]
+    shared = min(concepts1, concepts2)
+    off_valid[:, np.arange(shared), np.arange(shared)] = False
+    off_valid = off_valid.reshape(num_languages, -1)
+    total_entries = np.count_nonzero(off_valid, axis=1)
+
+    # 1. on-diagonal: a value of 1 is the highest LDN there is, every cell ranks below or with it
+    if not __uses_cache(cache, store):
+        cache = None
+    on_diagonal = __on_diagonal_LDN(layout1, layout2, cache)
+    valid = ~np.isnan(on_diagonal)
+    no_cells = np.zeros(on_diagonal.shape, dtype=np.int64)
+    all_cells_if_highest = np.where(on_diagonal >= 1, total_entries[:, None], 0)
+    undecided = np.arange(num_languages)
+    keep = __reject(statistics, 'on-diagonal', theta_dERC, num_concepts,
+                    valid, total_entries, no_cells, all_cells_if_highest)
+    undecided = undecided[keep]
+
+    # 2. off-diagonal blocks: known cells are only ever added, so their counts are lower bounds
+    blocks = np.array_split(np.arange(concepts1), max(1, min(num_blocks, concepts1)))
+    known_cells = np.zeros((len(undecided), 0))
+    for block_number, block in enumerate(blocks, start=1):
+        if not len(undecided):
+            break
+        included = np.zeros(concepts1, dtype=bool)
+        included[block] = True
+        stage = f'block {block_number}/{len(blocks)}'
+
+        layout_undecided = store.layout(indices[1:][undecided])
+        word_LDN = __block_LDN_matrix(layout1, layout_undecided, included, cache)
+        _, block_cells = aggregate_concept_scores(word_LDN, layout1, layout_undecided,
+                                                  diagonal=np.minimum, included_concepts=included)
+        known_cells = np.concatenate((known_cells, block_cells[:, np.repeat(included, concepts2)]), axis=1)
+
+        if block_number == len(blocks):
+            # every cell is known: the exact dERC decides (the order of the cells does not matter)
+            dERC = dERC_from_concept_scores(on_diagonal[undecided], known_cells, num_concepts)
+            related[undecided] = dERC <= theta_dERC
+            statistics['accepted: exact'] += int(np.count_nonzero(dERC <= theta_dERC))
+            statistics['rejected: exact'] += int(np.count_nonzero(dERC > theta_dERC))
+            break
+
+        known_less_than, known_less_than_or_equal, _ = count_ranks(on_diagonal[undecided], known_cells)
+        keep = __reject(statistics, stage, theta_dERC, num_concepts, valid[undecided], total_entries[undecided],
+                        known_less_than, np.maximum(known_less_than_or_equal, all_cells_if_highest[undecided]))
+        undecided = undecided[keep]
+        known_cells = known_cells[keep]
+
+    return related
+
+
+def __reject(statistics: Counter, stage: str, theta_dERC: float, num_concepts: int, valid: np.ndarray,
+             total_entries: np.ndarray, low_less_than: np.ndarray, low_less_than_or_equal: np.ndarray) -> np.ndarray:
+    """
+    Reject the pairs whose lowest possible dERC is already above the threshold.
+
+    `low_less_than` and `low_less_than_or_equal` are lower bounds on the rank counts of every on-diagonal entry.
+
+    Returns:
+    - np.ndarray: mask of the pairs that are still undecided
+    """
+    lowest_dERC = dERC_from_log_ranks(
+        log_normalized_ranks(low_less_than, low_less_than_or_equal, total_entries), valid, num_concepts)
+    rejected = lowest_dERC > theta_dERC + __DECISION_MARGIN
+    statistics[f'rejected: {stage}'] += int(np.count_nonzero(rejected))
+    return ~rejected
+
+
+def __uses_cache(cache: LDNCache, store) -> bool:
+    """A cache is keyed on the word ids of one store, it cannot serve languages of another."""
+    return cache is not None and cache.store is store
+
+
+def __on_diagonal_LDN(layout1: WordLayout, layout2: WordLayout, cache: LDNCache = None) -> np.ndarray:
+    """
+    The on-diagonal LDN of `aggregate_concept_scores`, measured on the same-concept word pairs only.
+
+    Returns:
+    - np.ndarray: (languages x concepts1) lowest LDN of every concept, NaN where skipped
+    """
+    num_languages = layout2.valid.shape[0]
+    concepts1 = layout1.valid.shape[1]
+    codes1, lengths1 = layout1.codes
+    codes2, lengths2 = layout2.codes
+    on_diagonal = np.full((num_languages, concepts1), np.nan)
+
+    for synonym1 in range(layout1.word_counts.max(initial=0)):
+        selected1 = layout1.synonym == synonym1
+        word_of_concept = np.full(concepts1, -1)
+        word_of_concept[layout1.concept[selected1]] = layout1.word_id[selected1]
 
-    total_entries = len(off_diagonal_list)
-    normalized_rank = 1
+        entries = np.nonzero(layout2.concept < concepts1)[0]
+        entries = entries[word_of_concept[layout2.concept[entries]] >= 0]
+        # every distinct word pair is measured once
+        pair_keys, inverse = np.unique(word_of_concept[layout2.concept[entries]] * len(lengths2)
+                                       + layout2.word_id[entries], return_inverse=True)
+        id1, id2 = np.divmod(pair_keys, len(lengths2))
+        if cache is not None:
+            LDN = cache.paired_LDN(layout1.vocabulary[id1], layout2.vocabulary[id2])
+        else:
+            distances = get_paired_edit_distances(codes1[id1], lengths1[id1], codes2[id2], lengths2[id2],
+                                                  alphabet_size=NUM_SYMBOLS)
+            LDN = distances / np.maximum(lengths1[id1], lengths2[id2])
+        np.fmin.at(on_diagonal, (layout2.language[entries], layout2.concept[entries]), LDN[inverse])
 
-    rank_count = less_than_or_equal_count - less_than_count + 1
+    return on_diagonal
 
-    for value in range(less_than_count + 1, less_than_or_equal_count + 2):
-        normalized_value = (value / (total_entries + 1)) ** (1 / rank_count)
-        normalized_rank *= normalized_value
 
-    return normalized_rank
+def __block_LDN_matrix(layout1: WordLayout, layout2: WordLayout, included: np.ndarray,
+                       cache: LDNCache = None) -> np.ndarray:
+    """
+    Word by word LDN matrix for `aggregate_concept_scores` with only the rows of the words of the included
+    concepts of the first language filled in (the others are NaN and never read).
+    """
+    codes1, lengths1 = layout1.codes
+    codes2, lengths2 = layout2.codes
+    rows = np.unique(layout1.word_id[included[layout1.concept]])
+    word_LDN = np.full((len(lengths1), len(lengths2)), np.nan)
+    if cache is not None:
+        word_LDN[rows] = cache.LDN_matrix(layout1.vocabulary[rows], layout2.vocabulary)
+    else:
+        word_LDN[rows] = get_encoded_LDN_matrix(codes1[rows], lengths1[rows], codes2, lengths2,
+                                                alphabet_size=NUM_SYMBOLS)
+    return word_LDN
@@ -1,9 +1,9 @@
-import bisect
-import math
-from itertools import product
+import numpy as np
 
+from dERC_batch import aggregate_concept_scores, dERC_from_concept_scores
 from language import Language
-from align import calculate_PMI
+from align import get_encoded_PMI_matrix
+from wordstore import store_languages
 
 
 def calculate_dERC_PMI(L1: Language, L2: Language, pmi_matrix, open_gap_score, extend_gap_score) -> float:
@@ -48,81 +48,34 @@ def calculate_dERC_PMI(L1: Language, L2: Language, pmi_matrix, open_gap_score, e
 
     """
 
-    L1_words: list[list[str]] = L1.word_list
-    L2_words: list[list[str]] = L2.word_list
+    return float(calculate_dERC_PMI_batch(L1, [L2], pmi_matrix, open_gap_score, extend_gap_score)[0])
 
-    # negative because normally bigger PMI is better but for LDN
-    #   smaller is better so that's how it is calibrated
-
-    on_diagonal = [(-1) * calculate_PMI(concepts1, concepts2, pmi_matrix, open_gap_score, extend_gap_score, average=False)
-                   for concepts1, concepts2 in zip(L1_words, L2_words)
-                   if 'XXX' not in concepts1 and 'XXX' not in concepts2]
-
-    off_diagonal = [(-1) * calculate_PMI(concepts1, concepts2, pmi_matrix, open_gap_score, extend_gap_score, average=True)
-                    for (i, concepts1), (j, concepts2) in product(enumerate(L1_words), enumerate(L2_words))
-                    if i != j and 'XXX' not in concepts1 and 'XXX' not in concepts2]
-
-    off_diagonal.sort()
-
-    normalized_ranks = [__calculate_normalized_rank(diagonal_entry=diagonal,
-                                                    off_diagonal_list=off_diagonal
-                                                    ) for diagonal in on_diagonal]
-
-    N = len(on_diagonal)
-
-    # NOTE: this should never prock
-    if N == 0:
-        return 1
-
-    ER = -sum(math.log(normalized_rank)
-              for normalized_rank in normalized_ranks) / N
-
-    Nmax = len(L1_words)  # should be 40 always
-    ERmax = -(math.log(1 / ((Nmax * Nmax) - Nmax + 1)))
-    ERmin = 0
 
-    ERC = math.sqrt(N) * (ER - 1)
-    ERCmax = math.sqrt(Nmax) * (ERmax - 1)
-    ERCmin = math.sqrt(Nmax) * (ERmin - 1)
-
-    dERC = (ERCmax - ERC) / (ERCmax - ERCmin)
-    return dERC
-
-
-def __calculate_normalized_rank(diagonal_entry: float, off_diagonal_list: list[float]) -> float:
+def calculate_dERC_PMI_batch(L1: Language, languages: list[Language], pmi_matrix, open_gap_score, extend_gap_score) -> np.ndarray:
     """
-    Calculate the normalized rank for a diagonal entry in a matrix representation.
+    Calculate the dERC/PMI between one language and many others in a single call.
 
-    This function calculates the normalized rank for a diagonal entry in a matrix represented by the 'off_diagonal_list'.
-    The 'off_diagonal_list' must be sorted in ascending order.
+    Every distinct word pair is aligned once (score-only, in one batch), the on-diagonal (best PMI) and
+    off-diagonal (average PMI) matrices are built as arrays, and the rank, ER, ERC and dERC steps are evaluated for all pairs together.
 
     Parameters:
-    - `diagonal_entry`: The diagonal entry for which the normalized rank needs to be calculated.
-    - `off_diagonal_list (list)`: A sorted list of off-diagonal entries in the matrix.
+    - L1 (Language): The language to be compared.
+    - languages (list[Language]): The languages to compare L1 against.
+    - pmi_matrix: PMI score of every (sorted) pair of characters.
+    - open_gap_score, extend_gap_score: gap penalties of the alignment.
 
     Returns:
-    - `float`: The calculated normalized rank for the diagonal entry.
-
-    Example:
-    ```
-    diagonal_entry = 5
-    off_diagonal_list = [1, 3, 5, 7, 9]
-    normalized_rank = __calculate_normalized_rank(diagonal_entry, off_diagonal_list)
-    print(normalized_rank)  # Output: 0.3548350710659892 (example value, actual value may vary)
-    ```
+    - np.ndarray: The dERC/PMI distance between L1 and each language in `languages`.
     """
-    less_than_or_equal_count = bisect.bisect_right(
-        off_diagonal_list, diagonal_entry)
-    less_than_count = bisect.bisect_left(
-        off_diagonal_list, diagonal_entry)
-
-    total_entries = len(off_diagonal_list)
-    normalized_rank = 1
-
-    rank_count = less_than_or_equal_count - less_than_count + 1
+    store, indices = store_languages([L1] + list(languages))
+    layout1 = store.layout(indices[:1])
+    layout2 = store.layout(indices[1:])
 
-    for value in range(less_than_count + 1, less_than_or_equal_count + 2):
-        normalized_value = (value / (total_entries + 1)) ** (1 / rank_count)
-        normalized_rank *= normalized_value
+    word_PMI = get_encoded_PMI_matrix(*layout1.codes, *layout2.codes,
+                                      pmi_matrix, open_gap_score, extend_gap_score)
+    on_diagonal, off_diagonal = aggregate_concept_scores(
+        word_PMI, layout1, layout2, diagonal=np.maximum)
 
-    return normalized_rank
+    # negative because normally bigger PMI is better but for LDN
+    #   smaller is better so that's how it is calibrated
+    return dERC_from_concept_scores(-on_diagonal, -off_diagonal, num_concepts=int(layout1.num_concepts[0]))
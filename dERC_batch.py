@@ -0,0 +1,161 @@
+import math
+
+import numpy as np
+
+from wordstore import WordLayout
+
+
+def aggregate_concept_scores(word_scores: np.ndarray, layout1: WordLayout, layout2: WordLayout,
+                             diagonal=np.minimum, included_concepts: np.ndarray = None,
+                             same_concept_cells: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce a word-by-word score matrix to the on-diagonal and off-diagonal concept scores of the single
+    language in `layout1` against every language in `layout2`.
+
+    On-diagonal entries are reduced with `diagonal` (np.minimum for LDN, np.maximum for PMI).
+    Off-diagonal entries are the average over all word pairs, summed in the same order as
+    `calculate_LDN`/`calculate_PMI` so that the results are bit for bit identical.
+
+    Parameters:
+    - `word_scores (np.ndarray)`: (len(layout1.vocabulary) x len(layout2.vocabulary)) word pair scores
+    - `layout1 (WordLayout)`: layout of exactly one language
+    - `layout2 (WordLayout)`: layout of the languages to be compared against
+    - `diagonal (np.ufunc)`: reduction used for the on-diagonal entries
+    - `included_concepts (np.ndarray, optional)`: boolean mask of the concepts of the first language to aggregate.
+        The rows of `word_scores` of the other concepts' words are never read, and their entries are NaN.
+    - `same_concept_cells (bool, optional)`: keep the average of the word pairs of the same concept in the
+        off-diagonal matrix instead of skipping it, as a concept sampled twice needs (see `concept_bootstrap`)
+
+    Returns:
+    - `tuple[np.ndarray, np.ndarray]`: (languages x concepts1) on-diagonal scores and
+        (languages x concepts1 * concepts2) off-diagonal scores. Entries that the scalar calculators
+        would skip ('XXX' concepts, the diagonal in the off-diagonal matrix, padding) are NaN.
+    """
+    num_languages, concepts2 = layout2.valid.shape
+    concepts1 = layout1.valid.shape[1]
+
+    included1 = np.ones(concepts1, dtype=bool) if included_concepts is None \
+        else np.asarray(included_concepts, dtype=bool)
+    # off-diagonal rows are only kept for the included concepts
+    rows1 = np.nonzero(included1)[0]
+    row_of_concept = np.cumsum(included1) - 1
+
+    on_diagonal = np.full((num_languages, concepts1), np.nan)
+    off_diagonal = np.zeros((num_languages, concepts2, len(rows1)))
+
+    for synonym1 in range(layout1.word_counts.max(initial=0)):
+        selected1 = (layout1.synonym == synonym1) & included1[layout1.concept]
+        concept_index1 = layout1.concept[selected1]
+        scores1 = word_scores[layout1.word_id[selected1]]
+
+        for synonym2 in range(layout2.word_counts.max(initial=0)):
+            selected2 = np.nonzero(layout2.synonym == synonym2)[0]
+            language_index = layout2.language[selected2]
+            concept_index2 = layout2.concept[selected2]
+            scores = scores1[:, layout2.word_id[selected2]].T
+
+            # (language, concept2) is unique within one synonym position, so += is safe
+            off_diagonal[language_index[:, None], concept_index2[:, None],
+                         row_of_concept[concept_index1][None, :]] += scores
+
+            same_concept = np.nonzero(
+                concept_index2[:, None] == concept_index1[None, :])
+            language_index = language_index[same_concept[0]]
+            concept_index = concept_index2[same_concept[0]]
+            current = on_diagonal[language_index, concept_index]
+            on_diagonal[language_index, concept_index] = np.where(
+                np.isnan(current), scores[same_concept],
+                diagonal(current, scores[same_concept]))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        off_diagonal /= layout2.word_counts[:, :, None] * layout1.word_counts[0][None, None, rows1]
+    off_diagonal = off_diagonal.transpose(0, 2, 1).copy()
+
+    off_valid = layout1.valid[0][rows1][None, :, None] & layout2.valid[:, None, :]
+    on_rows = np.nonzero(rows1 < concepts2)[0]
+    if not same_concept_cells:
+        off_valid[:, on_rows, rows1[on_rows]] = False
+    off_diagonal[~off_valid] = np.nan
+
+    if included_concepts is not None:
+        all_rows = np.full((num_languages, concepts1, concepts2), np.nan)
+        all_rows[:, rows1] = off_diagonal
+        off_diagonal = all_rows
+
+    return on_diagonal, off_diagonal.reshape(num_languages, -1)
+
+
+def dERC_from_concept_scores(on_diagonal: np.ndarray, off_diagonal: np.ndarray, num_concepts: int) -> np.ndarray:
+    """
+    Evaluate the rank, ER, ERC and dERC steps of `calculate_dERC_LDN` for a batch of language pairs.
+
+    Lower scores must mean "more similar" (negate PMI scores before calling this).
+
+    Parameters:
+    - `on_diagonal (np.ndarray)`: (pairs x concepts) on-diagonal scores, NaN where skipped
+    - `off_diagonal (np.ndarray)`: (pairs x cells) off-diagonal scores, NaN where skipped
+    - `num_concepts (int)`: Nmax, the number of concepts of the first language (should be 40 always)
+
+    Returns:
+    - `np.ndarray`: dERC of every pair. Pairs without a single usable concept get 1.
+    """
+    less_than_count, less_than_or_equal_count, total_entries = count_ranks(on_diagonal, off_diagonal)
+    log_normalized_rank = log_normalized_ranks(less_than_count, less_than_or_equal_count, total_entries)
+    return dERC_from_log_ranks(log_normalized_rank, ~np.isnan(on_diagonal), num_concepts)
+
+
+def count_ranks(on_diagonal: np.ndarray, off_diagonal: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count, for every on-diagonal entry, the off-diagonal entries of the same pair that are lower than it
+    and lower than or equal to it.
+
+    Returns:
+    - `tuple[np.ndarray, np.ndarray, np.ndarray]`: (pairs x concepts) less-than and less-than-or-equal counts,
+        and the number of (non-NaN) off-diagonal entries of every pair
+    """
+    off_sorted = np.sort(off_diagonal, axis=1)  # NaN goes last
+    total_entries = np.count_nonzero(~np.isnan(off_diagonal), axis=1)
+    less_than_count = np.zeros(on_diagonal.shape, dtype=np.int64)
+    less_than_or_equal_count = np.zeros(on_diagonal.shape, dtype=np.int64)
+    for row in range(len(off_sorted)):
+        finite = off_sorted[row, :total_entries[row]]
+        less_than_count[row] = np.searchsorted(finite, on_diagonal[row], side='left')
+        less_than_or_equal_count[row] = np.searchsorted(finite, on_diagonal[row], side='right')
+    return less_than_count, less_than_or_equal_count, total_entries
+
+
+def log_normalized_ranks(less_than_count: np.ndarray, less_than_or_equal_count: np.ndarray,
+                         total_entries: np.ndarray) -> np.ndarray:
+    """
+    Log of the normalized rank of every on-diagonal entry:
+        prod((value / (total + 1)) ** (1 / rank_count) for value in lt + 1 ... le + 1)
+
+    The normalized rank grows with both counts, which is what makes partial counts usable as bounds.
+    """
+    log_factorial = np.concatenate(
+        ([0.0], np.cumsum(np.log(np.arange(1, total_entries.max(initial=0) + 2)))))
+    rank_count = less_than_or_equal_count - less_than_count + 1
+    return (log_factorial[less_than_or_equal_count + 1] - log_factorial[less_than_count]) / rank_count \
+        - np.log(total_entries + 1)[:, None]
+
+
+def dERC_from_log_ranks(log_normalized_rank: np.ndarray, valid: np.ndarray, num_concepts: int) -> np.ndarray:
+    """
+    Evaluate the ER, ERC and dERC steps from the log normalized ranks of the valid on-diagonal entries.
+
+    Returns:
+    - `np.ndarray`: dERC of every pair. Pairs without a single usable concept get 1.
+    """
+    N = np.count_nonzero(valid, axis=1)
+    ER = -np.where(valid, log_normalized_rank, 0.0).sum(axis=1) / np.maximum(N, 1)
+
+    Nmax = num_concepts
+    ERmax = -(math.log(1 / ((Nmax * Nmax) - Nmax + 1)))
+    ERmin = 0
+
+    ERC = np.sqrt(N) * (ER - 1)
+    ERCmax = math.sqrt(Nmax) * (ERmax - 1)
+    ERCmin = math.sqrt(Nmax) * (ERmin - 1)
+
+    dERC = (ERCmax - ERC) / (ERCmax - ERCmin)
+    return np.where(N == 0, 1.0, dERC)
@@ -1,121 +1,191 @@
+import io
 import re
 import random
 
-from filehandler import get_text
+from filehandler import open_text
 from language import Language
+from wordstore import CHARS, EncodedLanguage
 
 
-def build_dictionaries_with_families(text: str) -> tuple[dict[str, list[Language]], dict[int, str]]:
-    lines = text.strip().split('\n')
+LISTS_PATH = "materials/lists.txt"
 
-    # Find the indices of the language sections
-    language_indices = [i for i, line in enumerate(
-        lines) if "|" in line.strip()]
+# punctuation and the '!' that do not start a word are not part of the phonetic word
+__PHONETIC_NOISE = re.compile(r'[^\w!]|(?!^)!')
+# deletes every ASCIIPMA symbol, so what is left of a word are the symbols that make its language culled
+#   (this covers the illegal strings "0", "1", "2", "6", "9", "W", "A", ..., "\\", "ï", "½", all single symbols)
+__DELETE_LEGAL = str.maketrans('', '', ''.join(CHARS))
+# languages with this many missing ('XXX') concepts are culled
+MAX_MISSING = 10
 
-    # Extract the common words section
-    common_words_section = lines[:language_indices[0]]
 
-    # Build the dictionary for the 40 chosen words
-    #   Currently, it is Swadesh number of word --> english word
-    common_words = {}
-    for line in common_words_section:
-        parts = line.strip().split()
-        if len(parts) != 2:
+def read_languages(file, cull: bool = False, encoded: bool = False, common_words: dict[int, str] = None,
+                   rejected: list[tuple[str, str, str]] = None):
+    """
+    Parse an ASJP `lists.txt` line by line, yielding every language as soon as its section ends.
+
+    The file starts with the chosen concepts ("number english_word"), followed by one section per language:
+    a "NAME{Family.Genus|...}" line, a line of metadata, and one line per concept. Only one section is held
+    at a time, so memory does not grow with the file.
+
+    Parameters:
+    - `file`: the open file, or any iterable of lines
+    - `cull (bool, optional)`: leave out the languages `cull_languages` would remove, before they are built
+    - `encoded (bool, optional)`: yield `EncodedLanguage` records (words as symbol codes) instead of Languages.
+            Only for culled files, words with symbols that are not ASCIIPMA cannot be encoded.
+    - `common_words (dict[int, str], optional)`: filled with the chosen concepts (number -> english word)
+    - `rejected (list[tuple[str, str, str]], optional)`: with `cull`, filled with the family, name and
+            `rejection_reason` of every culled language
+
+    Yields:
+    - `tuple[str, Language]`: the family and the language, in file order
+    """
+    if common_words is None:
+        common_words = {}
+    section = None
+    for line in file:
+        line = line.rstrip('\n')
+        if "|" in line:
+            if section is not None:
+                yield from __parse_language(section, common_words, cull, encoded, rejected)
+            section = [line]
+        elif section is not None:
+            section.append(line)
+        else:
+            # Build the dictionary for the 40 chosen words
+            #   Currently, it is Swadesh number of word --> english word
+            parts = line.split()
+            if len(parts) == 2:
+                common_words[int(parts[0])] = parts[1]
+    if section is not None:
+        yield from __parse_language(section, common_words, cull, encoded, rejected)
+
+
+def __parse_language(section: list[str], common_words: dict[int, str], cull: bool, encoded: bool,
+                     rejected: list):
+    # Extract the language name and family from the first line
+    language_name = section[0].split("{")[0].strip()
+    language_family = section[0][section[0].find("{")+1:section[0].find(".")]
+    if cull:
+        # the family and the name are enough to reject most culled languages, before their words are read
+        reason = rejection_reason(language_family, language_name, [])
+        if reason is not None:
+            if rejected is not None:
+                rejected.append((language_family, language_name, reason))
+            return
+
+    # Build the dictionary for the current language
+    #   Currently, it is english word -> translated phonetic word
+    language_words = {}
+    for line in section[2:]:
+        parts = line.split()
+        if len(parts) <= 3:  # Malformed / not what I'm looking for
             continue
-        number = parts[0].strip()
-        word = parts[1].strip()
-        common_words[int(number)] = word
-
-    # Build dictionaries for each language
-    languages = {}
-    for i in range(len(language_indices)):
-        start_index = language_indices[i]
-        end_index = language_indices[i +
-                                     1] if i < len(language_indices) - 1 else len(lines)
-        language_section = lines[start_index:end_index]
-
-        # Extract the language name from the first line
-        language_name = language_section[0].split("{")[0].strip()
-        language_family = language_section[0][language_section[0].find(
-            "{")+1:language_section[0].find(".")]
-
-        # Initialize the language list if it doesn't exist
-        if language_family not in languages:
-            languages[language_family] = []
-
-        # Build the dictionary for the current language
-        #   Currently, it is english word -> translated phonetic word
-        language_words = {}
-        for line in language_section[2:]:
-            parts = line.strip().split()
-            if len(parts) <= 3:  # Malformed / not what I'm looking for
-                continue
-            number = parts[0].strip()
-            # no synonyms!!!
-            phonetic = [re.sub(r'[^\w!]|(?!^)!', '', part)
-                        for part in parts[2:] if re.sub(r'[^\w!]|(?!^)!', '', part)]
-            language_words[int(number)] = phonetic
-
-        # Add common words to the language dictionary
-        filtered_language_words = [
-            value for key, value in language_words.items() if key in common_words.keys()]
-        languages[language_family].append(
-            Language(language_name, filtered_language_words))
-
-    return languages, common_words
+        # no synonyms!!!
+        phonetic = [word for word in (__PHONETIC_NOISE.sub('', part) for part in parts[2:]) if word]
+        language_words[int(parts[0])] = phonetic
 
+    # Add common words to the language dictionary
+    word_list = [value for key, value in language_words.items() if key in common_words]
+    if cull:
+        reason = rejection_reason(language_family, language_name, word_list)
+        if reason is not None:
+            if rejected is not None:
+                rejected.append((language_family, language_name, reason))
+            return
+    yield language_family, (EncodedLanguage if encoded else Language)(language_name, word_list)
 
-def cull_languages(dictionary):
-    illegal_strings = ["0", "1", "2", "6", "9", "W", "A", "B",
-                       "D", "F", "H", "I", "J", "K", "M", "O",
-                       "P", "Q", "R", "U", "V", "W", "Y", "\\", "ï", "½"]
-    legal_chars = ['p', 'b', 'f', 'v', 'm', 'w', '8', '4', 't', 'd', 's', 'z', 'c', 'n', 'r', 'l', 'S', 'Z', 'C', 'j',
-                   'T', '5', 'y', 'k', 'g', 'x', 'N', 'q', 'G', 'X', 'h', '7', 'L', '!', 'i', 'e', 'E', '3', 'a', 'u', 'o']
 
-    families_to_remove = []
+def build_dictionaries_with_families(text: str) -> tuple[dict[str, list[Language]], dict[int, str]]:
+    common_words = {}
+    languages = __group_by_family(read_languages(io.StringIO(text.strip()), common_words=common_words))
+    return languages, common_words
 
-    # Create a copy of the dictionary keys
-    family_names = list(dictionary.keys())
 
-    for family_name in family_names:
-        if family_name == "Oth":
-            families_to_remove.append(family_name)
-            continue
+def load_dictionaries_with_families(filename: str = LISTS_PATH, cull: bool = True, encoded: bool = False,
+                                    rejected: list[tuple[str, str, str]] = None
+                                    ) -> tuple[dict[str, list[Language]], dict[int, str]]:
+    """
+    Stream an ASJP `lists.txt` into languages grouped by family (see `read_languages`), without ever holding the
+    whole text. With `cull`, the result is that of `cull_languages`, but rejected languages are never built
+    (they are only reported in `rejected`).
 
-        languages_to_remove_in_family = []
+    Returns:
+    - `tuple[dict[str, list[Language]], dict[int, str]]`: the languages by family, and the chosen concepts
+    """
+    common_words = {}
+    with open_text(filename) as file:
+        languages = __group_by_family(read_languages(file, cull=cull, encoded=encoded, common_words=common_words,
+                                                     rejected=rejected))
+    return languages, common_words
 
-        for language in dictionary[family_name]:
-            if "PROTO" in language.name or "OLD" in language.name or language.name[-1].isdigit():
-                languages_to_remove_in_family.append(language)
-                continue
 
-            all_words = [word for word_list in language.word_list
-                         for word in word_list]
+def __group_by_family(records) -> dict[str, list[Language]]:
+    languages = {}
+    for language_family, language in records:
+        languages.setdefault(language_family, []).append(language)
+    return languages
 
-            # Check if any word contains illegal strings
-            if any(illegal_string in word for illegal_string in illegal_strings for word in all_words):
-                languages_to_remove_in_family.append(language)
 
-            # Check if any character in the word is not a legal character
-            if any(character not in legal_chars for word in all_words for character in word):
-                languages_to_remove_in_family.append(language)
+def rejection_reason(family_name: str, language_name: str, word_list: list[list[str]]) -> str:
+    """
+    Why `cull_languages` removes a language, in one pass over its words.
 
-            # Check if there are more than 10 missing entries
-            if all_words.count("XXX") >= 10:
-                languages_to_remove_in_family.append(language)
+    Parameters:
+    - `family_name (str)`: the family of the language
+    - `language_name (str)`: its name
+    - `word_list (list[list[str]])`: its words
 
-        # Remove languages from the family
-        for language in languages_to_remove_in_family:
-            if language in dictionary[family_name]:
-                dictionary[family_name].remove(language)
+    Returns:
+    - `str`: the reason, or None if the language is kept
+    """
+    if family_name == "Oth":
+        return "family Oth"
+    if "PROTO" in language_name:
+        return "proto-language"
+    if "OLD" in language_name:
+        return "old language"
+    if language_name[-1].isdigit():
+        return "numbered doculect"
+
+    # every word is checked once: for symbols that are not ASCIIPMA, and for being missing ('XXX')
+    num_missing = 0
+    for words in word_list:
+        for word in words:
+            illegal = word.translate(__DELETE_LEGAL)
+            if illegal:
+                return f"illegal symbol {illegal[0]!r}"
+            num_missing += word == "XXX"
+    if num_missing >= MAX_MISSING:
+        return f"{num_missing} missing concepts"
+    return None
+
+
+def cull_languages(dictionary, rejected: list[tuple[str, str, str]] = None):
+    """
+    Remove the languages that cannot be used (see `rejection_reason`), and the families left empty, in place.
 
-        # If the family has no remaining languages, mark it for removal
-        if not dictionary[family_name]:
-            families_to_remove.append(family_name)
+    Parameters:
+    - `dictionary (dict[str, list[Language]])`: the languages, by family
+    - `rejected (list[tuple[str, str, str]], optional)`: filled with the family, name and reason of every
+            removed language
 
-    # Remove families from the dictionary
-    for family in families_to_remove:
-        dictionary.pop(family)
+    Returns:
+    - `dict[str, list[Language]]`: `dictionary`
+    """
+    for family_name in list(dictionary.keys()):
+        kept = []
+        for language in dictionary[family_name]:
+            reason = rejection_reason(family_name, language.name, language.word_list)
+            if reason is None:
+                kept.append(language)
+            elif rejected is not None:
+                rejected.append((family_name, language.name, reason))
+
+        # If the family has no remaining languages, remove it
+        if kept:
+            dictionary[family_name][:] = kept
+        else:
+            dictionary.pop(family_name)
 
     return dictionary
 
@@ -159,10 +229,8 @@ def get_split_sets():
 
     This function is meant to be a one-stop-shop for a quick training and test set. 
     """
-    # get full wordlist
-    full_wordlist, common = build_dictionaries_with_families(
-        get_text("materials/lists.txt"))
-    full_wordlist = cull_languages(full_wordlist)
+    # get full wordlist, culled as it is read
+    full_wordlist, common = load_dictionaries_with_families(LISTS_PATH, cull=True)
 
     # split wordlist into training set and test set (not super useful now lol)
     training_set, test_set = split_languages(full_wordlist)
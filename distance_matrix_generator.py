@@ -0,0 +1,513 @@
+import json
+import multiprocessing
+import os
+from collections import Counter
+from functools import partial
+
+import numpy as np
+
+import instrumentation
+from dERC_LDNcalculator import calculate_dERC_LDN_batch, calculate_dERC_LDN_within
+from language import Language
+from ldn_cache import DEFAULT_CACHE_BYTES, LDNCache
+from wordstore import store_languages
+
+
+DEFAULT_CHUNK_SIZE = 50_000
+DISTANCE_MATRIX_PATH = "./materials/dERC_LDN_distances.npy"
+
+# set in every worker process by __init_worker, so the corpus is only shipped once per worker
+__worker_store = None
+__worker_indices = None
+__worker_score_batch = None
+__worker_cache = None
+# pruning statistics of the block a worker is scoring (see scan_related_pairs)
+__worker_statistics = Counter()
+
+
+def condensed_size(num_languages: int) -> int:
+    """Number of (i, j) pairs with i < j, the length of a condensed distance matrix."""
+    return num_languages * (num_languages - 1) // 2
+
+
+def condensed_index(i, j, num_languages: int):
+    """
+    Position of the pair (i, j), i < j, in a condensed distance matrix (the order of `itertools.combinations`
+    and `scipy.spatial.distance.squareform`). Works on scalars and arrays.
+    """
+    return num_languages * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def condensed_pairs(num_languages: int, positions=None) -> tuple[np.ndarray, np.ndarray]:
+    """Return the i and j of the given positions (all positions by default) of a condensed distance matrix."""
+    if positions is None:
+        return np.triu_indices(num_languages, 1)
+    positions = np.asarray(positions, dtype=np.int64)
+    row_starts = condensed_index(np.arange(num_languages), np.arange(num_languages) + 1, num_languages)
+    i = np.searchsorted(row_starts, positions, side='right') - 1
+    return i, positions - row_starts[i] + i + 1
+
+
+def pair_blocks(num_languages: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> list[tuple[int, int]]:
+    """
+    Split the rows of the pair triangle into blocks of about `chunk_size` pairs each.
+
+    Row i holds the pairs (i, i + 1) ... (i, n - 1), so early rows are long and late rows are short;
+    blocks are cut by pair count, not by row count, to keep the workers evenly loaded.
+
+    Returns:
+    - `list[tuple[int, int]]`: (first row, last row + 1) of every block
+    """
+    row_sizes = num_languages - 1 - np.arange(num_languages)
+    row_ends = np.cumsum(row_sizes)
+    blocks = []
+    start = 0
+    while start < num_languages - 1:
+        # at least one row per block, rows are never split
+        stop = max(start + 1, int(np.searchsorted(row_ends, row_ends[start] - row_sizes[start] + chunk_size,
+                                                  side='right')))
+        stop = min(stop, num_languages - 1)
+        blocks.append((start, stop))
+        start = stop
+    return blocks
+
+
+def scan_all_pairs(languages: list[Language], num_workers: int = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   score_batch=calculate_dERC_LDN_batch, progress=None, out: np.ndarray = None,
+                   statistics: Counter = None, cache_bytes: int = DEFAULT_CACHE_BYTES) -> np.ndarray:
+    """
+    Score every pair of languages (i < j) and return the scores as a condensed distance matrix.
+
+    The languages are put in a WordStore that is sent to each worker once (through the pool initializer).
+    Workers are handed blocks of rows of the pair triangle (see `pair_blocks`), score each row with a single
+    `score_batch(languages[i], languages[i + 1:])` call and stream the row back, which is written straight into
+    the preallocated result. No Language objects are pickled per pair and no per-pair results are kept.
+    Every worker keeps an `LDNCache` for the whole scan, so a word shared by many languages has its distances
+    measured once per worker instead of once per row it appears in.
+
+    Parameters:
+    - `languages (list[Language])`: the languages, in the order of the matrix
+    - `num_workers (int, optional)`: number of worker processes. Defaults to the number of CPU cores,
+            1 scores everything in this process.
+    - `chunk_size (int, optional)`: approximate number of pairs per block handed to a worker
+    - `score_batch (callable, optional)`: scores one language against a list of languages,
+            `calculate_dERC_LDN_batch` by default. Must be a module level function (it is pickled), and accept
+            a `cache` keyword argument unless `cache_bytes` is 0.
+    - `progress (callable, optional)`: called as `progress(pairs_done, total_pairs)` after every block,
+            prints the progress by default
+    - `out (np.ndarray, optional)`: array of length `condensed_size(len(languages))` to write the scores into,
+            for example a memory-mapped file (see `generate_distance_matrix`)
+    - `statistics (Counter, optional)`: collects what `score_batch` counts in `__worker_statistics`
+            (see `scan_related_pairs`), and the hits, misses and evictions of the worker caches
+    - `cache_bytes (int, optional)`: size bound of the `LDNCache` of every worker. 0 disables the cache,
+            and `score_batch` is then called without a `cache` argument.
+
+    Returns:
+    - `np.ndarray`: condensed distance matrix, `score_batch(languages[i], [languages[j]])` is at
+            `condensed_index(i, j, len(languages))`
+
+    Example:
+    ```py
+    distances = scan_all_pairs(languages, num_workers=8)
+    i, j = condensed_pairs(len(languages))
+    related = [(languages[a], languages[b]) for a, b in zip(i[distances <= 0.65], j[distances <= 0.65])]
+    ```
+    """
+    if progress is None:
+        progress = __print_progress
+    num_languages = len(languages)
+    total_pairs = condensed_size(num_languages)
+    distances = np.empty(total_pairs) if out is None else out
+    if statistics is None:
+        statistics = Counter()
+    if len(distances) != total_pairs:
+        raise ValueError(f"out holds {len(distances)} scores, {total_pairs} are needed.")
+    if total_pairs == 0:
+        return distances
+
+    store, indices = store_languages(list(languages))
+    blocks = pair_blocks(num_languages, chunk_size)
+    num_workers = num_workers or multiprocessing.cpu_count()
+
+    pairs_done = 0
+    if num_workers == 1:
+        __init_worker(store, indices, score_batch, cache_bytes)
+        for block in blocks:
+            rows, block_statistics = __score_block(block)
+            pairs_done += __write_block(distances, rows, num_languages)
+            statistics.update(block_statistics)
+            instrumentation.count_all(block_statistics, prefix='distance scan: ')
+            progress(pairs_done, total_pairs)
+        return distances
+
+    with multiprocessing.Pool(processes=num_workers, initializer=__init_worker,
+                              initargs=(store, indices, score_batch, cache_bytes)) as pool:
+        for rows, block_statistics in pool.imap_unordered(__score_block, blocks):
+            pairs_done += __write_block(distances, rows, num_languages)
+            statistics.update(block_statistics)
+            instrumentation.count_all(block_statistics, prefix='distance scan: ')
+            progress(pairs_done, total_pairs)
+
+    return distances
+
+
+def scan_related_pairs(languages: list[Language], theta_dERC: float, num_workers: int = None,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE, num_blocks: int = 4, progress=None,
+                       statistics: Counter = None, cache_bytes: int = 0) -> np.ndarray:
+    """
+    Find every pair of languages within `theta_dERC` of each other with the bounded dERC/LDN
+    (`calculate_dERC_LDN_within`), which stops scoring a pair as soon as it provably cannot be related.
+
+    The work is scheduled like `scan_all_pairs`, and the result is exactly `scan_all_pairs(languages) <= theta_dERC`.
+    It is not much faster: most pairs are only rejected after the first block of off-diagonal cells, and the
+    full scan's cells are cheap already (400 training languages at 0.65: 14.4 to 16.5 s, against 15 to 18.7 s).
+    The worker caches are off by default: with them the scan measured 15.9 s, without them 14.4 s.
+
+    Parameters:
+    - `languages (list[Language])`: the languages, in the order of the matrix
+    - `theta_dERC (float)`: the threshold
+    - `num_workers, chunk_size, progress`: see `scan_all_pairs`
+    - `num_blocks (int, optional)`: see `calculate_dERC_LDN_within`
+    - `cache_bytes (int, optional)`: see `scan_all_pairs`, 0 (no cache) by default
+    - `statistics (Counter, optional)`: if given, the number of pairs rejected at every stage (and accepted or
+            rejected by the exact dERC) is added to it
+
+    Returns:
+    - `np.ndarray`: condensed boolean matrix, True for the related pairs
+    """
+    return scan_all_pairs(languages, num_workers=num_workers, chunk_size=chunk_size,
+                          score_batch=partial(__within_threshold, theta_dERC=theta_dERC, num_blocks=num_blocks),
+                          progress=progress, out=np.zeros(condensed_size(len(languages)), dtype=bool),
+                          statistics=statistics, cache_bytes=cache_bytes)
+
+
+def scan_candidate_pairs(languages: list[Language], first: np.ndarray, second: np.ndarray, num_workers: int = None,
+                         chunk_size: int = DEFAULT_CHUNK_SIZE, score_batch=calculate_dERC_LDN_batch, progress=None,
+                         out: np.ndarray = None, statistics: Counter = None,
+                         cache_bytes: int = DEFAULT_CACHE_BYTES) -> np.ndarray:
+    """
+    Score only the given pairs of languages, e.g. the candidates of an `lsh_index.NGramLSHIndex`.
+
+    The work is scheduled like `scan_all_pairs`: the pairs are grouped by their first language, every group is
+    scored with a single `score_batch(languages[i], [languages[j] for its j])` call, and groups are handed to the
+    workers in blocks of about `chunk_size` pairs.
+
+    Parameters:
+    - `languages (list[Language])`: the languages
+    - `first (np.ndarray)`, `second (np.ndarray)`: the i and j of every pair, sorted by i (as `condensed_pairs`
+            returns them)
+    - `num_workers, chunk_size, score_batch, progress, statistics, cache_bytes`: see `scan_all_pairs`
+    - `out (np.ndarray, optional)`: array of length `len(first)` to write the scores into
+
+    Returns:
+    - `np.ndarray`: `score_batch(languages[first[k]], [languages[second[k]]])` of every pair k
+    """
+    if progress is None:
+        progress = __print_progress
+    first, second = np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64)
+    if np.any(np.diff(first) < 0):
+        raise ValueError("The pairs must be sorted by their first language.")
+    scores = np.empty(len(first)) if out is None else out
+    if statistics is None:
+        statistics = Counter()
+    if len(scores) != len(first):
+        raise ValueError(f"out holds {len(scores)} scores, {len(first)} are needed.")
+    if len(first) == 0:
+        return scores
+
+    rows, row_starts = np.unique(first, return_index=True)
+    row_ends = np.append(row_starts[1:], len(first))
+    blocks = []
+    for start in range(0, len(first), chunk_size):
+        # rows are never split: a block takes the rows that start in its range of pairs
+        block_rows = range(np.searchsorted(row_starts, start), np.searchsorted(row_starts, start + chunk_size))
+        blocks.append([(int(rows[row]), second[row_starts[row]:row_ends[row]]) for row in block_rows])
+    offsets = dict(zip(rows.tolist(), row_starts.tolist()))
+    store, indices = store_languages(list(languages))
+    num_workers = num_workers or multiprocessing.cpu_count()
+
+    pairs_done = 0
+    if num_workers == 1:
+        __init_worker(store, indices, score_batch, cache_bytes)
+        for block in blocks:
+            scored_rows, block_statistics = __score_rows(block)
+            pairs_done += __write_rows(scores, scored_rows, offsets)
+            statistics.update(block_statistics)
+            instrumentation.count_all(block_statistics, prefix='candidate scan: ')
+            progress(pairs_done, len(first))
+        return scores
+
+    with multiprocessing.Pool(processes=num_workers, initializer=__init_worker,
+                              initargs=(store, indices, score_batch, cache_bytes)) as pool:
+        for scored_rows, block_statistics in pool.imap_unordered(__score_rows, blocks):
+            pairs_done += __write_rows(scores, scored_rows, offsets)
+            statistics.update(block_statistics)
+            instrumentation.count_all(block_statistics, prefix='candidate scan: ')
+            progress(pairs_done, len(first))
+
+    return scores
+
+
+def generate_distance_matrix(languages: list[Language], path: str = DISTANCE_MATRIX_PATH, num_workers: int = None,
+                             chunk_size: int = DEFAULT_CHUNK_SIZE, progress=None,
+                             cache_bytes: int = DEFAULT_CACHE_BYTES) -> 'DistanceMatrix':
+    """
+    Score every pair of languages (see `scan_all_pairs`) straight into a memory-mapped `.npy` file and save the
+    language names next to it, so the full matrix only ever has to be computed once.
+
+    Parameters:
+    - `languages (list[Language])`: the languages, in the order of the matrix
+    - `path (str, optional)`: where to save the condensed matrix. The names go to `<path without .npy>_names.json`.
+    - `num_workers, chunk_size, progress, cache_bytes`: see `scan_all_pairs`
+
+    Returns:
+    - `DistanceMatrix`: the saved matrix, opened read-only
+    """
+    names = [language.name for language in languages]
+    if len(set(names)) != len(names):
+        raise ValueError("Language names must be unique to index a distance matrix.")
+
+    distances = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                          shape=(condensed_size(len(languages)),))
+    scan_all_pairs(languages, num_workers=num_workers, chunk_size=chunk_size, progress=progress, out=distances,
+                   cache_bytes=cache_bytes)
+    distances.flush()
+    del distances
+
+    with open(__names_path(path), 'w') as file:
+        json.dump(names, file)
+    return load_distance_matrix(path)
+
+
+def extend_distance_matrix(distance_matrix: 'DistanceMatrix', languages: list[Language],
+                           new_languages: list[Language], path: str = None, num_workers: int = None,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE, progress=None,
+                           cache_bytes: int = DEFAULT_CACHE_BYTES) -> 'DistanceMatrix':
+    """
+    Add languages at the end of a distance matrix, scoring only the pairs they are part of: k new languages
+    against n cost k * n + k * (k - 1) / 2 scores instead of a new scan of every pair.
+
+    Every new pair is scored as (earlier language, later language), like a scan of the languages followed by the new
+    ones would (see `scan_candidate_pairs`). The scores already in the matrix are copied to their positions in
+    the larger condensed matrix.
+
+    Parameters:
+    - `distance_matrix (DistanceMatrix)`: the matrix to extend
+    - `languages (list[Language])`: the languages of the matrix, in its order
+    - `new_languages (list[Language])`: the languages to add, their names must be new
+    - `path (str, optional)`: if given, the extended matrix is saved there like `generate_distance_matrix` does
+            (it may be the path the matrix was loaded from, it is replaced once the new one is complete)
+    - `num_workers, chunk_size, progress, cache_bytes`: see `scan_all_pairs`
+
+    Returns:
+    - `DistanceMatrix`: the extended matrix, opened read-only if it was saved
+    """
+    if [language.name for language in languages] != distance_matrix.names:
+        raise ValueError("The languages are not those of the distance matrix, in its order.")
+    names = distance_matrix.names + [language.name for language in new_languages]
+    if len(set(names)) != len(names):
+        raise ValueError("Language names must be unique to index a distance matrix.")
+    num_old, num_languages = len(languages), len(names)
+
+    # the pairs (i, j) with j new, sorted by i: row i pairs with max(i + 1, n) ... n + k - 1
+    rows = np.arange(num_languages)
+    starts = np.maximum(rows + 1, num_old)
+    row_lengths = np.maximum(num_languages - starts, 0)
+    row_offsets = np.concatenate(([0], np.cumsum(row_lengths)))
+    first = np.repeat(rows, row_lengths)
+    second = np.arange(len(first)) - np.repeat(row_offsets[:-1] - starts, row_lengths)
+    new_scores = scan_candidate_pairs(list(languages) + list(new_languages), first, second, num_workers=num_workers,
+                                      chunk_size=chunk_size, progress=progress, cache_bytes=cache_bytes)
+
+    if path is None:
+        distances = np.empty(condensed_size(num_languages))
+    else:
+        temporary_path = f"{os.path.splitext(path)[0]}.{os.getpid()}.tmp.npy"
+        distances = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.float64,
+                                              shape=(condensed_size(num_languages),))
+    # row i is the old row (i, i + 1) ... (i, n - 1) followed by the new pairs (i, n) ... (i, n + k - 1)
+    old_distances = distance_matrix.distances
+    for row in range(num_languages - 1):
+        start = condensed_index(row, row + 1, num_languages)
+        old_length = max(0, num_old - row - 1)
+        if old_length:
+            old_start = condensed_index(row, row + 1, num_old)
+            distances[start:start + old_length] = old_distances[old_start:old_start + old_length]
+        row_scores = new_scores[row_offsets[row]:row_offsets[row + 1]]
+        distances[start + old_length:start + old_length + len(row_scores)] = row_scores
+
+    if path is None:
+        return DistanceMatrix(names, distances)
+    distances.flush()
+    del distances
+    os.replace(temporary_path, path)
+    with open(__names_path(path), 'w') as file:
+        json.dump(names, file)
+    return load_distance_matrix(path)
+
+
+def save_distance_matrix(distance_matrix: 'DistanceMatrix', path: str = DISTANCE_MATRIX_PATH):
+    """
+    Save a distance matrix the way `generate_distance_matrix` does, for matrices that were computed in memory.
+    The file is replaced once complete, so matrices opened from it before keep their memory-mapped view.
+    """
+    temporary_path = f"{os.path.splitext(path)[0]}.{os.getpid()}.tmp.npy"
+    np.save(temporary_path, np.asarray(distance_matrix.distances, dtype=np.float64))
+    os.replace(temporary_path, path)
+    with open(__names_path(path), 'w') as file:
+        json.dump(distance_matrix.names, file)
+
+
+def distance_matrix_files(path: str = DISTANCE_MATRIX_PATH) -> list[str]:
+    """The files a saved distance matrix consists of: the scores and the language names."""
+    return [path, __names_path(path)]
+
+
+def load_distance_matrix(path: str = DISTANCE_MATRIX_PATH) -> 'DistanceMatrix':
+    """
+    Open a distance matrix saved by `generate_distance_matrix`. The scores are memory-mapped, not read.
+    """
+    with open(__names_path(path), 'r') as file:
+        names = json.load(file)
+    distances = np.load(path, mmap_mode='r')
+    if len(distances) != condensed_size(len(names)):
+        raise ValueError(f"{path} holds {len(distances)} scores, but its name index has {len(names)} languages.")
+    return DistanceMatrix(names, distances)
+
+
+class DistanceMatrix:
+    """
+    This class holds the condensed matrix of the distances between every pair of languages, indexed by name.
+
+    State:
+    - `names (list[str])`: name of every language, in the order of the matrix
+    - `distances (np.ndarray)`: condensed (possibly memory-mapped) distances, see `condensed_index`
+
+    Constructor:
+    - `names: list[str]`
+    - `distances: np.ndarray`
+
+    Example:
+    ```py
+    distance_matrix = load_distance_matrix()
+    print(distance_matrix.distance('ENGLISH', 'SWEDISH'))
+    related = distance_matrix.related_pairs(theta_dERC=0.65)  # [('ENGLISH', 'SWEDISH'), ...]
+    ```
+    """
+
+    def __init__(self, names: list[str], distances: np.ndarray) -> None:
+        self.names = list(names)
+        self.distances = distances
+        self.__positions = {name: position for position, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name: str) -> int:
+        return self.__positions[name]
+
+    def distance(self, name1: str, name2: str) -> float:
+        """Return the distance between two languages, scored as (earlier language, later language)."""
+        i, j = sorted((self.index(name1), self.index(name2)))
+        if i == j:
+            return 0.0
+        return float(self.distances[condensed_index(i, j, len(self))])
+
+    def distances_of(self, name_pairs: list[tuple[str, str]]) -> np.ndarray:
+        """Look up the distances of many pairs of languages at once."""
+        if not name_pairs:
+            return np.zeros(0)
+        positions = np.array([[self.index(name1), self.index(name2)] for name1, name2 in name_pairs])
+        i, j = positions.min(axis=1), positions.max(axis=1)
+        different = i != j
+        distances = np.zeros(len(name_pairs))
+        distances[different] = self.distances[condensed_index(i[different], j[different], len(self))]
+        return distances
+
+    def pairs_within(self, theta_dERC: float) -> tuple[np.ndarray, np.ndarray]:
+        """Return the i and j of every pair with a distance below or equal to `theta_dERC`, in combinations order."""
+        return condensed_pairs(len(self), np.nonzero(self.distances <= theta_dERC)[0])
+
+    def related_pairs(self, theta_dERC: float) -> list[tuple[str, str]]:
+        """Return the names of every pair with a distance below or equal to `theta_dERC`, in combinations order."""
+        first, second = self.pairs_within(theta_dERC)
+        return [(self.names[i], self.names[j]) for i, j in zip(first.tolist(), second.tolist())]
+
+
+def __names_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '_names.json'
+
+
+def __init_worker(store, indices: np.ndarray, score_batch, cache_bytes: int):
+    global __worker_store, __worker_indices, __worker_score_batch, __worker_cache
+    __worker_store = store
+    __worker_indices = indices
+    __worker_score_batch = score_batch
+    __worker_cache = LDNCache(store, max_bytes=cache_bytes) if cache_bytes else None
+
+
+def __score_block(block: tuple[int, int]) -> tuple[list[tuple[int, np.ndarray]], Counter]:
+    """
+    Score the rows of one block against every later language.
+
+    Returns:
+    - `tuple[list[tuple[int, np.ndarray]], Counter]`: (i, scores of (i, i + 1) ... (i, n - 1)) for every row
+            of the block, and the statistics counted while scoring it
+    """
+    return __score_rows([(row, slice(row + 1, None)) for row in range(*block)])
+
+
+def __score_rows(rows: list[tuple[int, object]]) -> tuple[list[tuple[int, np.ndarray]], Counter]:
+    """
+    Score every row against its columns: the languages of a slice, or of an array of positions.
+
+    Returns:
+    - `tuple[list[tuple[int, np.ndarray]], Counter]`: (i, scores) of every row, and the statistics counted while
+            scoring them
+    """
+    __worker_statistics.clear()
+    languages = [__worker_store[index] for index in __worker_indices.tolist()]
+    keywords = {} if __worker_cache is None else {'cache': __worker_cache}
+    cache_before = Counter(__worker_cache.counters()) if __worker_cache is not None else Counter()
+    scored_rows = []
+    for row, columns in rows:
+        if isinstance(columns, slice):
+            others = languages[columns]
+        else:
+            others = [languages[column] for column in columns.tolist()]
+        scored_rows.append((row, np.asarray(__worker_score_batch(languages[row], others, **keywords))))
+    block_statistics = Counter(__worker_statistics)
+    if __worker_cache is not None:
+        block_statistics.update(Counter(__worker_cache.counters()) - cache_before)
+    return scored_rows, block_statistics
+
+
+def __within_threshold(L1: Language, languages: list[Language], theta_dERC: float, num_blocks: int,
+                       cache: LDNCache = None) -> np.ndarray:
+    return calculate_dERC_LDN_within(L1, languages, theta_dERC, num_blocks=num_blocks,
+                                     statistics=__worker_statistics, cache=cache)
+
+
+def __write_block(distances: np.ndarray, rows: list[tuple[int, np.ndarray]], num_languages: int) -> int:
+    """Copy the rows of a scored block into the condensed matrix and return the number of pairs written."""
+    written = 0
+    for row, scores in rows:
+        start = condensed_index(row, row + 1, num_languages)
+        distances[start:start + len(scores)] = scores
+        written += len(scores)
+    return written
+
+
+def __write_rows(scores: np.ndarray, rows: list[tuple[int, np.ndarray]], offsets: dict[int, int]) -> int:
+    """Copy scored rows of candidate pairs to where their pairs start and return the number of pairs written."""
+    written = 0
+    for row, row_scores in rows:
+        scores[offsets[row]:offsets[row] + len(row_scores)] = row_scores
+        written += len(row_scores)
+    return written
+
+
+def __print_progress(pairs_done: int, total_pairs: int):
+    instrumentation.log('distance scan progress',
+                        f"scored {pairs_done} / {total_pairs} pairs ({100 * pairs_done / total_pairs:.1f}%)",
+                        pairs_done=pairs_done, total_pairs=total_pairs)
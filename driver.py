@@ -1,19 +1,30 @@
-from dictionaryhandler import get_split_sets
-from probably_related_generator import get_related_languages
-from potential_cognates_generator import generate_potential_cognates
+from dictionaryhandler import cull_languages, get_split_sets
+from potential_cognates_generator import generate_weighted_cognates
 from language import Language
+from ldn_cache import LDNCache
 import align
-import pmi_matrix_generator
-from dERC_PMIcalculator import calculate_dERC_PMI
-from dERC_LDNcalculator import calculate_dERC_LDN
+import instrumentation
+from cognate_corpus import CognateCorpus
+from corpus_file import TEST_SET_PATH, TRAINING_SET_PATH, load_corpus, save_corpus
+from distance_matrix_generator import DistanceMatrix, distance_matrix_files, load_distance_matrix, \
+    extend_distance_matrix, save_distance_matrix, scan_all_pairs
+from needleman_wunsch import align_batch, encode_pairs
+from objective_cache import ObjectiveCache, cached_reestimate_pmi_matrix
+from objective_evaluator import evaluate_objective, open_objective_pool
+from pipeline import PIPELINE_DIR, ArtifactFormat, Pipeline, Stage
+from pmi_matrix import PMIMatrix
+from pmi_matrix_generator import count_aligned_characters, open_realignment_pool
+from tree_builder import Tree, neighbor_joining, upgma
+from wordstore import CHARS, store_languages
 
 
-import math
 import random
 import multiprocessing
 import json
-from collections import Counter, defaultdict
+from collections import defaultdict
+from functools import partial
 
+import numpy as np
 from scipy.optimize import minimize
 
 
@@ -57,26 +68,19 @@ def simple_dERC_LDN_test():
     print(calculate_dERC_LDN(L1, L2))
 
 
-def save_sets(training_set, test_set):
-    # Convert the sets to a JSON-serializable format
-    serialized_training_set = {
-        key: [language_obj.__dict__ for language_obj in value]
-        for key, value in training_set.items()
-    }
-    serialized_test_set = {
-        key: [language_obj.__dict__ for language_obj in value]
-        for key, value in test_set.items()
-    }
+def save_sets(training_set, test_set, training_path: str = TRAINING_SET_PATH, test_path: str = TEST_SET_PATH):
+    # Save the sets as corpus files (see corpus_file.save_corpus)
+    save_corpus(training_set, training_path)
+    save_corpus(test_set, test_path)
 
-    # Save the data to files using JSON
-    with open("./materials/training_set.json", 'w') as file:
-        json.dump(serialized_training_set, file)
-    with open("./materials/test_set.json", 'w') as file:
-        json.dump(serialized_test_set, file)
 
+def load_sets(training_path: str = TRAINING_SET_PATH, test_path: str = TEST_SET_PATH):
+    # the words stay in the memory-mapped stores of the corpus files, the Language objects are views into them
+    return load_corpus(training_path), load_corpus(test_path)
 
-def load_sets():
-    # Load the data from files using JSON
+
+def load_json_sets():
+    # Load the data from the JSON files the sets used to be saved as
     with open("./materials/training_set.json", 'r') as file:
         serialized_training_set = json.load(file)
     with open("./materials/test_set.json", 'r') as file:
@@ -94,8 +98,28 @@ def load_sets():
     return training_set, test_set
 
 
+def __sets_test_path(path: str) -> str:
+    return path[:-len('.corpus')] + '_test.corpus'
+
+
+# the sets artifact of the pipeline: two corpus files, the training set's and the test set's
+SETS_FORMAT = ArtifactFormat('.corpus',
+                             lambda sets, path: save_sets(*sets, path, __sets_test_path(path)),
+                             lambda path: load_sets(path, __sets_test_path(path)),
+                             lambda path: [path, __sets_test_path(path)])
+
+
+INITIAL_GUESSES = [
+    [-2.5, -1.7, 4.4],
+    [-2.0, -1.0, 7.0],
+    [-1.0, -0.5, 5.5],
+    [-2.5, -1.8, 3.0],
+    [-3.0, -2.0, 10.0],
+]
+
+
 # NOTE:
-def objective_function(x):
+def objective_function(x, objective_pool, objective_cache):
     open_gap_score = x[0]
     extend_gap_score = x[1]
     theta_pmi = x[2]
@@ -104,178 +128,280 @@ def objective_function(x):
     if open_gap_score > 0 or extend_gap_score > 0:
         return 1
 
-    # training_set, test_set are defined
-    # potential_cognates is defined
-    # probably_related is defined
-    # default_pmi_matrix is defined
-
-    # build PMI matrix (training_set, cognates, theta_pmi, open_gap_score, extend_gap_score)
-    pmi_matrix = pmi_matrix_generator.reestimate_pmi_matrix(
-        potential_cognates,
-        open_gap_score, extend_gap_score, theta_pmi,
-        char_counts, num_characters,
-        default_pmi_matrix.copy(), 11)  # 11 since the first is not re-estimating using probable cognates, its generating probable cognates for the first time.
-
-    # score the 1,000 random pairs with PMI
-    total_score = 0
-    for related_pair in random_probably_related_language_pairs:
-        total_score += calculate_dERC_PMI(
-            related_pair[0], related_pair[1], pmi_matrix, open_gap_score, extend_gap_score)
-
-    # average and return the scores (need to define dERC/PMI for languages first)
-    mean_score = total_score / 1000
-    print(f"mean dERC/PMI of the words: {mean_score}")
+    # objective_pool holds potential_cognates, default_pmi_matrix, char_counts, num_characters
+    #   and the 1,000 random probably related pairs in its workers
+    # objective_cache holds the points evaluated before (also by an earlier run)
+
+    # build PMI matrix (cognates, theta_pmi, open_gap_score, extend_gap_score) with 11 re-estimations
+    #   (the first is not re-estimating using probable cognates, its generating probable cognates for the first time),
+    #   then average the dERC/PMI of the 1,000 random pairs, spread over the workers
+    mean_score = float(evaluate_objective(
+        objective_pool, [(open_gap_score, extend_gap_score, theta_pmi)], cache=objective_cache)[0])
+    instrumentation.log('objective evaluated', f"mean dERC/PMI of the words: {mean_score}",
+                        point=[open_gap_score, extend_gap_score, theta_pmi], value=mean_score)
     return mean_score
 
 
-if __name__ == '__main__':
-    multiprocessing.freeze_support()
-
-    # reset cached sets
+def build_pipeline(theta_dERC: float = 0.65, sample_size: int = 1000, sample_seed: int = 0,
+                   num_iterations: int = 11, initial_guesses=INITIAL_GUESSES, directory: str = PIPELINE_DIR,
+                   training_path: str = TRAINING_SET_PATH, test_path: str = TEST_SET_PATH) -> Pipeline:
     """
-    training_set, test_set = get_split_sets()
-    save_sets(training_set, test_set)
-    # """
-
-    # load cached training_set, test_set
-    training_set, test_set = load_sets()
+    The stages of the whole experiment, from the split sets to the final PMI matrix (see `pipeline.Pipeline`).
+
+    Stages:
+    - `sets`: the training and test sets, read from `materials/*_set.corpus` (re-split with
+            `save_sets(*get_split_sets())`)
+    - `distance_matrix`: the dERC/LDN of every pair of training languages
+    - `potential_cognates`: the weighted potential cognates of the probably related pairs
+    - `default_pmi_matrix`: the PMI matrix of the Levenshtein alignments of the potential cognates, with the character counts
+    - `objective_sample`: the random probably related pairs the objective averages over
+    - `optimization`: the gap scores and theta_pmi found by Nelder-Mead
+    - `final_pmi_matrix`: the PMI matrix re-estimated with the optimal parameters
+    - `nj_tree`, `upgma_tree`: the neighbor-joining and UPGMA trees of the training languages, as Newick
+
+    The artifacts are kept in `directory`, and the `sets` stage reads the corpus files at `training_path` and
+    `test_path`.
 
-    # reset probably_related_languages
+    Returns:
+    - `Pipeline`: the pipeline, run it with `pipeline.run()` and read artifacts with `pipeline[name]`
     """
-    probably_related_languages = get_related_languages(
-        training_set, test_set, theta_dERC=0.65)
-
-    # Convert the list of tuples of Language objects to a JSON-serializable format
-    serialized_data = [((language1.__dict__, language2.__dict__), )
-                       for language1, language2 in probably_related_languages]
-    # Save the data to a file using JSON
-    with open("./materials/probably_related.json", 'w') as file:
-        json.dump(serialized_data, file)
-    # """
-
-    # load cached probably_related_languages
-    with open("./materials/probably_related.json", 'r') as file:
-        serialized_data = json.load(file)
-    # Convert the JSON data back to tuples of Language objects
-    probably_related_languages = [(Language(**language1_dict), Language(**language2_dict))
-                                  for ((language1_dict, language2_dict), ) in serialized_data]
-
-    # reset potential_cognates
+    pipeline = Pipeline(directory)
+    pipeline.add_stage(Stage('sets', partial(load_sets, training_path, test_path),
+                             files=[training_path, test_path], artifact_format=SETS_FORMAT))
+    pipeline.add_stage(Stage('distance_matrix', distance_matrix_stage, inputs=['sets'],
+                             artifact_format=ArtifactFormat('.npy', save_distance_matrix, load_distance_matrix,
+                                                            distance_matrix_files)))
+    pipeline.add_stage(Stage('potential_cognates', potential_cognates_stage, inputs=['sets', 'distance_matrix'],
+                             params={'theta_dERC': theta_dERC},
+                             artifact_format=ArtifactFormat('.npz', CognateCorpus.save, CognateCorpus.load)))
+    pipeline.add_stage(Stage('default_pmi_matrix', default_pmi_matrix_stage, inputs=['sets', 'potential_cognates'],
+                             version='2'))
+    pipeline.add_stage(Stage('objective_sample', objective_sample_stage, inputs=['distance_matrix'],
+                             params={'theta_dERC': theta_dERC, 'sample_size': sample_size, 'seed': sample_seed}))
+    pipeline.add_stage(Stage('optimization', optimization_stage,
+                             inputs=['sets', 'potential_cognates', 'default_pmi_matrix', 'objective_sample'],
+                             params={'initial_guesses': initial_guesses, 'num_iterations': num_iterations}))
+    pipeline.add_stage(Stage('final_pmi_matrix', final_pmi_matrix_stage,
+                             inputs=['potential_cognates', 'default_pmi_matrix', 'optimization'],
+                             params={'num_iterations': num_iterations},
+                             artifact_format=ArtifactFormat('.npy', PMIMatrix.save, PMIMatrix.load)))
+    pipeline.add_stage(Stage('nj_tree', neighbor_joining, inputs=['distance_matrix'],
+                             artifact_format=ArtifactFormat('.nwk', Tree.save, Tree.load)))
+    pipeline.add_stage(Stage('upgma_tree', upgma, inputs=['distance_matrix'],
+                             artifact_format=ArtifactFormat('.nwk', Tree.save, Tree.load)))
+    return pipeline
+
+
+def distance_matrix_stage(sets) -> DistanceMatrix:
+    # every pair of training languages, scored once; changing theta_dERC is just another slice of it
+    training_set, _ = sets
+    languages = [language for family in training_set.values() for language in family]
+    return DistanceMatrix([language.name for language in languages], scan_all_pairs(languages))
+
+
+def potential_cognates_stage(sets, distance_matrix: DistanceMatrix, theta_dERC: float) -> CognateCorpus:
+    # the related pairs are views into the training set's store
+    training_languages = __training_languages(sets)
+    probably_related_languages = [(training_languages[name1], training_languages[name2])
+                                  for name1, name2 in distance_matrix.related_pairs(theta_dERC=theta_dERC)]
+    # every distinct pair once, with its count; the pairs are views into one store, so the cache measures a word
+    #   pair that many language pairs share once
+    training_store, _ = store_languages(list(training_languages.values()))
+    return generate_weighted_cognates(probably_related_languages, cache=LDNCache(training_store))
+
+
+def default_pmi_matrix_stage(sets, potential_cognates: CognateCorpus) -> dict:
     """
-    potential_cognates = generate_potential_cognates(
-        probably_related_languages)
-    with open("./materials/potential_cognates.json", 'w') as file:
-        json.dump(potential_cognates, file)
-    # """
-
-    # load potential_cognates
-    with open("./materials/potential_cognates.json", 'r') as file:
-        potential_cognates = json.load(file)
+    Returns:
+    - `dict`: `default_pmi_matrix`, and the `char_counts` and `num_characters` of the training set
+    """
+    training_set, _ = sets
 
     # count: number of characters in training_list
     # count: p, b, f, v, m, w, 8, 4, t, d, s, z, c, n, r, l, S, Z, C, j, T, 5, y, k, g, x, N, q, G, X, h, 7, L, !, i, e, E, 3, a, u, o
-    chars = ['p', 'b', 'f', 'v', 'm', 'w', '8', '4', 't', 'd', 's', 'z', 'c', 'n', 'r', 'l', 'S', 'Z', 'C', 'j',
-             'T', '5', 'y', 'k', 'g', 'x', 'N', 'q', 'G', 'X', 'h', '7', 'L', '!', 'i', 'e', 'E', '3', 'a', 'u', 'o']
-    num_characters = 0
-    char_counts = {char: 0 for char in chars}
-    for family in training_set.values():
-        for lang in family:
-            for concept in lang.word_list:
-                for word in concept:
-                    if word != 'XXX':
-                        num_characters += len(word)
-                        for char in word:
-                            if char not in chars:
-                                print(word)
-                                continue
-                            char_counts[char] += 1
+    chars = CHARS
+    training_store, _ = store_languages(
+        [language for family in training_set.values() for language in family])
+    num_characters = len(training_store.symbols)
+    char_counts = dict(zip(chars, np.bincount(
+        training_store.symbols, minlength=len(chars)).tolist()))
     # now we have num_characters and char_counts
 
-    # align using levenshtein (default needleman-wunsch)
-    aligned_cognates = [align.levenshtein_align(
-        potential_pair) for potential_pair in potential_cognates]
-
-    # count: number of alignments total in aligned_cognates
-    # count: each type of non-gap alignment in aligned_cognates
-    num_alignments = 0
-    valid_alignments_count = Counter()
-    for aligned1, aligned2 in aligned_cognates:
-        for char1, char2 in zip(aligned1, aligned2):
-
-            # get valid alignments
-            if char1 == '-' or char2 == '-':
-                continue
-
-            # just valid alignments
-            num_alignments += 1
-
-            # make sure they are in sorted order
-            sorted_c1, sorted_c2 = tuple(sorted([char1, char2]))
-
-            # Update the count in the dictionary
-            valid_alignments_count[(sorted_c1, sorted_c2)] += 1
-
-    # now we have num_valid_alignments and valid_alignments_count
-    default_pmi_matrix = {}
-    for char1 in chars:
-        for char2 in chars:
-            sorted_c1, sorted_c2 = tuple(sorted([char1, char2]))
-            if default_pmi_matrix.get((sorted_c1, sorted_c2)):
-                continue
-            s_ab = (valid_alignments_count[(
-                sorted_c1, sorted_c2)] / num_alignments)
-            q_a, q_b = (
-                (char_counts[char1] / num_characters),
-                (char_counts[char2] / num_characters)
-            )
-            if s_ab == 0:  # frequency of alignments is 0 (never aligned)
-                #               common for characters like '!', 'X', etc.
-                # basically, just assume one does happen
-                s_ab = 1
-                q_a += 1
-                q_b += 1
-
-            default_pmi_matrix[(sorted_c1, sorted_c2)] = \
-                math.log(s_ab / (q_a * q_b))
-
-    # pick my 1,000 matrices
-    random_probably_related_language_pairs = random.sample(
-        probably_related_languages, 1000)
-
-    # get LDN score
-    total_score = 0
-    for related_pair in random_probably_related_language_pairs:
-        total_score += calculate_dERC_LDN(related_pair[0], related_pair[1])
-    print(total_score / 1000)
-
-    # now actually optimize it.
-    # initial guesses
-    initial_guesses = [
-        [-2.5, -1.7, 4.4],
-        [-2.0, -1.0, 7.0],
-        [-1.0, -0.5, 5.5],
-        [-2.5, -1.8, 3.0],
-        [-3.0, -2.0, 10.0],
-    ]
-
-    result = minimize(objective_function,
-                      initial_guesses[0],
-                      method='Nelder-Mead',
-                      options={'initial_simplex': initial_guesses[1:]}
-                      )
+    # align using levenshtein (default needleman-wunsch), every distinct pair once
+    codes1, lengths1, codes2, lengths2 = encode_pairs(potential_cognates.pairs)
+    _, aligned1, aligned2, _, found = align_batch(codes1, lengths1, codes2, lengths2, align.LEVENSHTEIN_SCORES, -1, -1)
+
+    # count: each type of non-gap alignment in the aligned cognates, as often as the pair is a potential cognate
+    # count: number of alignments total in the aligned cognates
+    valid_alignments_count, num_alignments = count_aligned_characters(aligned1, aligned2,
+                                                                      potential_cognates.counts * found)
+
+    # pairs that are never aligned (common for characters like '!', 'X', etc.) are smoothed:
+    #   basically, just assume one does happen
+    default_pmi_matrix = PMIMatrix.from_counts(valid_alignments_count, char_counts, num_characters,
+                                               unaligned='smoothed', num_alignments=num_alignments)
+
+    return {'default_pmi_matrix': default_pmi_matrix, 'char_counts': char_counts, 'num_characters': num_characters}
+
+
+def objective_sample_stage(distance_matrix: DistanceMatrix, theta_dERC: float, sample_size: int,
+                           seed: int) -> list[tuple[str, str]]:
+    # pick my 1,000 matrices (seeded, so a resumed optimization averages over the same pairs)
+    random_probably_related_language_pairs = random.Random(seed).sample(
+        distance_matrix.related_pairs(theta_dERC=theta_dERC), sample_size)
+
+    # get LDN score (read from the distance matrix)
+    total_score = distance_matrix.distances_of(random_probably_related_language_pairs).sum()
+    instrumentation.log('objective sample', str(total_score / sample_size), mean_LDN=total_score / sample_size)
+    return random_probably_related_language_pairs
+
+
+def optimization_stage(sets, potential_cognates: CognateCorpus, default_pmi: dict,
+                       objective_sample: list[tuple[str, str]], initial_guesses, num_iterations: int) -> dict:
+    """
+    Returns:
+    - `dict`: the optimized parameters `x` and the objective value `fun`
+    """
+    training_languages = __training_languages(sets)
+    random_probably_related_language_pairs = [(training_languages[name1], training_languages[name2])
+                                              for name1, name2 in objective_sample]
+
+    # workers that keep the cognates and the 1,000 pairs loaded for every objective evaluation
+    objective_cache = ObjectiveCache()
+    with open_objective_pool(potential_cognates, random_probably_related_language_pairs,
+                             default_pmi['char_counts'], default_pmi['num_characters'],
+                             default_pmi['default_pmi_matrix'], num_iterations=num_iterations) as objective_pool:
+        # now actually optimize it.
+        result = minimize(objective_function,
+                          initial_guesses[0],
+                          args=(objective_pool, objective_cache),
+                          method='Nelder-Mead',
+                          options={'initial_simplex': initial_guesses[1:]}
+                          )
 
     # Print the optimized parameters and the corresponding objective function value
-    optimal_params = result.x
-    optimal_value = result.fun
+    print("Optimized Parameters: ", result.x)
+    print("Objective Function Value: ", result.fun)
+    return {'x': [float(value) for value in result.x], 'fun': float(result.fun)}
 
-    print("Optimized Parameters: ", optimal_params)
-    print("Objective Function Value: ", optimal_value)
 
+def final_pmi_matrix_stage(potential_cognates: CognateCorpus, default_pmi: dict, optimization: dict,
+                           num_iterations: int) -> PMIMatrix:
     # get it using values generated previously
-    pmi_matrix = pmi_matrix_generator.reestimate_pmi_matrix(potential_cognates,
-                                                            optimal_params[0],
-                                                            optimal_params[1],
-                                                            optimal_params[2],
-                                                            char_counts, num_characters,
-                                                            default_pmi_matrix, 11)
-    print(pmi_matrix)
+    optimal_params = optimization['x']
+    # the potential cognates are realigned on every core
+    with open_realignment_pool(potential_cognates) as realignment_pool:
+        return cached_reestimate_pmi_matrix(ObjectiveCache(), potential_cognates,
+                                            optimal_params[0],
+                                            optimal_params[1],
+                                            optimal_params[2],
+                                            default_pmi['char_counts'], default_pmi['num_characters'],
+                                            PMIMatrix.of(default_pmi['default_pmi_matrix']).copy(), num_iterations,
+                                            realignment_pool=realignment_pool)
+
+
+def add_languages(pipeline: Pipeline, new_set: dict[str, list[Language]], num_workers: int = None,
+                  progress=None, rejected: list[tuple[str, str, str]] = None) -> list[tuple[str, str]]:
+    """
+    Add languages to the training set of a pipeline built by `build_pipeline`, scoring only the pairs they are part
+    of instead of running the distance matrix and potential cognates stages again on the whole corpus.
+
+    The languages `dictionaryhandler.cull_languages` would have removed from the corpus (proto- and old languages,
+    the 'Oth' family, too many missing concepts, symbols that are not ASCIIPMA) are left out before anything is
+    scored, so they never reach the training set.
+
+    The new languages are scored against every training language (see `extend_distance_matrix`) and come last in
+    the distance matrix, which is indexed by name. Only their related pairs are collected, and their potential
+    cognates are merged into the corpus (counts add up, so it is the corpus the stage would produce). The training
+    set file, the distance matrix and the potential cognates are stored as the current artifacts of their stages,
+    so the stages after them (PMI matrices, trees) see the new corpus on the next `pipeline.run()`.
+
+    Every file is replaced, not rewritten in place: sets and matrices obtained before the call (from the pipeline,
+    or by another process such as `query_server --pipeline`) keep reading the old files. They are the old
+    artifacts, though: re-fetch `pipeline['sets']` and `pipeline['distance_matrix']` after the call.
+
+    Parameters:
+    - `pipeline (Pipeline)`: the pipeline, see `build_pipeline`
+    - `new_set (dict[str, list[Language]])`: the new languages by family, families may be new or existing ones
+    - `num_workers (int, optional)`, `progress (optional)`: see `scan_candidate_pairs`
+    - `rejected (list[tuple[str, str, str]], optional)`: filled with the family, name and reason of every language
+            left out (see `dictionaryhandler.cull_languages`)
+
+    Returns:
+    - `list[tuple[str, str]]`: the names of the new probably related pairs, (existing or new, new)
+    """
+    culled = []
+    new_set = cull_languages({family: list(family_languages) for family, family_languages in new_set.items()},
+                             culled)
+    if culled:
+        instrumentation.log('languages rejected', f"left out {len(culled)} languages that cannot be used",
+                            languages=[name for _, name, _ in culled])
+    if rejected is not None:
+        rejected.extend(culled)
+    if not new_set:
+        return []
+
+    training_set, test_set = pipeline['sets']
+    distance_matrix = pipeline['distance_matrix']
+    potential_cognates = pipeline['potential_cognates']
+    theta_dERC = pipeline.stages['potential_cognates'].params['theta_dERC']
+
+    training_languages = __training_languages((training_set, test_set))
+    languages = [training_languages[name] for name in distance_matrix.names]
+    new_languages = [language for family in new_set.values() for language in family]
+
+    # score the new rows only, and collect the related pairs among them
+    distance_matrix = extend_distance_matrix(distance_matrix, languages, new_languages, num_workers=num_workers,
+                                             progress=progress)
+    all_languages = languages + new_languages
+    first, second = distance_matrix.pairs_within(theta_dERC)
+    new_pairs = second >= len(languages)
+    related_languages = [(all_languages[i], all_languages[j])
+                         for i, j in zip(first[new_pairs].tolist(), second[new_pairs].tolist())]
+    potential_cognates = potential_cognates.merged(generate_weighted_cognates(related_languages))
+
+    # the sets stage reads the corpus files, they are rewritten first so its key is that of the new sets
+    training_set = {family: list(family_languages) for family, family_languages in training_set.items()}
+    for family, family_languages in new_set.items():
+        training_set.setdefault(family, []).extend(family_languages)
+    save_sets(training_set, test_set, *pipeline.stages['sets'].files)
+    pipeline.store('sets', load_sets(*pipeline.stages['sets'].files))
+    pipeline.store('distance_matrix', distance_matrix)
+    pipeline.store('potential_cognates', potential_cognates)
+    instrumentation.log('languages added', f"added {len(new_languages)} languages, "
+                        f"{len(related_languages)} new probably related pairs",
+                        languages=len(new_languages), related_pairs=len(related_languages))
+    return [(language1.name, language2.name) for language1, language2 in related_languages]
+
+
+def __training_languages(sets) -> dict[str, Language]:
+    training_set, _ = sets
+    return {language.name: language for family in training_set.values() for language in family}
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    # reset cached sets (the stages after them run again, since their input changed)
+    """
+    training_set, test_set = get_split_sets()
+    save_sets(training_set, test_set)
+    # """
+
+    # convert the sets saved as JSON by earlier versions
+    """
+    save_sets(*load_json_sets())
+    # """
+
+    # time the stages, count alignments, edit distances and cache hits, log every event as JSON and dump a
+    #   profile of every 25th call of each stage (off by default, it is almost free when off)
+    """
+    instrumentation.enable(log_path="./materials/instrumentation/run.jsonl", profile_every=25)
+    # """
+
+    # every stage whose inputs did not change is skipped, its artifact is only read when needed
+    pipeline = build_pipeline(theta_dERC=0.65)
+    pipeline.run()
+    print(pipeline['final_pmi_matrix'].as_dict())
+    if instrumentation.enabled:
+        instrumentation.print_report()
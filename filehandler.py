@@ -29,3 +29,16 @@ def get_text(filename: str):
         raise Exception("Error occurred while reading the file:", e)
 
     return text
+
+
+# Argument: filename of .txt file in script directory
+# Returns: the file opened for reading, to be read line by line
+def open_text(filename: str):
+    # build fully qualified file path
+    file_path = __find_file_in_directory(filename)
+
+    # Check if the filepath exists
+    if not Path(file_path).exists():
+        raise FileNotFoundError("filepath does not exist.")
+
+    return open(file_path, 'r')
@@ -0,0 +1,152 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+INSTRUMENTATION_DIR = "./materials/instrumentation"
+
+# read by the hot paths before they count anything, so that a disabled run only pays for this check
+enabled = False
+
+__counters = Counter()
+__timers = defaultdict(lambda: [0, 0.0])
+__sink = None
+__profile_every = 0
+__profile_dir = INSTRUMENTATION_DIR
+__profiling = False
+# nothing to enter or exit when disabled
+__NO_STAGE = nullcontext()
+
+
+def enable(log_path: str = None, profile_every: int = 0, profile_dir: str = INSTRUMENTATION_DIR):
+    """
+    Start timing stages, counting events and logging them.
+
+    Parameters:
+    - `log_path (str, optional)`: file the log events are appended to as JSON lines. Without it they go to stderr.
+    - `profile_every (int, optional)`: run every n-th call of each stage under cProfile and dump the profile to
+            `profile_dir/<stage>-<call>.prof` (read it with `pstats`). 0 never profiles.
+    - `profile_dir (str, optional)`: where the profiles are dumped
+    """
+    global enabled, __sink, __profile_every, __profile_dir
+    disable()
+    if log_path is not None:
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+        __sink = open(log_path, 'a')
+    else:
+        __sink = sys.stderr
+    __profile_every = profile_every
+    __profile_dir = profile_dir
+    if profile_every:
+        os.makedirs(profile_dir, exist_ok=True)
+    enabled = True
+
+
+def disable():
+    """Stop instrumenting. The timers and counters are kept until `reset`."""
+    global enabled, __sink
+    enabled = False
+    if __sink is not None and __sink is not sys.stderr:
+        __sink.close()
+    __sink = None
+
+
+def reset():
+    __counters.clear()
+    __timers.clear()
+
+
+def count(name: str, amount: int = 1):
+    """Add to a counter. Hot loops should check `instrumentation.enabled` first instead of calling this."""
+    if enabled:
+        __counters[name] += amount
+
+
+def count_all(counts: dict, prefix: str = ''):
+    """Add every counter of `counts`, e.g. the statistics a worker process sent back."""
+    if enabled:
+        for name, amount in counts.items():
+            __counters[prefix + name] += amount
+
+
+def stage(name: str):
+    """
+    Context manager that times a stage (inclusive of the stages nested in it) and counts its calls.
+
+    Example:
+    ```py
+    with instrumentation.stage('reestimate_pmi_matrix'):
+        ...
+    ```
+    """
+    if not enabled:
+        return __NO_STAGE
+    return __timed_stage(name)
+
+
+def log(event: str, message: str = None, level: str = 'info', **fields):
+    """
+    Record an event of the run.
+
+    `info` events print their message, instrumented or not (they are the progress messages of the pipeline).
+    `debug` events are dropped unless instrumenting. When instrumenting, every event is also written to the log
+    sink as one JSON line with its time, level and fields.
+
+    Parameters:
+    - `event (str)`: name of the event, e.g. 'reestimation iteration'
+    - `message (str, optional)`: the line to print
+    - `level (str, optional)`: 'info' or 'debug'
+    - `**fields`: JSON-serializable details of the event
+    """
+    if level == 'info' and message is not None:
+        print(message)
+    if enabled:
+        __sink.write(json.dumps({'time': time.time(), 'event': event, 'level': level, 'message': message,
+                                 **fields}, default=str) + '\n')
+        __sink.flush()
+
+
+def report() -> dict:
+    """
+    Returns:
+    - `dict`: `timers` (calls and total seconds of every stage) and `counters`
+    """
+    return {
+        'timers': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in __timers.items()},
+        'counters': dict(__counters),
+    }
+
+
+def print_report():
+    current = report()
+    for name, timer in sorted(current['timers'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name}: {timer['seconds']:.3f} s in {timer['calls']} calls")
+    for name, value in sorted(current['counters'].items()):
+        print(f"{name}: {value}")
+
+
+@contextmanager
+def __timed_stage(name: str):
+    global __profiling
+    timer = __timers[name]
+    timer[0] += 1
+    profiler = None
+    # cProfile cannot nest, a stage inside a profiled one is only timed
+    if __profile_every and not __profiling and timer[0] % __profile_every == 0:
+        profiler = cProfile.Profile()
+        __profiling = True
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer[1] += time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            __profiling = False
+            file_name = ''.join(char if char.isalnum() else '_' for char in name)
+            profiler.dump_stats(os.path.join(__profile_dir, f"{file_name}-{timer[0]}.prof"))
@@ -0,0 +1,161 @@
+from collections import OrderedDict
+
+import numpy as np
+
+import instrumentation
+from levenshtein import get_edit_distance_matrix, get_paired_edit_distances
+from wordstore import NUM_SYMBOLS, WordStore
+
+
+DEFAULT_CACHE_BYTES = 128 * 1024 * 1024
+
+
+class LDNCache:
+    """
+    This class caches the edit distance between words of one WordStore, keyed on their interned word ids
+    (`WordStore.word_ids`), so words shared by many languages are only measured once per run.
+
+    Every cached word owns a row with its distance to every word of the store's vocabulary, filled in as
+    pairs are asked for (`UNKNOWN` where a pair was never measured). Rows are evicted least recently used
+    first once they take more than `max_bytes`.
+
+    Hits and misses count word pairs: a miss is a pair that had to be measured, a hit one that was not.
+
+    State:
+    - `store (WordStore)`: the store whose word ids are the keys
+    - `max_rows (int)`: number of rows that fit in `max_bytes`
+    - `hits (int)`: word pairs served from the cache
+    - `misses (int)`: word pairs that had to be measured
+    - `evictions (int)`: rows dropped to stay within the size bound
+
+    Constructor:
+    - `store: WordStore`
+    - `max_bytes: int`, optional
+
+    Example:
+    ```py
+    cache = LDNCache(store)
+    distances = calculate_dERC_LDN_batch(L1, languages, cache=cache)
+    print(cache.hits, cache.misses)
+    ```
+    """
+
+    def __init__(self, store: WordStore, max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.store = store
+        lengths = store.vocabulary_lengths
+        self.__dtype = np.uint8 if lengths.max(initial=0) < np.iinfo(np.uint8).max else np.uint16
+        self.UNKNOWN = np.iinfo(self.__dtype).max
+        row_bytes = max(1, len(lengths) * np.dtype(self.__dtype).itemsize)
+        self.max_rows = max(1, max_bytes // row_bytes)
+        self.__rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def counters(self) -> dict[str, int]:
+        return {'cache hits': self.hits, 'cache misses': self.misses, 'cache evictions': self.evictions}
+
+    def edit_distance_matrix(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray:
+        """
+        Return the edit distance between every word of `ids1` and every word of `ids2` (vocabulary ids),
+        measuring only the pairs that are not cached yet.
+
+        Returns:
+        - np.ndarray: (len(ids1) x len(ids2)) integer matrix, as `levenshtein.get_edit_distance_matrix`
+        """
+        ids1 = np.asarray(ids1, dtype=np.int64)
+        ids2 = np.asarray(ids2, dtype=np.int64)
+        rows = [self.__row(word_id) for word_id in ids1.tolist()]
+        distances = np.stack(rows)[:, ids2] if rows else np.zeros((0, len(ids2)), dtype=self.__dtype)
+
+        unknown = distances == self.UNKNOWN
+        self.misses += int(np.count_nonzero(unknown))
+        self.hits += distances.size - int(np.count_nonzero(unknown))
+        if instrumentation.enabled:
+            instrumentation.count('LDN cache misses', int(np.count_nonzero(unknown)))
+            instrumentation.count('LDN cache hits', distances.size - int(np.count_nonzero(unknown)))
+        if unknown.any():
+            missing_rows = np.nonzero(unknown.any(axis=1))[0]
+            missing_cols = np.nonzero(unknown.any(axis=0))[0]
+            codes, lengths = self.store.vocabulary_codes, self.store.vocabulary_lengths
+            row_ids, col_ids = ids1[missing_rows], ids2[missing_cols]
+            measured = get_edit_distance_matrix(codes[row_ids], lengths[row_ids], codes[col_ids], lengths[col_ids],
+                                                alphabet_size=NUM_SYMBOLS)
+            distances[missing_rows[:, None], missing_cols[None, :]] = measured
+            for position in missing_rows.tolist():
+                rows[position][col_ids] = distances[position, missing_cols]
+
+        return distances.astype(np.int64)
+
+    def LDN_matrix(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray:
+        """`edit_distance_matrix` normalized like `levenshtein.get_encoded_LDN_matrix`."""
+        lengths = self.store.vocabulary_lengths
+        return self.edit_distance_matrix(ids1, ids2) / np.maximum(lengths[np.asarray(ids1, dtype=np.int64)][:, None],
+                                                                  lengths[np.asarray(ids2, dtype=np.int64)][None, :])
+
+    def paired_edit_distances(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray:
+        """
+        Return the edit distance between the i-th word of `ids1` and the i-th word of `ids2` (vocabulary ids),
+        for every i. A pair that is asked for more than once is measured once.
+
+        Pairs whose first word has a row are looked up there (and filled in if unknown). No rows are created:
+        a few pairs per word do not pay for a row of the whole vocabulary.
+
+        Returns:
+        - np.ndarray: integer distances, as `levenshtein.get_paired_edit_distances`
+        """
+        ids1 = np.asarray(ids1, dtype=np.int64)
+        ids2 = np.asarray(ids2, dtype=np.int64)
+        vocabulary_size = len(self.store.vocabulary_lengths)
+        pair_keys, inverse = np.unique(ids1 * vocabulary_size + ids2, return_inverse=True)
+        pair_ids1, pair_ids2 = np.divmod(pair_keys, vocabulary_size)
+        distances = np.full(len(pair_keys), self.UNKNOWN, dtype=np.int64)
+
+        # unique keys are sorted, so the pairs of every first word are contiguous
+        words, starts = np.unique(pair_ids1, return_index=True)
+        ends = np.append(starts[1:], len(pair_keys))
+        cached = []
+        for word_id, start, end in zip(words.tolist(), starts.tolist(), ends.tolist()):
+            if word_id in self.__rows:
+                self.__rows.move_to_end(word_id)
+                cached.append((self.__rows[word_id], slice(start, end)))
+        for row, pairs in cached:
+            distances[pairs] = row[pair_ids2[pairs]]
+
+        unknown = distances == self.UNKNOWN
+        self.misses += int(np.count_nonzero(unknown))
+        self.hits += len(ids1) - int(np.count_nonzero(unknown))
+        if instrumentation.enabled:
+            instrumentation.count('LDN cache misses', int(np.count_nonzero(unknown)))
+            instrumentation.count('LDN cache hits', len(ids1) - int(np.count_nonzero(unknown)))
+        if unknown.any():
+            codes, lengths = self.store.vocabulary_codes, self.store.vocabulary_lengths
+            id1, id2 = pair_ids1[unknown], pair_ids2[unknown]
+            distances[unknown] = get_paired_edit_distances(codes[id1], lengths[id1], codes[id2], lengths[id2],
+                                                           alphabet_size=NUM_SYMBOLS)
+            for row, pairs in cached:
+                row[pair_ids2[pairs]] = distances[pairs]
+
+        return distances[inverse.reshape(-1)]
+
+    def paired_LDN(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray:
+        """`paired_edit_distances` normalized like `levenshtein.get_LDN`."""
+        lengths = self.store.vocabulary_lengths
+        return self.paired_edit_distances(ids1, ids2) / np.maximum(lengths[np.asarray(ids1, dtype=np.int64)],
+                                                                   lengths[np.asarray(ids2, dtype=np.int64)])
+
+    def __row(self, word_id: int) -> np.ndarray:
+        """Return the row of a word, creating it (and evicting the least recently used row) if needed."""
+        row = self.__rows.get(word_id)
+        if row is not None:
+            self.__rows.move_to_end(word_id)
+            return row
+        while len(self.__rows) >= self.max_rows:
+            self.__rows.popitem(last=False)
+            self.evictions += 1
+        row = np.full(len(self.store.vocabulary_lengths), self.UNKNOWN, dtype=self.__dtype)
+        self.__rows[word_id] = row
+        return row
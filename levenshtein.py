@@ -1,4 +1,7 @@
 import Levenshtein
+import numpy as np
+
+import instrumentation
 
 
 def get_LDN(word1: str, word2: str) -> float:
@@ -29,6 +32,8 @@ def calculate_LDN(word_list1: list[str], word_list2: list[str], average=True) ->
     Returns:
     float: optimal/average LDN between the word lists
     """
+    if instrumentation.enabled:
+        instrumentation.count('edit distances', len(word_list1) * len(word_list2))
     LDN_values = [get_LDN(word1, word2)
                   for word1 in word_list1 for word2 in word_list2]
 
@@ -46,3 +51,190 @@ def get_closest_cognates(concept_from1: list[str], concept_from2: list[str]):
 
     __, min_word1, min_word2 = min(LDN_values, key=lambda x: x[0])
     return min_word1, min_word2
+
+
+def encode_words(words: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    This function packs a list of words into a padded matrix of symbol codes
+
+    Parameters:
+    - words (list[str]): words to encode
+
+    Returns:
+    tuple[np.ndarray, np.ndarray]: (number of words x longest word) uint8 code matrix, zero padded,
+        and the length of every word
+    """
+    lengths = np.fromiter((len(word) for word in words),
+                          dtype=np.int64, count=len(words))
+    codes = np.zeros((len(words), max(lengths, default=0)), dtype=np.uint8)
+    for row, word in enumerate(words):
+        codes[row, :len(word)] = np.frombuffer(word.encode('latin-1'), dtype=np.uint8)
+    return codes, lengths
+
+
+def __bit_parallel_distances(matches, pattern_lengths: np.ndarray, text_length: int, shape: tuple) -> np.ndarray:
+    """
+    Myers' bit-parallel edit distance (in Hyyrö's global form) for many pattern/text pairs at once.
+
+    Parameters:
+    - matches (callable): matches(position) returns the bitmask of the pattern positions that hold the
+        text symbol at `position`, for every pair
+    - pattern_lengths (np.ndarray): pattern length of every pair, broadcastable to `shape`
+    - text_length (int): length of every text (texts are processed in buckets of equal length)
+    - shape (tuple): shape of the batch of pairs
+
+    Returns:
+    np.ndarray: edit distance of every pair
+    """
+    one = np.uint64(1)
+    last_bit = one << (pattern_lengths.astype(np.uint64) - one)
+
+    positive_vertical = np.full(shape, ~np.uint64(0))
+    negative_vertical = np.zeros(shape, dtype=np.uint64)
+    score = np.broadcast_to(pattern_lengths, shape).copy()
+
+    for position in range(text_length):
+        eq = matches(position)
+        x_vertical = eq | negative_vertical
+        x_horizontal = (((eq & positive_vertical) + positive_vertical) ^ positive_vertical) | eq
+        positive_horizontal = negative_vertical | ~(x_horizontal | positive_vertical)
+        negative_horizontal = positive_vertical & x_horizontal
+
+        score += (positive_horizontal & last_bit) != 0
+        score -= (negative_horizontal & last_bit) != 0
+
+        positive_horizontal = (positive_horizontal << one) | one
+        negative_horizontal = negative_horizontal << one
+        positive_vertical = negative_horizontal | ~(x_vertical | positive_horizontal)
+        negative_vertical = positive_horizontal & x_vertical
+
+    return score
+
+
+def __pattern_masks(codes: np.ndarray, lengths: np.ndarray, alphabet_size: int) -> np.ndarray:
+    """Bitmask of the positions of every symbol in every word."""
+    masks = np.zeros((len(lengths), alphabet_size), dtype=np.uint64)
+    for position in range(min(codes.shape[1], 64)):
+        rows = np.nonzero(lengths > position)[0]
+        masks[rows, codes[rows, position]] |= np.uint64(1) << np.uint64(position)
+    return masks
+
+
+def get_edit_distance_matrix(codes1: np.ndarray, lengths1: np.ndarray,
+                             codes2: np.ndarray, lengths2: np.ndarray,
+                             alphabet_size=256) -> np.ndarray:
+    """
+    This function returns the Levenshtein distance between every word of the first batch and every
+    word of the second batch.
+
+    It runs Myers' bit-parallel algorithm on all pairs at once: each word of the first batch is a
+    bitmask pattern, and the second batch is processed in buckets of equal length so that no pair
+    does more steps than its own length.
+
+    Parameters:
+    - codes1 (np.ndarray): padded symbol codes of the first batch, as returned by `encode_words`
+    - lengths1 (np.ndarray): lengths of the words in the first batch
+    - codes2 (np.ndarray): padded symbol codes of the second batch
+    - lengths2 (np.ndarray): lengths of the words in the second batch
+    - alphabet_size (int): number of distinct symbol codes
+
+    Returns:
+    np.ndarray: (len(lengths1) x len(lengths2)) integer matrix of edit distances
+    """
+    lengths1 = np.asarray(lengths1, dtype=np.int64)
+    lengths2 = np.asarray(lengths2, dtype=np.int64)
+    distances = np.zeros((len(lengths1), len(lengths2)), dtype=np.int64)
+    if not len(lengths1) or not len(lengths2):
+        return distances
+    if instrumentation.enabled:
+        instrumentation.count('edit distances', distances.size)
+
+    # patterns that do not fit in a machine word are measured one pair at a time
+    for row in np.nonzero(lengths1 > 64)[0]:
+        word1 = codes1[row, :lengths1[row]].tolist()
+        distances[row] = [Levenshtein.distance(word1, codes2[col, :lengths2[col]].tolist())
+                          for col in range(len(lengths2))]
+    # an empty pattern has no last bit to follow, its distance is the length of the text
+    distances[lengths1 == 0] = lengths2
+    rows = np.nonzero((lengths1 > 0) & (lengths1 <= 64))[0]
+
+    pattern_masks = __pattern_masks(codes1[rows], lengths1[rows], alphabet_size)
+    for length in np.unique(lengths2):
+        cols = np.nonzero(lengths2 == length)[0]
+        text = codes2[cols]
+        distances[rows[:, None], cols[None, :]] = __bit_parallel_distances(
+            lambda position: pattern_masks[:, text[:, position]],
+            lengths1[rows, None], length, (len(rows), len(cols)))
+
+    return distances
+
+
+def get_paired_edit_distances(codes1: np.ndarray, lengths1: np.ndarray,
+                              codes2: np.ndarray, lengths2: np.ndarray,
+                              alphabet_size=256) -> np.ndarray:
+    """
+    This function returns the Levenshtein distance between the i-th word of the first batch and the
+    i-th word of the second batch, for every i.
+
+    Parameters:
+    - codes1 (np.ndarray): padded symbol codes of the first batch, as returned by `encode_words`
+    - lengths1 (np.ndarray): lengths of the words in the first batch
+    - codes2 (np.ndarray): padded symbol codes of the second batch
+    - lengths2 (np.ndarray): lengths of the words in the second batch
+    - alphabet_size (int): number of distinct symbol codes
+
+    Returns:
+    np.ndarray: integer edit distance of every pair
+    """
+    lengths1 = np.asarray(lengths1, dtype=np.int64)
+    lengths2 = np.asarray(lengths2, dtype=np.int64)
+    distances = np.zeros(len(lengths1), dtype=np.int64)
+    if instrumentation.enabled:
+        instrumentation.count('edit distances', len(distances))
+
+    for pair in np.nonzero(lengths1 > 64)[0]:
+        distances[pair] = Levenshtein.distance(codes1[pair, :lengths1[pair]].tolist(),
+                                               codes2[pair, :lengths2[pair]].tolist())
+    empty = lengths1 == 0
+    distances[empty] = lengths2[empty]
+    short = (lengths1 > 0) & (lengths1 <= 64)
+
+    for length in np.unique(lengths2[short]):
+        pairs = np.nonzero(short & (lengths2 == length))[0]
+        pattern_masks = __pattern_masks(codes1[pairs], lengths1[pairs], alphabet_size)
+        text = codes2[pairs]
+        rows = np.arange(len(pairs))
+        distances[pairs] = __bit_parallel_distances(
+            lambda position: pattern_masks[rows, text[:, position]],
+            lengths1[pairs], length, (len(pairs),))
+
+    return distances
+
+
+def get_encoded_LDN_matrix(codes1: np.ndarray, lengths1: np.ndarray,
+                           codes2: np.ndarray, lengths2: np.ndarray,
+                           alphabet_size=256) -> np.ndarray:
+    """
+    This function is `get_LDN_matrix` for words that are already encoded (see `encode_words`)
+
+    Returns:
+    np.ndarray: (len(lengths1) x len(lengths2)) matrix of LDN values
+    """
+    distances = get_edit_distance_matrix(codes1, lengths1, codes2, lengths2, alphabet_size)
+    return distances / np.maximum(np.asarray(lengths1)[:, None], np.asarray(lengths2)[None, :])
+
+
+def get_LDN_matrix(words1: list[str], words2: list[str]) -> np.ndarray:
+    """
+    This function takes two lists of words and returns the LDN between every pair of words
+
+    Parameters:
+    - words1 (list[str]): first list of words
+    - words2 (list[str]): second list of words
+
+    Returns:
+    np.ndarray: (len(words1) x len(words2)) matrix where entry [i, j] is get_LDN(words1[i], words2[j])
+    """
+    codes1, lengths1 = encode_words(words1)
+    codes2, lengths2 = encode_words(words2)
+    return get_encoded_LDN_matrix(codes1, lengths1, codes2, lengths2)
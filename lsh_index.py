@@ -0,0 +1,287 @@
+import argparse
+import time
+
+import numpy as np
+
+from corpus_file import TRAINING_SET_PATH, load_corpus
+from distance_matrix_generator import condensed_index, condensed_pairs, condensed_size, scan_candidate_pairs, \
+    scan_related_pairs
+from language import Language
+from wordstore import NUM_SYMBOLS, WordStore, store_languages
+
+
+DEFAULT_NGRAM = 2
+DEFAULT_NUM_BANDS = 24
+DEFAULT_BAND_SIZE = 3
+DEFAULT_MIN_COLLISIONS = 5
+# (num_bands, band_size, min_collisions) settings measured by recall_report by default
+RECALL_SETTINGS = [(8, 2, 6), (16, 3, 3), (16, 3, 4), (24, 3, 4), (24, 3, 5), (24, 3, 6), (32, 4, 2), (32, 4, 3)]
+
+
+class NGramLSHIndex:
+    """
+    This class proposes the pairs of languages that are likely to be related, without scoring every pair.
+
+    Every concept slot of every language (the words of one concept) is turned into the set of the character
+    n-grams of its words, with a boundary symbol at both ends of every word, and summarized by MinHash: for each of
+    `num_bands * band_size` random permutations of the n-grams, the first n-gram of the set. Two slots get the same
+    MinHash with probability their Jaccard similarity, which is high for cognates and low otherwise. The hashes
+    are grouped into bands of `band_size`, and every (concept, band) puts the languages into buckets of equal band
+    values. Two languages collide once for every concept and band they share a bucket in, so a pair with many
+    similar concepts collides often, and a pair of unrelated languages rarely.
+
+    A pair is a candidate when it collides at least `min_collisions` times. That is the recall knob: lowered, more
+    related pairs are proposed, along with more unrelated ones to score. Only pairs that share a bucket are ever
+    formed, and their collisions are counted once (see `collisions`), so trying another `min_collisions` is a mask.
+
+    Wide bands keep the buckets of unrelated languages small (two slots share a band with probability their Jaccard
+    similarity to the power `band_size`), and many of them keep the recall of related pairs. On the training set
+    (3032 languages, 47,627 related pairs at 0.65) the defaults propose 7.2% of the pairs and find 99.65% of the
+    related ones, forming 4.3M pairs (48 MB) on the way, 13 per candidate. The 8 bands of 2 used before propose
+    6.3% and find 99.67%, but form 6.4M pairs, 22 per candidate (see `recall_report`).
+
+    The candidates are meant to be scored exactly (see `distance_matrix_generator.scan_candidate_pairs`): the related
+    pairs found are exactly the related pairs among the candidates, and `recall_report` measures how many are missed.
+
+    State:
+    - `ngram (int)`: length of the n-grams
+    - `num_bands (int)`, `band_size (int)`: the MinHash bands, `num_bands * band_size` hashes per concept slot
+    - `num_languages (int)`: number of indexed languages
+    - `signatures (np.ndarray)`: (hashes x concept slots) MinHash of every concept slot of the store, -1 for
+            slots without words ('XXX') and slots of languages that are not indexed
+    - `slot_language (np.ndarray)`: position in the indexed languages of every concept slot of the store, -1 for
+            languages of the store that are not indexed
+    - `slot_concept (np.ndarray)`: concept of every concept slot of the store
+    - `generated_pairs (int)`, `generated_bytes (int)`: number of pairs formed to count the collisions, and the bytes
+            of the arrays holding them, None until `collisions` is computed
+
+    Constructor:
+    - `languages: list[Language]`
+    - `ngram: int`, optional
+    - `num_bands: int`, optional
+    - `band_size: int`, optional
+    - `seed: int`, optional: seed of the permutations
+
+    Example:
+    ```py
+    index = NGramLSHIndex(languages)
+    first, second = index.candidate_pairs(min_collisions=5)
+    related = scan_candidate_pairs(languages, first, second) <= 0.65
+    probably_related = [(languages[i], languages[j]) for i, j in zip(first[related], second[related])]
+    ```
+    """
+
+    def __init__(self, languages: list[Language], ngram: int = DEFAULT_NGRAM, num_bands: int = DEFAULT_NUM_BANDS,
+                 band_size: int = DEFAULT_BAND_SIZE, seed: int = 0) -> None:
+        if min(ngram, num_bands, band_size) < 1:
+            raise ValueError("ngram, num_bands and band_size are at least 1.")
+        self.ngram = ngram
+        self.num_bands = num_bands
+        self.band_size = band_size
+        self.num_languages = len(languages)
+        self.generated_pairs = self.generated_bytes = None
+        self.__collisions = None
+
+        store, indices = store_languages(list(languages))
+        positions = np.full(len(store), -1, dtype=np.int64)
+        positions[indices] = np.arange(len(indices))
+        store_language = np.repeat(np.arange(len(store)), np.diff(store.language_offsets))
+        self.slot_language = positions[store_language]
+        self.slot_concept = np.arange(len(store_language)) - store.language_offsets[store_language]
+
+        # every n-gram of every word of the indexed languages, with the concept slot of the word
+        vocabulary_ngrams, has_ngram, num_ngrams = self.__vocabulary_ngrams(store, ngram)
+        words = np.nonzero(self.slot_language[store.word_slot] >= 0)[0]
+        has_ngram = has_ngram[store.word_ids[words]]
+        ngrams = vocabulary_ngrams[store.word_ids[words]][has_ngram]
+        slots = np.repeat(store.word_slot[words], has_ngram.sum(axis=1))
+
+        # exact MinHash: the smallest rank of the slot's n-grams in a random permutation of every n-gram there is
+        random = np.random.default_rng(seed)
+        self.signatures = np.full((num_bands * band_size, len(store_language)), num_ngrams, dtype=np.int64)
+        for signature in self.signatures:
+            np.minimum.at(signature, slots, random.permutation(num_ngrams)[ngrams])
+        self.signatures[self.signatures == num_ngrams] = -1
+
+    def collisions(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Count how many (concept, band) buckets every pair of languages shares, for the pairs that share any.
+        Computed once per index.
+
+        The slots of a concept with the same whole signature (most often the same words, as in groups of close
+        dialects) share a bucket in every band. They are grouped into classes first and the buckets are formed over
+        the classes: the languages of a class are paired once, with `num_bands` collisions, and the languages of two
+        classes once, with the number of bands the two share a bucket in. A pair of languages is thus formed once
+        per concept at most, instead of once per band it collides in.
+
+        Returns:
+        - `tuple[np.ndarray, np.ndarray]`: the positions of the pairs in a condensed distance matrix (see
+                `distance_matrix_generator.condensed_index`), sorted, and their number of collisions
+        """
+        if self.__collisions is not None:
+            return self.__collisions
+        indexed = (self.slot_language >= 0) & (self.signatures[0] >= 0)
+        language = self.slot_language[indexed]
+        # the slots of a concept with the same whole signature (most often the same words) share a bucket in every
+        #   band: they are grouped into classes, and the buckets are formed over the classes
+        classes, slot_class = np.unique(np.vstack((self.slot_concept[indexed], self.signatures[:, indexed])), axis=1,
+                                        return_inverse=True)
+        slot_class = slot_class.ravel()
+        num_classes = classes.shape[1]
+
+        # the pairs of classes that share a bucket, with the number of bands they share one in
+        class_pairs = []
+        for band in range(self.num_bands):
+            band_values = classes[1 + band * self.band_size:1 + (band + 1) * self.band_size]
+            _, bucket = np.unique(np.vstack((classes[0], band_values)), axis=1, return_inverse=True)
+            first, second = self.__group_pairs(bucket.ravel())
+            class_pairs.append(first * num_classes + second)
+        class_pairs = np.concatenate(class_pairs)
+        shared, shared_bands = np.unique(class_pairs, return_counts=True)
+        class1, class2 = np.divmod(shared, num_classes)
+
+        # every language of a class with every language of the other, and the languages of a class with each other
+        #   in every band: a pair of languages is formed once per concept at most
+        order = np.argsort(slot_class, kind='stable')
+        class_languages = language[order]
+        class_sizes = np.bincount(slot_class, minlength=num_classes)
+        class_starts = np.cumsum(class_sizes) - class_sizes
+        sizes1, sizes2 = class_sizes[class1], class_sizes[class2]
+        products = sizes1 * sizes2
+        pair = np.repeat(np.arange(len(shared)), products)
+        member = np.arange(len(pair)) - np.repeat(np.cumsum(products) - products, products)
+        first = class_languages[class_starts[class1][pair] + member // sizes2[pair]]
+        second = class_languages[class_starts[class2][pair] + member % sizes2[pair]]
+        same_first, same_second = self.__group_pairs(slot_class)
+        first = np.concatenate((first, language[same_first]))
+        second = np.concatenate((second, language[same_second]))
+        weights = np.concatenate((shared_bands[pair], np.full(len(same_first), self.num_bands))).astype(np.int32)
+
+        positions = condensed_index(np.minimum(first, second), np.maximum(first, second), self.num_languages)
+        self.generated_pairs = len(class_pairs) + len(positions)
+        self.generated_bytes = class_pairs.nbytes + positions.nbytes + weights.nbytes
+        positions, inverse = np.unique(positions, return_inverse=True)
+        self.__collisions = positions, np.bincount(inverse.ravel(), weights=weights).astype(np.int64)
+        return self.__collisions
+
+    def candidate_pairs(self, min_collisions: int = DEFAULT_MIN_COLLISIONS) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The pairs of languages that collide at least `min_collisions` times.
+
+        Returns:
+        - `tuple[np.ndarray, np.ndarray]`: the i and j (i < j) of every candidate pair, in combinations order
+        """
+        positions, counts = self.collisions()
+        return condensed_pairs(self.num_languages, positions[counts >= min_collisions])
+
+    @staticmethod
+    def __vocabulary_ngrams(store: WordStore, ngram: int) -> tuple[np.ndarray, np.ndarray, int]:
+        """
+        The n-grams of every distinct word of the store, with a boundary symbol (code NUM_SYMBOLS) before and after
+        the word, each as one integer.
+
+        Returns:
+        - `tuple[np.ndarray, np.ndarray, int]`: (vocabulary x positions) n-gram ids, mask of the positions that
+                hold an n-gram of the word, and the number of possible n-gram ids
+        """
+        lengths = store.vocabulary_lengths
+        width = store.vocabulary_codes.shape[1] + 2
+        positions = np.arange(width)
+        padded = np.full((len(lengths), width), NUM_SYMBOLS, dtype=np.int64)
+        padded[:, 1:-1] = store.vocabulary_codes
+        padded[positions[None, :] > lengths[:, None]] = NUM_SYMBOLS
+
+        num_positions = max(0, width - ngram + 1)
+        ngrams = np.zeros((len(lengths), num_positions), dtype=np.int64)
+        for offset in range(ngram):
+            ngrams = ngrams * (NUM_SYMBOLS + 1) + padded[:, offset:offset + num_positions]
+        has_ngram = positions[None, :num_positions] < (lengths + 2 - ngram + 1)[:, None]
+        return ngrams, has_ngram, (NUM_SYMBOLS + 1) ** ngram
+
+    @staticmethod
+    def __group_pairs(group: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Every pair of elements in the same group, as (smaller, larger) positions in `group`."""
+        order = np.argsort(group, kind='stable')
+        group = group[order]
+        starts = np.concatenate(([0], np.nonzero(np.diff(group))[0] + 1))
+        sizes = np.diff(np.append(starts, len(group)))
+        # every element pairs with the elements after it in its group
+        later = np.repeat(starts + sizes, sizes) - np.arange(len(group)) - 1
+        first = np.repeat(np.arange(len(group)), later)
+        second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(later) - later, later)
+        return order[first], order[second]
+
+
+def recall_report(languages: list[Language], theta_dERC: float, related: np.ndarray = None,
+                  settings=RECALL_SETTINGS, ngram: int = DEFAULT_NGRAM, seed: int = 0,
+                  num_workers: int = None) -> list[dict]:
+    """
+    Measure the recall of the candidate pairs of `NGramLSHIndex` against the exhaustive scan.
+
+    Parameters:
+    - `languages (list[Language])`: the languages
+    - `theta_dERC (float)`: the threshold of the related pairs
+    - `related (np.ndarray, optional)`: condensed boolean matrix of the related pairs, as `scan_related_pairs`
+            returns it. Scanned if not given.
+    - `settings (list[tuple[int, int, int]], optional)`: the (num_bands, band_size, min_collisions) to measure
+    - `ngram (int, optional)`, `seed (int, optional)`: see `NGramLSHIndex`
+    - `num_workers (int, optional)`: worker processes of the exhaustive scan
+
+    Returns:
+    - `list[dict]`: for every setting, the number of candidates, the fraction of all pairs they are, the recall
+            (fraction of the related pairs that are candidates), the number of pairs formed to count the collisions
+            and their bytes (see `NGramLSHIndex.generated_pairs`), and the seconds it took to build the index and
+            count its collisions
+    """
+    if related is None:
+        related = scan_related_pairs(languages, theta_dERC, num_workers=num_workers)
+    related_positions = np.nonzero(related)[0]
+    report = []
+    indexes = {}
+    for num_bands, band_size, min_collisions in settings:
+        # one index per banding, the min_collisions of a banding are masks of the same collisions
+        if (num_bands, band_size) not in indexes:
+            start = time.perf_counter()
+            index = NGramLSHIndex(languages, ngram, num_bands, band_size, seed)
+            index.collisions()
+            indexes[num_bands, band_size] = index, time.perf_counter() - start
+        index, seconds = indexes[num_bands, band_size]
+        positions, counts = index.collisions()
+        candidates = positions[counts >= min_collisions]
+        found = np.count_nonzero(np.isin(related_positions, candidates, assume_unique=True))
+        report.append({
+            'num_bands': num_bands, 'band_size': band_size, 'min_collisions': min_collisions,
+            'candidates': len(candidates),
+            'candidate_fraction': len(candidates) / max(1, condensed_size(len(languages))),
+            'recall': found / len(related_positions) if len(related_positions) else 1.0,
+            'generated_pairs': index.generated_pairs,
+            'generated_bytes': index.generated_bytes,
+            'index_seconds': seconds,
+        })
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the recall of the LSH candidate pairs on the training set.")
+    parser.add_argument('--theta', type=float, default=0.65)
+    parser.add_argument('--corpus', default=TRAINING_SET_PATH)
+    parser.add_argument('--workers', type=int, default=None)
+    arguments = parser.parse_args()
+
+    training_languages = [language for family in load_corpus(arguments.corpus).values() for language in family]
+    scan_start = time.perf_counter()
+    related_pairs = scan_related_pairs(training_languages, arguments.theta, num_workers=arguments.workers)
+    print(f"exhaustive scan: {np.count_nonzero(related_pairs)} related pairs of "
+          f"{condensed_size(len(training_languages))} in {time.perf_counter() - scan_start:.1f}s")
+    for row in recall_report(training_languages, arguments.theta, related_pairs):
+        print(f"bands {row['num_bands']:>2} x {row['band_size']}, min collisions {row['min_collisions']:>2}: "
+              f"{row['candidates']} candidates ({100 * row['candidate_fraction']:.2f}% of the pairs), "
+              f"recall {100 * row['recall']:.2f}%, {row['generated_pairs']} pairs formed "
+              f"({row['generated_bytes'] / 1e6:.0f} MB), index {row['index_seconds']:.1f}s")
+
+    candidate_start = time.perf_counter()
+    first_languages, second_languages = NGramLSHIndex(training_languages).candidate_pairs()
+    found_pairs = scan_candidate_pairs(training_languages, first_languages, second_languages,
+                                       num_workers=arguments.workers) <= arguments.theta
+    print(f"default candidate scan: {np.count_nonzero(found_pairs)} related pairs "
+          f"in {time.perf_counter() - candidate_start:.1f}s")
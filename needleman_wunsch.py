@@ -0,0 +1,676 @@
+import numpy as np
+
+import instrumentation
+from pmi_matrix import PMIMatrix
+from wordstore import GAP, NUM_SYMBOLS, encode_word
+
+
+# pairwise2 compares scores after rounding them to this many parts per unit
+__PRECISION = 1000
+__BATCH_SIZE = 1024
+# batches of at most this many pairs are aligned one pair at a time with Python scalars (see `align_pair`): the
+#   vectorized steps cost about the same for one pair as for a thousand, far more than a single small alignment
+SCALAR_PAIRS = 8
+# longest pair (both words together) the scalar traceback takes, it recurses once per cell of a path
+__SCALAR_LENGTH = 128
+
+
+def check_gap_scores(open_gap_score: float, extend_gap_score: float):
+    """
+    Raise the same errors as Bio.pairwise2 for gap scores it does not accept.
+    """
+    if open_gap_score > 0 or extend_gap_score > 0:
+        raise ValueError("Gap penalties should be non-positive.")
+    if extend_gap_score < open_gap_score:
+        raise ValueError("Gap opening penalty should be higher than "
+                         "gap extension penalty (or equal)")
+
+
+def gap_penalty(length: int, open_gap_score: float, extend_gap_score: float) -> float:
+    """
+    Score of a gap of the given length. Uses the same floating point steps as Bio.pairwise2.
+    """
+    if length <= 0:
+        return 0.0
+    return open_gap_score + extend_gap_score * length - extend_gap_score
+
+
+def pmi_array(pmi_matrix) -> np.ndarray:
+    """
+    The dense symmetric 41x41 array indexed by symbol codes of a PMI matrix: the scores of a `PMIMatrix`
+    (not copied), or those of a `dict[tuple[str, str], float]` PMI matrix (sorted character pairs as keys).
+    Arrays are passed through.
+
+    Pairs that are missing from the dict are NaN.
+    """
+    if isinstance(pmi_matrix, np.ndarray):
+        return pmi_matrix
+    return PMIMatrix.of(pmi_matrix).scores
+
+
+def pmi_dict(scores: np.ndarray) -> dict[tuple[str, str], float]:
+    """
+    Turn a dense PMI array back into a `dict[tuple[str, str], float]` PMI matrix. NaN entries are left out.
+    """
+    return PMIMatrix(scores).as_dict()
+
+
+def identity_array(match: float, mismatch: float) -> np.ndarray:
+    """
+    Dense score array that gives `match` to identical symbols and `mismatch` to everything else.
+    """
+    scores = np.full((NUM_SYMBOLS, NUM_SYMBOLS), float(mismatch))
+    np.fill_diagonal(scores, match)
+    return scores
+
+
+def encode_pairs(word_pairs: list[tuple[str, str]]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Encode a list of word pairs into padded code matrices.
+
+    Returns:
+    - `tuple`: codes and lengths of the first words, codes and lengths of the second words
+    """
+    words1 = [encode_word(word1) for word1, _ in word_pairs]
+    words2 = [encode_word(word2) for _, word2 in word_pairs]
+    return (*__pad(words1), *__pad(words2))
+
+
+def __pad(words: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    lengths = np.array([len(word) for word in words], dtype=np.int64)
+    codes = np.zeros((len(words), lengths.max(initial=0)), dtype=np.uint8)
+    for row, word in enumerate(words):
+        codes[row, :len(word)] = word
+    return codes, lengths
+
+
+def align_scores(codes1: np.ndarray, lengths1: np.ndarray, codes2: np.ndarray, lengths2: np.ndarray,
+                 scores: np.ndarray, open_gap_score: float, extend_gap_score: float) -> np.ndarray:
+    """
+    Score-only global alignment of a batch of word pairs.
+
+    Gives the score of `pairwise2.align.globalcs(word1, word2, match_fn, open, extend)[0]` for every pair,
+    where `match_fn` looks up `scores`.
+
+    Parameters:
+    - `codes1, lengths1 (np.ndarray)`: padded symbol codes and lengths of the first words
+    - `codes2, lengths2 (np.ndarray)`: padded symbol codes and lengths of the second words
+    - `scores (np.ndarray)`: dense symbol by symbol score array (see `pmi_array`)
+    - `open_gap_score, extend_gap_score (float)`: affine gap scores, non-positive
+
+    Returns:
+    - `np.ndarray`: alignment score of every pair. Pairs with an empty word get NaN.
+    """
+    check_gap_scores(open_gap_score, extend_gap_score)
+    result = np.full(len(lengths1), np.nan)
+    matches = __pair_matches(codes1, lengths1, codes2, lengths2, scores) if len(lengths1) <= SCALAR_PAIRS else None
+    if matches is not None:
+        for pair, match in enumerate(matches):
+            if match is not None:
+                result[pair] = score_pair(match, open_gap_score, extend_gap_score)
+        if instrumentation.enabled:
+            __count_alignments(codes1, lengths1, codes2, lengths2, scores)
+        return result
+    for batch, rows, cols in __batches(lengths1, lengths2):
+        score, _ = __fill(codes1[batch, :rows], codes2[batch, :cols], scores,
+                          open_gap_score, extend_gap_score, traceback=False)
+        result[batch] = score[np.arange(len(batch)), lengths1[batch], lengths2[batch]]
+    if instrumentation.enabled:
+        __count_alignments(codes1, lengths1, codes2, lengths2, scores)
+    return result
+
+
+def align_batch(codes1: np.ndarray, lengths1: np.ndarray, codes2: np.ndarray, lengths2: np.ndarray,
+                scores: np.ndarray, open_gap_score: float, extend_gap_score: float):
+    """
+    Global alignment of a batch of word pairs with a single traceback per pair.
+
+    Gives the same score and aligned words as `pairwise2.align.globalcs(word1, word2, match_fn, open, extend)[0]`
+    for every pair: the trace matrix is built with pairwise2's rounding rules, and the traceback follows the
+    first path of pairwise2's depth-first search (it never builds the other co-optimal alignments).
+
+    Parameters:
+    - `codes1, lengths1 (np.ndarray)`: padded symbol codes and lengths of the first words
+    - `codes2, lengths2 (np.ndarray)`: padded symbol codes and lengths of the second words
+    - `scores (np.ndarray)`: dense symbol by symbol score array (see `pmi_array`)
+    - `open_gap_score, extend_gap_score (float)`: affine gap scores, non-positive
+
+    Returns:
+    - `tuple`: alignment score of every pair, (pairs x longest alignment) codes of both aligned words with
+        `wordstore.GAP` for gaps, the length of every alignment, and a mask of the pairs that have an
+        alignment (pairwise2 returns none for empty words)
+    """
+    check_gap_scores(open_gap_score, extend_gap_score)
+    num_pairs = len(lengths1)
+    width = int((np.asarray(lengths1) + np.asarray(lengths2)).max(initial=0))
+    result = np.full(num_pairs, np.nan)
+    aligned1 = np.full((num_pairs, width), GAP, dtype=np.uint8)
+    aligned2 = np.full((num_pairs, width), GAP, dtype=np.uint8)
+    aligned_lengths = np.zeros(num_pairs, dtype=np.int64)
+    found = np.zeros(num_pairs, dtype=bool)
+
+    # the scalar traceback rounds with int, which needs finite scores (missing PMI entries are NaN)
+    matches = __pair_matches(codes1, lengths1, codes2, lengths2, scores) \
+        if num_pairs <= SCALAR_PAIRS and width <= __SCALAR_LENGTH else None
+    if matches is not None:
+        for pair, match in enumerate(matches):
+            if match is not None:
+                result[pair], pair_aligned1, pair_aligned2, found[pair] = align_pair(
+                    codes1[pair, :lengths1[pair]].tolist(), codes2[pair, :lengths2[pair]].tolist(), match,
+                    open_gap_score, extend_gap_score)
+                aligned_lengths[pair] = len(pair_aligned1)
+                aligned1[pair, :len(pair_aligned1)] = pair_aligned1
+                aligned2[pair, :len(pair_aligned2)] = pair_aligned2
+        if instrumentation.enabled:
+            __count_alignments(codes1, lengths1, codes2, lengths2, scores)
+        return result, aligned1, aligned2, aligned_lengths, found
+
+    penalties = np.array([gap_penalty(length, open_gap_score, extend_gap_score)
+                          for length in range(width + 1)])
+
+    for batch, rows, cols in __batches(lengths1, lengths2):
+        batch_codes1, batch_codes2 = codes1[batch, :rows], codes2[batch, :cols]
+        batch_lengths1, batch_lengths2 = lengths1[batch], lengths2[batch]
+        score, trace = __fill(batch_codes1, batch_codes2, scores,
+                              open_gap_score, extend_gap_score, traceback=True)
+        result[batch] = score[np.arange(len(batch)), batch_lengths1, batch_lengths2]
+
+        path = __traceback(score, trace, batch_codes1, batch_lengths1,
+                           batch_codes2, batch_lengths2, penalties)
+
+        # pairwise2 retries with both words swapped if no path survived
+        retry = ~path[3]
+        if retry.any():
+            swapped = __traceback(score[retry].transpose(0, 2, 1), __swap_trace(trace[retry].transpose(0, 2, 1)),
+                                  batch_codes2[retry], batch_lengths2[retry],
+                                  batch_codes1[retry], batch_lengths1[retry], penalties)
+            for part, swapped_part in zip(path, (swapped[1], swapped[0], swapped[2], swapped[3])):
+                part[retry] = swapped_part
+
+        # no alignment is longer than both words together, so trimming to `width` loses nothing
+        batch_aligned1, batch_aligned2, batch_aligned_lengths, batch_found = path
+        batch_width = min(width, batch_aligned1.shape[1])
+        aligned1[batch, :batch_width] = batch_aligned1[:, :batch_width]
+        aligned2[batch, :batch_width] = batch_aligned2[:, :batch_width]
+        aligned_lengths[batch] = batch_aligned_lengths
+        found[batch] = batch_found
+
+    if instrumentation.enabled:
+        __count_alignments(codes1, lengths1, codes2, lengths2, scores)
+    return result, aligned1, aligned2, aligned_lengths, found
+
+
+def score_pair(match: list[list[float]], open_gap_score: float, extend_gap_score: float) -> float:
+    """
+    Score-only global alignment of a single pair of non-empty words, with Python scalars: `align_scores` for
+    one pair, without the fixed cost of the vectorized steps.
+
+    Parameters:
+    - `match (list[list[float]])`: score of every symbol of the first word (rows) with every symbol of the
+            second word (columns), all finite
+    - `open_gap_score, extend_gap_score (float)`: affine gap scores, non-positive
+
+    Returns:
+    - `float`: the alignment score
+    """
+    check_gap_scores(open_gap_score, extend_gap_score)
+    penalties = [gap_penalty(length, open_gap_score, extend_gap_score)
+                 for length in range(max(len(match), len(match[0])) + 1)]
+    score, _, _ = __fill_pair(match, penalties, open_gap_score, extend_gap_score)
+    return score[-1][-1]
+
+
+def align_pair(word1, word2, match: list[list[float]], open_gap_score: float, extend_gap_score: float,
+               gap=GAP) -> tuple[float, list, list, bool]:
+    """
+    Global alignment of a single pair of non-empty words with a single traceback, with Python scalars:
+    `align_batch` for one pair, without the fixed cost of the vectorized steps.
+
+    Parameters:
+    - `word1, word2`: the symbols of both words, codes or characters, they are what the alignment is made of
+    - `match (list[list[float]])`: see `score_pair`
+    - `open_gap_score, extend_gap_score (float)`: affine gap scores, non-positive
+    - `gap (optional)`: the symbol of a gap, `wordstore.GAP` by default ('-' for characters)
+
+    Returns:
+    - `tuple[float, list, list, bool]`: the alignment score, both aligned words as lists, and whether there is
+        an alignment
+    """
+    check_gap_scores(open_gap_score, extend_gap_score)
+    penalties = [gap_penalty(length, open_gap_score, extend_gap_score)
+                 for length in range(max(len(word1), len(word2)) + 1)]
+    score, row_scores, col_scores = __fill_pair(match, penalties, open_gap_score, extend_gap_score)
+    trace = __trace_pair(score, row_scores, col_scores, match, penalties[1], extend_gap_score)
+    aligned1, aligned2, found = __traceback_pair(score, trace, word1, word2, penalties, gap)
+    if not found:
+        # pairwise2 retries with both words swapped if no path survived: transposed, a gap in one word is a gap
+        #   in the other
+        swapped_score = [list(column) for column in zip(*score)]
+        swapped_row_scores = [list(column) for column in zip(*col_scores)]
+        swapped_col_scores = [list(column) for column in zip([0.0] * len(score[0]), *row_scores[1:])]
+        swapped_trace = __trace_pair(swapped_score, swapped_row_scores, swapped_col_scores,
+                                     [list(column) for column in zip(*match)], penalties[1], extend_gap_score)
+        aligned2, aligned1, found = __traceback_pair(swapped_score, swapped_trace, word2, word1, penalties, gap)
+    return score[-1][-1], aligned1, aligned2, found
+
+
+def __count_alignments(codes1: np.ndarray, lengths1: np.ndarray, codes2: np.ndarray, lengths2: np.ndarray,
+                       scores: np.ndarray):
+    """Count the alignments, and the character pairs they looked up that have no score (NaN)."""
+    instrumentation.count('alignments', len(lengths1))
+    missing = np.isnan(scores)
+    if not missing.any() or not len(lengths1):
+        return
+    rows, cols = codes1.shape[1], codes2.shape[1]
+    in_words = (np.arange(rows)[None, :, None] < np.asarray(lengths1)[:, None, None]) \
+        & (np.arange(cols)[None, None, :] < np.asarray(lengths2)[:, None, None])
+    missing_lookups = (missing[codes1[:, :, None], codes2[:, None, :]] & in_words).sum(axis=(1, 2))
+    instrumentation.count('missing PMI lookups', int(missing_lookups.sum()))
+    instrumentation.count('alignments with missing PMI entries', int(np.count_nonzero(missing_lookups)))
+
+
+def __batches(lengths1: np.ndarray, lengths2: np.ndarray):
+    """
+    Yield chunks of pairs of similar lengths, with the longest first and second word of every chunk.
+    """
+    lengths1 = np.asarray(lengths1)
+    lengths2 = np.asarray(lengths2)
+    nonempty = np.nonzero((lengths1 > 0) & (lengths2 > 0))[0]
+    order = nonempty[np.lexsort((lengths2[nonempty], lengths1[nonempty]))]
+    for start in range(0, len(order), __BATCH_SIZE):
+        batch = order[start:start + __BATCH_SIZE]
+        yield batch, int(lengths1[batch].max()), int(lengths2[batch].max())
+
+
+def __rint(values):
+    return np.trunc(values * __PRECISION + 0.5)
+
+
+def __diagonals(rows: int, cols: int):
+    """
+    Yield the (row, col) indices of the inner cells of every anti-diagonal, in order.
+
+    The cells of one anti-diagonal only depend on cells of earlier anti-diagonals, so each one is a single vector step.
+    """
+    for diagonal in range(2, rows + cols + 1):
+        row = np.arange(max(1, diagonal - cols), min(rows, diagonal - 1) + 1)
+        yield row, diagonal - row
+
+
+def __fill(codes1: np.ndarray, codes2: np.ndarray, scores: np.ndarray,
+           open_gap_score: float, extend_gap_score: float, traceback: bool):
+    """
+    Fill pairwise2's (Gotoh) score matrix, and optionally its trace matrix, for a batch of padded pairs.
+
+    Trace bits: 1 = open gap in word1, 2 = match/mismatch, 4 = open gap in word2,
+    8 = extend gap in word1, 16 = extend gap in word2.
+    """
+    num_pairs, rows = codes1.shape
+    cols = codes2.shape[1]
+    first_gap = gap_penalty(1, open_gap_score, extend_gap_score)
+
+    match = scores[codes1[:, :, None], codes2[:, None, :]]
+    score = np.empty((num_pairs, rows + 1, cols + 1))
+    score[:, :, 0] = [gap_penalty(row, open_gap_score, extend_gap_score) for row in range(rows + 1)]
+    score[:, 0, :] = [gap_penalty(col, open_gap_score, extend_gap_score) for col in range(cols + 1)]
+    # best score of a gap in word1 ending in every row, and of a gap in word2 ending in every column
+    row_cache = np.tile([gap_penalty(row, 2 * open_gap_score, extend_gap_score)
+                         for row in range(rows + 1)], (num_pairs, 1))
+    col_cache = np.tile([gap_penalty(col, 2 * open_gap_score, extend_gap_score)
+                         for col in range(cols + 1)], (num_pairs, 1))
+    trace = np.zeros((num_pairs, rows + 1, cols + 1), dtype=np.uint8) if traceback else None
+
+    for row, col in __diagonals(rows, cols):
+        nogap_score = score[:, row - 1, col - 1] + match[:, row - 1, col - 1]
+
+        row_open = score[:, row, col - 1] + first_gap
+        row_extend = row_cache[:, row] + extend_gap_score
+        row_score = np.maximum(row_open, row_extend)
+        row_cache[:, row] = row_score
+
+        col_open = score[:, row - 1, col] + first_gap
+        col_extend = col_cache[:, col] + extend_gap_score
+        col_score = np.maximum(col_open, col_extend)
+        col_cache[:, col] = col_score
+
+        best_score = np.maximum(row_score, col_score)
+        best_score = np.where(nogap_score > best_score, nogap_score, best_score)
+        score[:, row, col] = best_score
+
+        if traceback:
+            row_score_rint = __rint(row_score)
+            col_score_rint = __rint(col_score)
+            best_score_rint = __rint(best_score)
+            row_trace = (__rint(row_open) == row_score_rint) * 1 \
+                + (__rint(row_extend) == row_score_rint) * 8
+            col_trace = (__rint(col_open) == col_score_rint) * 4 \
+                + (__rint(col_extend) == col_score_rint) * 16
+            trace[:, row, col] = (__rint(nogap_score) == best_score_rint) * 2 \
+                + (row_score_rint == best_score_rint) * row_trace \
+                + (col_score_rint == best_score_rint) * col_trace
+
+    return score, trace
+
+
+def __swap_trace(trace: np.ndarray) -> np.ndarray:
+    """Trace bits of the same matrix with both words swapped (1 <-> 4 and 8 <-> 16)."""
+    return (trace & 2) | ((trace & 1) << 2) | ((trace & 4) >> 2) | ((trace & 8) << 1) | ((trace & 16) >> 1)
+
+
+def __gap_landings(score: np.ndarray, target_rint: np.ndarray, penalties: np.ndarray, position: np.ndarray) -> np.ndarray:
+    """
+    Where an extended gap that ends at `position` may have been opened.
+
+    `score` holds the scores along the gap's row (or column) in its last axis. Entry k of the result is True if
+    a gap opened after k reproduces the target score (pairwise2's `_find_gap_open`). Gaps must be at least 2 long.
+    """
+    starts = np.arange(score.shape[-1])
+    length = position[..., None] - starts
+    actual_score = score + penalties[np.clip(length, 0, len(penalties) - 1)]
+    return (__rint(actual_score) == target_rint[..., None]) & (length >= 2)
+
+
+def __feasible(score: np.ndarray, trace: np.ndarray, penalties: np.ndarray) -> np.ndarray:
+    """
+    For every cell and both values of pairwise2's `col_gap` flag, can the traceback reach the origin from there?
+
+    pairwise2 forbids a gap in word1 right before (in traceback order: after) a gap in word2. A path that runs
+    into that dies, which is why the first alignment is not simply the greedy path.
+    """
+    num_pairs, rows, cols = trace.shape
+    feasible = np.zeros((num_pairs, rows, cols, 2), dtype=bool)
+    feasible[:, :, 0, :] = True
+    feasible[:, 0, :, 0] = True
+    feasible[:, 0, 0, 1] = True
+    score_rint = __rint(score)
+
+    for row, col in __diagonals(rows - 1, cols - 1):
+        cell_trace = trace[:, row, col]
+        target = score_rint[:, row, col]
+        horizontal = (cell_trace & 1).astype(bool) & feasible[:, row, col - 1, 0]
+        diagonal = (cell_trace & 2).astype(bool) & feasible[:, row - 1, col - 1, 0]
+        vertical = (cell_trace & 4).astype(bool) & feasible[:, row - 1, col, 1]
+
+        # extended gaps are rare, so their landings are only searched in the pairs that have one here;
+        #   landings past the cell itself are too short (length < 2), whatever their feasibility
+        row_extend = (cell_trace & 8).astype(bool)
+        col_extend = (cell_trace & 16).astype(bool)
+        extending = np.nonzero(row_extend.any(axis=1))[0]
+        if len(extending):
+            row_extend[extending] &= (
+                __gap_landings(score[extending][:, row, :], target[extending], penalties, col)
+                & feasible[extending, :, :, 0][:, row, :]).any(axis=-1)
+        extending = np.nonzero(col_extend.any(axis=1))[0]
+        if len(extending):
+            col_extend[extending] &= (
+                __gap_landings(score[extending][:, :, col].transpose(0, 2, 1), target[extending], penalties, row)
+                & feasible[extending, :, :, 1][:, :, col].transpose(0, 2, 1)).any(axis=-1)
+
+        feasible[:, row, col, 1] = diagonal | vertical | col_extend
+        feasible[:, row, col, 0] = feasible[:, row, col, 1] | horizontal | row_extend
+
+    return feasible
+
+
+def __traceback(score: np.ndarray, trace: np.ndarray, codes1: np.ndarray, lengths1: np.ndarray,
+                codes2: np.ndarray, lengths2: np.ndarray, penalties: np.ndarray):
+    """
+    Follow the first alignment of pairwise2's depth-first traceback for a batch of pairs.
+
+    At every step the options are tried in pairwise2's order (open gap in word1, match, open gap in word2,
+    extended gap in word1 back to the border, extended gaps in word2 from the longest, extended gaps in
+    word1 from the longest) and the first one that can still reach the origin is taken.
+    """
+    num_pairs, rows, cols = trace.shape
+    pairs = np.arange(num_pairs)
+    feasible = __feasible(score, trace, penalties)
+    score_rint = __rint(score)
+
+    row = np.asarray(lengths1).copy()
+    col = np.asarray(lengths2).copy()
+    col_gap = np.zeros(num_pairs, dtype=bool)
+    found = feasible[pairs, row, col, 0]
+
+    width = rows + cols - 2
+    reversed1 = np.full((num_pairs, width), GAP, dtype=np.uint8)
+    reversed2 = np.full((num_pairs, width), GAP, dtype=np.uint8)
+    emitted = np.zeros(num_pairs, dtype=np.int64)
+
+    active = found & ((row > 0) | (col > 0))
+    while active.any():
+        inner = active & (row > 0) & (col > 0)
+        cell_trace = np.where(inner, trace[pairs, row, col], 0)
+        target = score_rint[pairs, row, col]
+        row_before = np.maximum(row - 1, 0)
+        col_before = np.maximum(col - 1, 0)
+
+        new_row = row.copy()
+        new_col = col.copy()
+        new_col_gap = col_gap.copy()
+        chosen = ~inner
+
+        # borders: the rest of the other word against gaps
+        new_row[active & (col == 0)] = 0
+        new_col[active & (row == 0)] = 0
+
+        def choose(option, to_row, to_col, to_col_gap):
+            nonlocal chosen
+            take = option & ~chosen
+            new_row[take] = to_row[take]
+            new_col[take] = to_col[take]
+            new_col_gap[take] = to_col_gap
+            chosen = chosen | take
+
+        choose((cell_trace & 1).astype(bool) & ~col_gap & feasible[pairs, row, col_before, 0],
+               row, col - 1, False)
+        choose((cell_trace & 2).astype(bool) & feasible[pairs, row_before, col_before, 0],
+               row - 1, col - 1, False)
+        choose((cell_trace & 4).astype(bool) & feasible[pairs, row_before, col, 1],
+               row - 1, col, True)
+
+        row_landings = (cell_trace & 8).astype(bool)[:, None] & ~col_gap[:, None] \
+            & __gap_landings(score[pairs, row], target, penalties, col) \
+            & feasible[pairs, row, :, 0] & (np.arange(cols)[None, :] < col[:, None])
+        col_landings = (cell_trace & 16).astype(bool)[:, None] \
+            & __gap_landings(score[pairs, :, col], target, penalties, row) \
+            & feasible[pairs, :, col, 1] & (np.arange(rows)[None, :] < row[:, None])
+
+        choose(row_landings[:, 0], row, np.zeros(num_pairs, dtype=np.int64), False)
+        choose(col_landings.any(axis=1), col_landings.argmax(axis=1), col, True)
+        row_landings[:, 0] = False
+        choose(row_landings.any(axis=1), row, row_landings.argmax(axis=1), False)
+
+        # emit the columns of this step, in traceback order
+        steps = np.where(active, np.maximum(row - new_row, col - new_col), 0)
+        diagonal = (row - new_row == 1) & (col - new_col == 1)
+        for step in range(steps.max(initial=0)):
+            emit = step < steps
+            take1 = emit & (row > new_row)
+            take2 = emit & (col > new_col)
+            position = emitted + step
+            reversed1[pairs[take1], position[take1]] = codes1[take1, (row - 1 - np.where(diagonal, 0, step))[take1]]
+            reversed2[pairs[take2], position[take2]] = codes2[take2, (col - 1 - np.where(diagonal, 0, step))[take2]]
+        emitted += steps
+
+        row, col, col_gap = new_row, new_col, new_col_gap
+        active = found & ((row > 0) | (col > 0))
+
+    # reverse the emitted columns of every pair
+    offsets = emitted[:, None] - 1 - np.arange(width)[None, :]
+    inside = offsets >= 0
+    aligned1 = np.where(inside, reversed1[pairs[:, None], np.maximum(offsets, 0)], GAP).astype(np.uint8)
+    aligned2 = np.where(inside, reversed2[pairs[:, None], np.maximum(offsets, 0)], GAP).astype(np.uint8)
+
+    return aligned1, aligned2, emitted, found
+
+
+def __pair_matches(codes1: np.ndarray, lengths1: np.ndarray, codes2: np.ndarray, lengths2: np.ndarray,
+                   scores: np.ndarray):
+    """
+    The match scores of every pair of a small batch as lists of rows, for `score_pair` and `align_pair`.
+
+    Returns:
+    - `list`: the rows of every pair, None for pairs with an empty word. None instead if any score is not finite.
+    """
+    matches = []
+    for pair, (length1, length2) in enumerate(zip(np.asarray(lengths1).tolist(), np.asarray(lengths2).tolist())):
+        if not (length1 and length2):
+            matches.append(None)
+            continue
+        match = scores[codes1[pair, :length1, None], codes2[pair, None, :length2]]
+        if not np.isfinite(match).all():
+            return None
+        matches.append(match.tolist())
+    return matches
+
+
+def __fill_pair(match: list, penalties: list, open_gap_score: float, extend_gap_score: float):
+    """
+    `__fill` for a single pair, with Python scalars and the same floating point steps. The trace is not built:
+    the best row gap and column gap score of every cell are kept instead, from which `__trace_pair` derives the
+    trace bits of the few cells a traceback visits.
+
+    Returns:
+    - `tuple[list, list, list]`: the score, the row gap score and the column gap score of every cell, as lists of rows
+    """
+    rows, cols = len(match), len(match[0])
+    first_gap = penalties[1]
+    # gap_penalty(length, 2 * open_gap_score, extend_gap_score) of every length
+    double_open_gap_score = 2 * open_gap_score
+    double_penalties = [0.0] + [double_open_gap_score + extend_gap_score * length - extend_gap_score
+                                for length in range(1, max(rows, cols) + 1)]
+    score = [penalties[:cols + 1]]
+    # row 0 never opens a gap in the first word
+    row_scores = [None]
+    col_scores = [double_penalties[:cols + 1]]
+
+    # row by row, every cell still comes after the cells it depends on
+    for row in range(1, rows + 1):
+        above, col_above = score[row - 1], col_scores[row - 1]
+        best_score = penalties[row]
+        row_score = double_penalties[row]
+        current, current_row_scores, current_col_scores = [best_score], [row_score], [0.0]
+        append, append_row_score, append_col_score = current.append, current_row_scores.append, current_col_scores.append
+        for diagonal, match_score, up, col_up in zip(above, match[row - 1], above[1:], col_above[1:]):
+            nogap_score = diagonal + match_score
+
+            row_open = best_score + first_gap
+            row_extend = row_score + extend_gap_score
+            row_score = row_open if row_open >= row_extend else row_extend
+
+            col_open = up + first_gap
+            col_extend = col_up + extend_gap_score
+            col_score = col_open if col_open >= col_extend else col_extend
+
+            best_score = row_score if row_score >= col_score else col_score
+            if nogap_score > best_score:
+                best_score = nogap_score
+            append(best_score)
+            append_row_score(row_score)
+            append_col_score(col_score)
+        score.append(current)
+        row_scores.append(current_row_scores)
+        col_scores.append(current_col_scores)
+
+    return score, row_scores, col_scores
+
+
+def __trace_pair(score: list, row_scores: list, col_scores: list, match: list, first_gap: float,
+                 extend_gap_score: float):
+    """
+    The trace bits of `__fill` for the cells of a single pair filled by `__fill_pair`, on demand.
+
+    Returns:
+    - `callable`: `trace(row, col)`, the trace bits of the cell (row and col at least 1)
+    """
+    precision = __PRECISION
+
+    def trace(row: int, col: int) -> int:
+        best_score_rint = int(score[row][col] * precision + 0.5)
+        cell_trace = 2 if int((score[row - 1][col - 1] + match[row - 1][col - 1]) * precision + 0.5) == \
+            best_score_rint else 0
+        row_score_rint = int(row_scores[row][col] * precision + 0.5)
+        if row_score_rint == best_score_rint:
+            if int((score[row][col - 1] + first_gap) * precision + 0.5) == row_score_rint:
+                cell_trace += 1
+            if int((row_scores[row][col - 1] + extend_gap_score) * precision + 0.5) == row_score_rint:
+                cell_trace += 8
+        col_score_rint = int(col_scores[row][col] * precision + 0.5)
+        if col_score_rint == best_score_rint:
+            if int((score[row - 1][col] + first_gap) * precision + 0.5) == col_score_rint:
+                cell_trace += 4
+            if int((col_scores[row - 1][col] + extend_gap_score) * precision + 0.5) == col_score_rint:
+                cell_trace += 16
+        return cell_trace
+
+    return trace
+
+
+def __traceback_pair(score: list, trace, word1, word2, penalties: list, gap):
+    """
+    `__traceback` for a single pair: the first alignment of pairwise2's depth-first traceback, found with the same
+    depth-first search. A cell whose options all lead to dead ends is remembered, so no cell is searched twice.
+
+    Returns:
+    - `tuple`: both aligned words as lists (`gap` for gaps), and whether there is an alignment
+    """
+    precision = __PRECISION
+    chosen, dead = {}, set()
+
+    def reach(row: int, col: int, col_gap: bool) -> bool:
+        # whether the origin can be reached from the cell with pairwise2's col_gap flag, choosing the first option
+        #   that can on the way
+        if col == 0:
+            return True
+        if row == 0:
+            return not col_gap
+        key = (row, col, col_gap)
+        if key in dead:
+            return False
+        cell_trace = trace(row, col)
+        if cell_trace & 1 and not col_gap and reach(row, col - 1, False):
+            chosen[key] = (row, col - 1, False)
+            return True
+        if cell_trace & 2 and reach(row - 1, col - 1, False):
+            chosen[key] = (row - 1, col - 1, False)
+            return True
+        if cell_trace & 4 and reach(row - 1, col, True):
+            chosen[key] = (row - 1, col, True)
+            return True
+        if cell_trace & 24:
+            # extended gaps: in word1 back to the border, in word2 from the longest, in word1 from the longest
+            target = int(score[row][col] * precision + 0.5)
+            row_gap = cell_trace & 8 and not col_gap
+            if row_gap and col >= 2 and int((score[row][0] + penalties[col]) * precision + 0.5) == target:
+                chosen[key] = (row, 0, False)
+                return True
+            if cell_trace & 16:
+                for start in range(row - 1):
+                    if int((score[start][col] + penalties[row - start]) * precision + 0.5) == target \
+                            and reach(start, col, True):
+                        chosen[key] = (start, col, True)
+                        return True
+            if row_gap:
+                for start in range(1, col - 1):
+                    if int((score[row][start] + penalties[col - start]) * precision + 0.5) == target \
+                            and reach(row, start, False):
+                        chosen[key] = (row, start, False)
+                        return True
+        dead.add(key)
+        return False
+
+    row, col = len(word1), len(word2)
+    if not reach(row, col, False):
+        return [], [], False
+    col_gap = False
+    reversed1, reversed2 = [], []
+    while row > 0 or col > 0:
+        if row == 0 or col == 0:
+            new_row, new_col = 0, 0
+        else:
+            new_row, new_col, col_gap = chosen[row, col, col_gap]
+        for step in range(max(row - new_row, col - new_col)):
+            reversed1.append(word1[row - 1 - step] if row > new_row else gap)
+            reversed2.append(word2[col - 1 - step] if col > new_col else gap)
+        row, col = new_row, new_col
+    return reversed1[::-1], reversed2[::-1], True
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import instrumentation
+import pmi_matrix_generator
+from cognate_corpus import CognateCorpus
+from language import Language
+from needleman_wunsch import pmi_array
+from pmi_matrix import PMIMatrix
+
+
+OBJECTIVE_CACHE_DIR = "./materials/objective_cache"
+DEFAULT_QUANTUM = 1e-6
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def reestimation_fingerprint(potential_cognates: CognateCorpus, char_counts: dict, num_characters: int,
+                             default_pmi_matrix: dict, num_iterations: int) -> str:
+    """
+    Hash of everything a re-estimated PMI matrix depends on, besides the gap scores and theta_pmi.
+
+    Returns:
+    - `str`: hex digest, the same for the same inputs in every run
+    """
+    digest = hashlib.sha256()
+    for word1, word2 in potential_cognates.pairs:
+        digest.update(f"{word1} {word2}\n".encode())
+    digest.update(np.asarray(potential_cognates.counts, dtype=np.int64).tobytes())
+    digest.update(json.dumps([sorted(char_counts.items()), num_characters, num_iterations]).encode())
+    digest.update(json.dumps(sorted((''.join(key), value) for key, value in default_pmi_matrix.items())).encode())
+    return digest.hexdigest()
+
+
+def objective_fingerprint(reestimation_key: str, language_pairs: list[tuple[Language, Language]]) -> str:
+    """Hash of everything the objective depends on: the re-estimation inputs and the sample of language pairs."""
+    digest = hashlib.sha256(reestimation_key.encode())
+    digest.update(json.dumps([[L1.name, L2.name] for L1, L2 in language_pairs]).encode())
+    return digest.hexdigest()
+
+
+class ObjectiveCache:
+    """
+    This class keeps re-estimated PMI matrices and objective values on disk, so points the optimizer has already
+    visited (in this run or in an earlier one) are not computed again.
+
+    Entries are keyed by a fingerprint of the inputs (see `reestimation_fingerprint` and `objective_fingerprint`)
+    and by the point, rounded to multiples of `quantum`: points closer than that share their entry. Every entry is a
+    small `.npy` file. Reading an entry marks it as used, and once the files take more than `max_bytes` the least
+    recently used ones are deleted.
+
+    State:
+    - `directory (str)`: where the entries are kept
+    - `quantum (float)`: resolution of the points
+    - `max_bytes (int)`: size bound of the directory
+    - `hits (int)`, `misses (int)`: lookups that found, or did not find, an entry
+
+    Constructor:
+    - `directory: str`, optional
+    - `quantum: float`, optional
+    - `max_bytes: int`, optional
+
+    Example:
+    ```py
+    cache = ObjectiveCache()
+    values = evaluate_objective(objective_pool, points, cache=cache)
+    print(cache.hits, cache.misses)
+    ```
+    """
+
+    def __init__(self, directory: str = OBJECTIVE_CACHE_DIR, quantum: float = DEFAULT_QUANTUM,
+                 max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.directory = directory
+        self.quantum = quantum
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def point_key(self, point) -> str:
+        """The point rounded to multiples of `quantum`, as it appears in file names."""
+        return '_'.join(str(int(round(float(value) / self.quantum))) for value in point)
+
+    def get_pmi_matrix(self, fingerprint: str, point) -> np.ndarray:
+        """The dense PMI matrix (see `needleman_wunsch.pmi_array`) stored for the point, or None."""
+        return self.__read(self.__path('pmi', fingerprint, point))
+
+    def put_pmi_matrix(self, fingerprint: str, point, pmi_matrix):
+        self.__write(self.__path('pmi', fingerprint, point), pmi_array(pmi_matrix))
+
+    def get_value(self, fingerprint: str, point) -> float:
+        """The objective value stored for the point, or None."""
+        value = self.__read(self.__path('objective', fingerprint, point))
+        return None if value is None else float(value)
+
+    def put_value(self, fingerprint: str, point, value: float):
+        self.__write(self.__path('objective', fingerprint, point), np.array(value, dtype=np.float64))
+
+    def __path(self, kind: str, fingerprint: str, point) -> str:
+        return os.path.join(self.directory, f"{kind}-{fingerprint[:32]}-{self.point_key(point)}.npy")
+
+    def __read(self, path: str) -> np.ndarray:
+        try:
+            array = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            instrumentation.count('objective cache misses')
+            return None
+        os.utime(path)
+        self.hits += 1
+        instrumentation.count('objective cache hits')
+        return array
+
+    def __write(self, path: str, array: np.ndarray):
+        # write next to the entry and rename, so an interrupted run never leaves half an entry behind
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(temporary_path, path)
+        self.__evict()
+
+    def __evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+
+
+def cached_reestimate_pmi_matrix(cache: ObjectiveCache, potential_cognates: CognateCorpus, open_gap_score: float,
+                                 extend_gap_score: float, theta_pmi: float, char_counts: dict, num_characters: int,
+                                 current_pmi_matrix, num_remaining: int = 10,
+                                 realignment_pool: pmi_matrix_generator.RealignmentPool = None) -> PMIMatrix:
+    """
+    `pmi_matrix_generator.reestimate_pmi_matrix`, read from the cache if this point was already re-estimated
+    from the same inputs, and stored in it otherwise. A `realignment_pool` is passed on to the re-estimation.
+
+    Returns:
+    - `PMIMatrix`: the re-estimated PMI matrix (a new matrix on a hit, as `reestimate_pmi_matrix` returns it otherwise)
+    """
+    fingerprint = reestimation_fingerprint(potential_cognates, char_counts, num_characters,
+                                           current_pmi_matrix, num_remaining)
+    point = (open_gap_score, extend_gap_score, theta_pmi)
+    pmi_matrix = cache.get_pmi_matrix(fingerprint, point)
+    if pmi_matrix is not None:
+        return PMIMatrix(pmi_matrix)
+
+    pmi_matrix = pmi_matrix_generator.reestimate_pmi_matrix(
+        potential_cognates, open_gap_score, extend_gap_score, theta_pmi,
+        char_counts, num_characters, current_pmi_matrix, num_remaining, realignment_pool=realignment_pool)
+    cache.put_pmi_matrix(fingerprint, point, pmi_matrix)
+    return pmi_matrix
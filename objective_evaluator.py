@@ -0,0 +1,239 @@
+import io
+import multiprocessing
+from collections import defaultdict
+from contextlib import redirect_stdout
+
+import numpy as np
+
+import instrumentation
+import pmi_matrix_generator
+from cognate_corpus import CognateCorpus
+from dERC_PMIcalculator import calculate_dERC_PMI_batch
+from language import Language
+from objective_cache import ObjectiveCache, objective_fingerprint, reestimation_fingerprint
+from pmi_matrix_generator import RealignmentPool, open_realignment_pool
+from pmi_matrix import PMIMatrix
+from wordstore import store_languages
+
+
+DEFAULT_NUM_ITERATIONS = 11
+# value of the objective for parameters it does not accept (positive gap scores)
+REJECTED_VALUE = 1
+
+# set in every worker process by __init_worker, so the corpus and the pair sample are only shipped once per worker
+__worker_store = None
+__worker_indices = None
+__worker_reestimation = None
+
+
+class ObjectivePool:
+    """
+    This class holds the worker processes that evaluate the optimizer's objective (see `open_objective_pool`),
+    and how the language pairs of the sample are split between them.
+
+    State:
+    - `pool (RealignmentPool)`: the workers, None when everything runs in this process. They realign the potential
+            cognates of a single point in parallel, and run the re-estimations and scoring of `evaluate_objective`.
+    - `num_pairs (int)`: number of language pairs the objective averages over
+    - `chunks (list[list[list[int]]])`: the positions in the sample of the pairs of every chunk, grouped by
+            first language
+    - `reestimation_key (str)`, `objective_key (str)`: fingerprints of the inputs, to key an `ObjectiveCache`
+    - `reestimation (tuple)`: the inputs of the re-estimation of a point, besides the point
+
+    Example:
+    ```py
+    with open_objective_pool(potential_cognates, language_pairs, char_counts, num_characters,
+                             default_pmi_matrix) as objective_pool:
+        values = evaluate_objective(objective_pool, [[-2.5, -1.7, 4.4], [-2.0, -1.0, 7.0]])
+    ```
+    """
+
+    def __init__(self, pool: RealignmentPool, num_pairs: int, chunks: list, reestimation_key: str,
+                 objective_key: str, reestimation: tuple = None) -> None:
+        self.pool = pool
+        self.num_pairs = num_pairs
+        self.chunks = chunks
+        self.reestimation_key = reestimation_key
+        self.objective_key = objective_key
+        self.reestimation = reestimation
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+def open_objective_pool(potential_cognates: CognateCorpus, language_pairs: list[tuple[Language, Language]],
+                        char_counts: dict, num_characters: int, default_pmi_matrix: dict,
+                        num_iterations: int = DEFAULT_NUM_ITERATIONS, num_workers: int = None) -> ObjectivePool:
+    """
+    Start the workers that evaluate the objective of the gap/theta optimization.
+
+    The objective of a point (open_gap_score, extend_gap_score, theta_pmi) re-estimates the PMI matrix from the
+    default matrix (`pmi_matrix_generator.reestimate_pmi_matrix`) and averages the dERC/PMI of the sampled language
+    pairs with it. The workers are those of a `RealignmentPool` over the potential cognates, which realign a single
+    point in parallel: the re-estimation inputs and the pairs (as a WordStore) are sent to every worker once,
+    through its initializer, and stay there for every evaluation. One set of `num_workers` processes serves both.
+
+    Parameters:
+    - `potential_cognates (CognateCorpus)`: the corpus the PMI matrix is re-estimated from
+    - `language_pairs (list[tuple[Language, Language]])`: the sample of language pairs to average over
+    - `char_counts, num_characters, default_pmi_matrix`: see `pmi_matrix_generator.reestimate_pmi_matrix`
+    - `num_iterations (int, optional)`: re-estimations per point
+    - `num_workers (int, optional)`: number of worker processes. Defaults to the number of CPU cores,
+            1 evaluates everything in this process.
+
+    Returns:
+    - `ObjectivePool`: the workers, to pass to `evaluate_objective` and close when done
+    """
+    store, indices = store_languages([language for pair in language_pairs for language in pair])
+    reestimation = (potential_cognates, char_counts, num_characters, PMIMatrix.of(default_pmi_matrix).copy(),
+                    num_iterations)
+    num_workers = num_workers or multiprocessing.cpu_count()
+
+    # pairs that share their first language are scored in one batch
+    groups = defaultdict(list)
+    for position, first_language in enumerate(indices[0::2].tolist()):
+        groups[first_language].append(position)
+    groups = list(groups.values())
+    chunks = [chunk.tolist() for chunk in np.array_split(np.arange(len(groups)), min(len(groups), 4 * num_workers))
+              if len(chunk)]
+    chunks = [[groups[group] for group in chunk] for chunk in chunks]
+
+    reestimation_key = reestimation_fingerprint(potential_cognates, char_counts, num_characters,
+                                                default_pmi_matrix, num_iterations)
+    objective_key = objective_fingerprint(reestimation_key, language_pairs)
+
+    if num_workers == 1:
+        __init_worker(store, indices, reestimation)
+        return ObjectivePool(None, len(language_pairs), chunks, reestimation_key, objective_key)
+    pool = open_realignment_pool(potential_cognates, num_workers, initializer=__init_worker,
+                                 initargs=(store, indices, reestimation))
+    return ObjectivePool(pool, len(language_pairs), chunks, reestimation_key, objective_key, reestimation)
+
+
+def evaluate_objective(objective_pool: ObjectivePool, points, cache: ObjectiveCache = None) -> np.ndarray:
+    """
+    Evaluate the objective at several points at once.
+
+    The PMI matrices of all points are re-estimated in parallel (one point per worker, or, with fewer points than
+    workers, one point after the other with its potential cognates realigned by all workers), then the dERC/PMI of
+    every (point, chunk of language pairs) is scored in parallel. Every point gets the value the sequential objective
+    would give: the dERC/PMI of the pairs are summed in sample order.
+
+    With a `cache`, points whose value is stored are not evaluated, and points whose PMI matrix is stored are not
+    re-estimated. Whatever is computed is stored.
+
+    Parameters:
+    - `objective_pool (ObjectivePool)`: see `open_objective_pool`
+    - `points`: (open_gap_score, extend_gap_score, theta_pmi) of every point
+    - `cache (ObjectiveCache, optional)`: values and PMI matrices of points evaluated before
+
+    Returns:
+    - `np.ndarray`: mean dERC/PMI of the sampled pairs at every point, `REJECTED_VALUE` for points with a positive
+            gap score
+    """
+    points = [tuple(float(value) for value in point) for point in points]
+    values = np.full(len(points), float(REJECTED_VALUE))
+    accepted = [number for number, (open_gap_score, extend_gap_score, _) in enumerate(points)
+                if not (open_gap_score > 0 or extend_gap_score > 0)]
+    if cache is not None:
+        cached_values = {number: cache.get_value(objective_pool.objective_key, points[number]) for number in accepted}
+        for number, value in cached_values.items():
+            if value is not None:
+                values[number] = value
+        accepted = [number for number in accepted if cached_values[number] is None]
+    if not accepted:
+        return values
+
+    pool = objective_pool.pool
+    map_function = map if pool is None else pool.map
+    pmi_matrices = {}
+    if cache is not None:
+        for number in accepted:
+            pmi_matrix = cache.get_pmi_matrix(objective_pool.reestimation_key, points[number])
+            if pmi_matrix is not None:
+                pmi_matrices[number] = pmi_matrix
+    missing = [number for number in accepted if number not in pmi_matrices]
+    if pool is not None and len(missing) < len(pool.processes):
+        # Nelder-Mead evaluates one point at a time: spread its realignment over the workers instead
+        reestimated = (__reestimate_in_process(objective_pool, points[number]) for number in missing)
+    else:
+        reestimated = map_function(__reestimate, [points[number] for number in missing])
+    with instrumentation.stage('objective: reestimate PMI matrices'):
+        for number, pmi_matrix in zip(missing, reestimated):
+            pmi_matrices[number] = pmi_matrix
+            if cache is not None:
+                cache.put_pmi_matrix(objective_pool.reestimation_key, points[number], pmi_matrix)
+
+    tasks = [(number, pmi_matrices[number], points[number][0], points[number][1], chunk)
+             for number in accepted
+             for chunk in objective_pool.chunks]
+    scores = {number: np.zeros(objective_pool.num_pairs) for number in accepted}
+    with instrumentation.stage('objective: score language pairs'):
+        for number, positions, pair_scores in (map(__score_chunk, tasks) if pool is None
+                                               else pool.imap_unordered(__score_chunk, tasks)):
+            scores[number][positions] = pair_scores
+
+    for number in accepted:
+        total_score = 0
+        for score in scores[number].tolist():
+            total_score += score
+        values[number] = total_score / objective_pool.num_pairs
+        if cache is not None:
+            cache.put_value(objective_pool.objective_key, points[number], values[number])
+    return values
+
+
+def __init_worker(store, indices: np.ndarray, reestimation: tuple):
+    global __worker_store, __worker_indices, __worker_reestimation
+    __worker_store = store
+    __worker_indices = indices
+    __worker_reestimation = reestimation
+
+
+def __reestimate(point: tuple[float, float, float]) -> np.ndarray:
+    """Re-estimate the PMI matrix of one point from the default matrix, as a dense array."""
+    open_gap_score, extend_gap_score, theta_pmi = point
+    potential_cognates, char_counts, num_characters, default_pmi_matrix, num_iterations = __worker_reestimation
+    # the progress of the re-estimation would interleave between workers
+    with redirect_stdout(io.StringIO()):
+        pmi_matrix = pmi_matrix_generator.reestimate_pmi_matrix(
+            potential_cognates, open_gap_score, extend_gap_score, theta_pmi,
+            char_counts, num_characters, default_pmi_matrix.copy(), num_iterations)
+    return pmi_matrix.scores
+
+
+def __reestimate_in_process(objective_pool: ObjectivePool, point: tuple[float, float, float]) -> np.ndarray:
+    """Re-estimate the PMI matrix of one point in this process, realigning with the workers of the pool."""
+    open_gap_score, extend_gap_score, theta_pmi = point
+    potential_cognates, char_counts, num_characters, default_pmi_matrix, num_iterations = objective_pool.reestimation
+    with redirect_stdout(io.StringIO()):
+        pmi_matrix = pmi_matrix_generator.reestimate_pmi_matrix(
+            potential_cognates, open_gap_score, extend_gap_score, theta_pmi,
+            char_counts, num_characters, default_pmi_matrix.copy(), num_iterations,
+            realignment_pool=objective_pool.pool)
+    return pmi_matrix.scores
+
+
+def __score_chunk(task: tuple) -> tuple[int, list[int], np.ndarray]:
+    """
+    Score the language pairs of one chunk with the PMI matrix of one point.
+
+    Returns:
+    - `tuple[int, list[int], np.ndarray]`: the point, the positions of the pairs in the sample and their dERC/PMI
+    """
+    number, pmi_matrix, open_gap_score, extend_gap_score, chunk = task
+    positions, pair_scores = [], []
+    for pair_positions in chunk:
+        first = __worker_store[int(__worker_indices[2 * pair_positions[0]])]
+        others = [__worker_store[int(__worker_indices[2 * position + 1])] for position in pair_positions]
+        pair_scores.append(calculate_dERC_PMI_batch(first, others, pmi_matrix, open_gap_score, extend_gap_score))
+        positions.extend(pair_positions)
+    return number, positions, np.concatenate(pair_scores)
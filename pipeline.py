@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import pickle
+
+import instrumentation
+
+
+PIPELINE_DIR = "./materials/pipeline"
+
+
+class ArtifactFormat:
+    """
+    This class describes how the artifact of a stage is written to and read from disk.
+
+    State:
+    - `extension (str)`: file extension of the artifact
+    - `save (callable)`: `save(artifact, path)` writes the artifact
+    - `load (callable)`: `load(path)` reads it back
+    - `files (callable)`: `files(path)` lists every file `save` writes, they are all content-hashed
+
+    Constructor:
+    - `extension: str`
+    - `save: callable`
+    - `load: callable`
+    - `files: callable`, optional: `[path]` by default
+    """
+
+    def __init__(self, extension: str, save, load, files=None) -> None:
+        self.extension = extension
+        self.save = save
+        self.load = load
+        self.files = files if files is not None else (lambda path: [path])
+
+
+def __save_pickle(artifact, path: str):
+    with open(path, 'wb') as file:
+        pickle.dump(artifact, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def __load_pickle(path: str):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+PICKLE = ArtifactFormat('.pkl', __save_pickle, __load_pickle)
+
+
+class Stage:
+    """
+    This class holds one named step of a pipeline.
+
+    State:
+    - `name (str)`: name of the stage, and of its artifact
+    - `function (callable)`: called as `function(*input artifacts, **params)`, returns the artifact
+    - `inputs (tuple[str, ...])`: names of the stages whose artifacts the function takes
+    - `params (dict)`: keyword arguments of the function, JSON-serializable
+    - `files (tuple[str, ...])`: files the function reads, their content is part of the stage's key
+    - `artifact_format (ArtifactFormat)`: how the artifact is stored
+    - `version (str)`: change it to re-run the stage after changing its code
+    """
+
+    def __init__(self, name: str, function, inputs=(), params: dict = None, files=(),
+                 artifact_format: ArtifactFormat = PICKLE, version: str = '1') -> None:
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.params = dict(params or {})
+        self.files = tuple(files)
+        self.artifact_format = artifact_format
+        self.version = version
+
+
+class Pipeline:
+    """
+    This class runs named stages and keeps their artifacts on disk, so a stage only runs again when what it
+    depends on changed.
+
+    Every stage has a key: a hash of its name, version and params, the content of the files it reads, and the
+    content hashes of the artifacts of its inputs. After a stage runs, its artifact is saved in `directory` with a
+    manifest recording the key and a hash of the artifact's content. A stage whose manifest has the current key is
+    up to date and is skipped. Since keys are built on content, a stage that re-runs and produces the same artifact
+    does not invalidate the stages after it.
+
+    Artifacts are loaded lazily: running an up-to-date pipeline loads nothing, and `pipeline[name]` reads just that
+    artifact (once).
+
+    State:
+    - `directory (str)`: where the artifacts and manifests are kept
+    - `stages (dict[str, Stage])`: the stages, by name
+
+    Constructor:
+    - `directory: str`, optional
+
+    Example:
+    ```py
+    pipeline = Pipeline()
+    pipeline.add_stage(Stage('sets', load_sets, files=['./materials/training_set.json']))
+    pipeline.add_stage(Stage('cognates', generate_cognates, inputs=['sets'], params={'theta_dERC': 0.65}))
+    pipeline.run()                  # runs only what changed
+    cognates = pipeline['cognates']  # read from disk
+    ```
+    """
+
+    def __init__(self, directory: str = PIPELINE_DIR) -> None:
+        self.directory = directory
+        self.stages = {}
+        self.__artifacts = {}
+        self.__content_hashes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def add_stage(self, stage: Stage) -> Stage:
+        for input_name in stage.inputs:
+            if input_name not in self.stages:
+                raise ValueError(f"Stage '{stage.name}' takes '{input_name}', which is not a stage (yet).")
+        self.stages[stage.name] = stage
+        return stage
+
+    def run(self, *names: str):
+        """Bring the given stages (every stage by default) and the stages they depend on up to date."""
+        for name in names or list(self.stages):
+            self.__ensure(name)
+
+    def is_up_to_date(self, name: str) -> bool:
+        """Whether the stage and every stage it depends on would be skipped."""
+        stage = self.stages[name]
+        if not all(self.is_up_to_date(input_name) for input_name in stage.inputs):
+            return False
+        manifest = self.__read_manifest(name)
+        return manifest is not None and manifest['key'] == self.__key(stage, [
+            self.__read_manifest(input_name)['content'] for input_name in stage.inputs])
+
+    def store(self, name: str, artifact):
+        """
+        Record an artifact computed outside the stage's function (updated incrementally, say) as the current
+        artifact of the stage, as if the stage had just produced it from its current inputs. The stages after it
+        are no longer up to date if its content changed.
+        """
+        stage = self.stages[name]
+        key = self.__key(stage, [self.__ensure(input_name) for input_name in stage.inputs])
+        self.__forget_dependents(name)
+        self.__content_hashes[name] = self.__save(stage, key, artifact)
+        self.__artifacts[name] = artifact
+
+    def __getitem__(self, name: str):
+        if name not in self.__artifacts:
+            self.__ensure(name)
+        if name not in self.__artifacts:
+            stage = self.stages[name]
+            self.__artifacts[name] = stage.artifact_format.load(self.__artifact_path(stage))
+        return self.__artifacts[name]
+
+    def __ensure(self, name: str) -> str:
+        """Run the stage if it is out of date, and return the content hash of its artifact."""
+        if name in self.__content_hashes:
+            return self.__content_hashes[name]
+        stage = self.stages[name]
+        key = self.__key(stage, [self.__ensure(input_name) for input_name in stage.inputs])
+
+        manifest = self.__read_manifest(name)
+        path = self.__artifact_path(stage)
+        if manifest is not None and manifest['key'] == key \
+                and all(os.path.exists(file) for file in stage.artifact_format.files(path)):
+            instrumentation.log('pipeline stage skipped', f"stage '{name}' is up to date", stage=name)
+            content_hash = manifest['content']
+        else:
+            inputs = [self[input_name] for input_name in stage.inputs]
+            instrumentation.log('pipeline stage started', f"running stage '{name}'", stage=name)
+            with instrumentation.stage(f"pipeline stage {name}"):
+                artifact = stage.function(*inputs, **stage.params)
+            content_hash = self.__save(stage, key, artifact)
+            self.__artifacts[name] = artifact
+
+        self.__content_hashes[name] = content_hash
+        return content_hash
+
+    def __save(self, stage: Stage, key: str, artifact) -> str:
+        """Save the artifact of a stage and its manifest, and return the content hash of the artifact."""
+        path = self.__artifact_path(stage)
+        stage.artifact_format.save(artifact, path)
+        content_hash = self.__hash_files(stage.artifact_format.files(path))
+        # the manifest is written last, so an interrupted stage runs again
+        with open(self.__manifest_path(stage.name), 'w') as file:
+            json.dump({'key': key, 'content': content_hash}, file)
+        return content_hash
+
+    def __forget_dependents(self, name: str):
+        """Drop what is known of the stages that take the artifact of `name`, directly or not, so they are checked again."""
+        for stage in self.stages.values():
+            if name in stage.inputs:
+                self.__content_hashes.pop(stage.name, None)
+                self.__artifacts.pop(stage.name, None)
+                self.__forget_dependents(stage.name)
+
+    def __key(self, stage: Stage, input_hashes: list[str]) -> str:
+        return hashlib.sha256(json.dumps({
+            'name': stage.name,
+            'version': stage.version,
+            'params': stage.params,
+            'files': [self.__hash_files([file]) for file in stage.files],
+            'inputs': input_hashes,
+        }, sort_keys=True, default=str).encode()).hexdigest()
+
+    def __artifact_path(self, stage: Stage) -> str:
+        return os.path.join(self.directory, stage.name + stage.artifact_format.extension)
+
+    def __manifest_path(self, name: str) -> str:
+        return os.path.join(self.directory, name + '.json')
+
+    def __read_manifest(self, name: str) -> dict:
+        try:
+            with open(self.__manifest_path(name), 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def __hash_files(paths: list[str]) -> str:
+        digest = hashlib.sha256()
+        for path in paths:
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+        return digest.hexdigest()
+
@@ -0,0 +1,174 @@
+import math
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from wordstore import CHAR_CODES, CHARS, NUM_SYMBOLS
+
+
+PMI_MATRIX_PATH = "./materials/pmi_matrix.npy"
+
+
+class PMIMatrix(MutableMapping):
+    """
+    This class holds a PMI matrix as a dense symmetric (NUM_SYMBOLS x NUM_SYMBOLS) array indexed by symbol codes,
+    so a score is read with one array lookup in either order of the characters, and whole matrices are updated
+    with array operations.
+
+    It is also a mapping with the keys of the `dict[tuple[str, str], float]` PMI matrices it replaces (sorted
+    character pairs), so code written for those keeps working: `matrix[('a', 'p')]`, `matrix.get(...)`,
+    `dict(matrix)` and `matrix == pmi_dict` all behave as with the dict. Lookups also accept unsorted pairs.
+    Pairs without a score are NaN in the array and missing from the mapping.
+
+    State:
+    - `scores (np.ndarray)`: the symmetric float64 array, NaN where a pair has no score
+
+    Constructor:
+    - `scores: np.ndarray`, optional: copied and made symmetric from its upper triangle. Empty by default.
+
+    Example:
+    ```py
+    matrix = PMIMatrix.from_dict({('a', 'p'): -1.5, ('p', 'p'): 3.4})
+    print(matrix[('p', 'a')], matrix.scores[CHAR_CODES['a'], CHAR_CODES['p']])  # -1.5 -1.5
+    matrix.save(PMI_MATRIX_PATH)
+    ```
+    """
+
+    # every unordered pair of symbol codes once (code1 <= code2), in the order the dict PMI matrices were built
+    __UPPER = np.triu_indices(NUM_SYMBOLS)
+
+    def __init__(self, scores: np.ndarray = None) -> None:
+        if scores is None:
+            self.scores = np.full((NUM_SYMBOLS, NUM_SYMBOLS), np.nan)
+            return
+        scores = np.array(scores, dtype=np.float64)
+        if scores.shape != (NUM_SYMBOLS, NUM_SYMBOLS):
+            raise ValueError(f"A PMI matrix is {NUM_SYMBOLS}x{NUM_SYMBOLS}, not {'x'.join(map(str, scores.shape))}.")
+        upper = np.triu(np.ones(scores.shape, dtype=bool))
+        self.scores = np.where(upper, scores, scores.T)
+
+    @classmethod
+    def from_dict(cls, pmi_matrix: dict[tuple[str, str], float]) -> 'PMIMatrix':
+        """Build the matrix of a `dict[tuple[str, str], float]` PMI matrix. Keys with non-ASCIIPMA symbols are ignored."""
+        matrix = cls()
+        for (char1, char2), score in pmi_matrix.items():
+            code1, code2 = CHAR_CODES.get(char1), CHAR_CODES.get(char2)
+            if code1 is not None and code2 is not None:
+                matrix.scores[code1, code2] = matrix.scores[code2, code1] = score
+        return matrix
+
+    @classmethod
+    def of(cls, pmi_matrix) -> 'PMIMatrix':
+        """`pmi_matrix` itself if it is a PMIMatrix, otherwise a new one built from a dict or a dense array."""
+        if isinstance(pmi_matrix, PMIMatrix):
+            return pmi_matrix
+        if isinstance(pmi_matrix, np.ndarray):
+            return cls(pmi_matrix)
+        return cls.from_dict(pmi_matrix)
+
+    @classmethod
+    def from_counts(cls, counts: np.ndarray, char_counts: dict[str, int], num_characters: int,
+                    unaligned: str = 'missing', num_alignments: int = None) -> 'PMIMatrix':
+        """
+        The PMI of every pair of characters, from how often they were aligned.
+
+        The PMI of characters a and b is `log(s_ab / (q_a * q_b))`, with `s_ab` the fraction of the aligned character
+        pairs that are (a, b) and `q_a`, `q_b` the frequencies of a and b in the corpus.
+
+        Parameters:
+        - `counts (np.ndarray)`: (NUM_SYMBOLS x NUM_SYMBOLS) number of times the first character of an alignment
+                (row) was aligned with the second (column). Both orders count for the same pair, so the counts can be
+                in either triangle or spread over both.
+        - `char_counts (dict[str, int])`: number of occurrences of every character in the corpus
+        - `num_characters (int)`: number of characters in the corpus
+        - `unaligned (str, optional)`: what pairs that were never aligned get: 'missing' leaves them without a
+                score, 'smoothed' scores them as if aligned once with one more occurrence of both characters
+                (`log(1 / ((q_a + 1) * (q_b + 1)))`, the default matrix of driver.py)
+        - `num_alignments (int, optional)`: the total of `counts`, if the counting kernel already has it
+
+        Returns:
+        - `PMIMatrix`: the matrix
+        """
+        matrix = cls()
+        matrix.update_from_counts(counts, char_counts, num_characters, num_alignments)
+        if unaligned == 'smoothed':
+            frequencies = cls.__frequencies(char_counts, num_characters) + 1
+            never_aligned = np.isnan(matrix.scores)
+            matrix.scores[never_aligned] = [math.log(1 / product) for product in
+                                            np.outer(frequencies, frequencies)[never_aligned].tolist()]
+        elif unaligned != 'missing':
+            raise ValueError(f"unaligned is 'missing' or 'smoothed', not {unaligned!r}.")
+        return matrix
+
+    def update_from_counts(self, counts: np.ndarray, char_counts: dict[str, int], num_characters: int,
+                           num_alignments: int = None):
+        """
+        Set the PMI of every pair of characters that was aligned at least once (see `from_counts`), in place.
+        The scores of the other pairs are kept.
+        """
+        counts = np.asarray(counts)
+        pair_counts = counts + counts.T - np.diag(counts.diagonal())
+        if num_alignments is None:
+            num_alignments = int(counts.sum())
+        if num_alignments == 0:
+            return
+        aligned = pair_counts > 0
+        frequencies = self.__frequencies(char_counts, num_characters)
+        # the log-ratio of every aligned pair at once. math.log rather than np.log, whose SIMD version can be an ulp
+        #   off: the scores are bit for bit those of the dict matrices (at most 861 of them)
+        ratios = (pair_counts / num_alignments) / np.outer(frequencies, frequencies)
+        self.scores[aligned] = [math.log(ratio) for ratio in ratios[aligned].tolist()]
+
+    def score(self, char1: str, char2: str) -> float:
+        """The PMI of two characters in either order, NaN if the pair has no score."""
+        return float(self.scores[CHAR_CODES[char1], CHAR_CODES[char2]])
+
+    def copy(self) -> 'PMIMatrix':
+        return PMIMatrix(self.scores)
+
+    def as_dict(self) -> dict[tuple[str, str], float]:
+        """The `dict[tuple[str, str], float]` PMI matrix (sorted character pairs as keys, no NaN entries)."""
+        return dict(self.items())
+
+    def save(self, path: str = PMI_MATRIX_PATH):
+        """Write the array as a `.npy` file (13 KB, read back with `load`)."""
+        with open(path, 'wb') as file:
+            np.save(file, self.scores)
+
+    @classmethod
+    def load(cls, path: str = PMI_MATRIX_PATH) -> 'PMIMatrix':
+        """Read a matrix written by `save`."""
+        return cls(np.load(path))
+
+    def __getitem__(self, key: tuple[str, str]) -> float:
+        char1, char2 = key
+        score = self.scores[CHAR_CODES[char1], CHAR_CODES[char2]]
+        if score != score:
+            raise KeyError(key)
+        return float(score)
+
+    def __setitem__(self, key: tuple[str, str], score: float):
+        char1, char2 = key
+        code1, code2 = CHAR_CODES[char1], CHAR_CODES[char2]
+        self.scores[code1, code2] = self.scores[code2, code1] = score
+
+    def __delitem__(self, key: tuple[str, str]):
+        self[key]
+        self[key] = np.nan
+
+    def __iter__(self):
+        has_score = ~np.isnan(self.scores[self.__UPPER])
+        for code1, code2 in zip(self.__UPPER[0][has_score].tolist(), self.__UPPER[1][has_score].tolist()):
+            char1, char2 = CHARS[code1], CHARS[code2]
+            yield (char1, char2) if char1 <= char2 else (char2, char1)
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(~np.isnan(self.scores[self.__UPPER])))
+
+    def __repr__(self) -> str:
+        return f"PMIMatrix({self.as_dict()!r})"
+
+    @staticmethod
+    def __frequencies(char_counts: dict[str, int], num_characters: int) -> np.ndarray:
+        """Frequency of every symbol code in the corpus."""
+        return np.array([char_counts.get(char, 0) / num_characters for char in CHARS])
@@ -1,63 +1,372 @@
-import align
-import math
-from collections import Counter
+import multiprocessing
+from multiprocessing.connection import wait
 
+import numpy as np
 
-def reestimate_pmi_matrix(potential_cognates: list[tuple[str, str]], open_gap_score: float, extend_gap_score: float, theta_pmi: float, char_counts: dict, num_characters: int, current_pmi_matrix, num_remaining=10):
-    print(f"number remaining: {num_remaining}")
+import instrumentation
+from cognate_corpus import CognateCorpus
+from needleman_wunsch import align_batch, encode_pairs
+from pmi_matrix import PMIMatrix
+from wordstore import GAP, NUM_SYMBOLS
 
-    # pick out what will be used to reestimate
-    aligned_cognate_pairs_within_threshold = []
 
-    # alignment cache for each loop
-    alignment_cache = {}
-    alignment_cache.clear()
+def reestimate_pmi_matrix(potential_cognates: CognateCorpus, open_gap_score: float, extend_gap_score: float, theta_pmi: float, char_counts: dict, num_characters: int, current_pmi_matrix, num_remaining=10, tolerance: float = 0.0, realignment_pool: 'RealignmentPool' = None):
+    """
+    Re-estimate the PMI matrix from the potential cognates, up to `num_remaining` times (EM style: align with the
+    current matrix, keep the probable cognates, count their aligned characters, update the matrix, repeat).
 
-    # align cognates (get probable cognates) using past pmi matrix
-    for cognate_pair in potential_cognates:
-        cognate_pair = tuple(sorted(cognate_pair))
-        cache_key = tuple(cognate_pair)
-        if cache_key not in alignment_cache:
-            pair_pmi_score, (aligned_pair) = align.get_PMI(
-                cognate_pair[0], cognate_pair[1],
-                current_pmi_matrix,
-                open_gap_score, extend_gap_score)
-            alignment_cache[cache_key] = (pair_pmi_score, aligned_pair)
+    Every distinct (sorted) pair is aligned once, and its score and aligned characters are kept between iterations.
+    A pair is only realigned when one of the character pairs it could align (a character of its first word with a
+    character of its second word) moved by more than `tolerance` since the pair was last aligned: otherwise its
+    alignment cannot have changed. Once no character pair moves by more than `tolerance`, the matrix has converged
+    and the remaining iterations are skipped.
+
+    With `tolerance=0` the result is exactly that of running all `num_remaining` iterations on every pair.
+
+    Parameters:
+    - `potential_cognates (CognateCorpus | list[tuple[str, str]])`: the weighted potential cognates (see
+            `potential_cognates_generator.generate_weighted_cognates`), or a flat list of them in which duplicates
+            count as often as they appear
+    - `open_gap_score, extend_gap_score (float)`: gap penalties of the alignments
+    - `theta_pmi (float)`: pairs that align with a score below this are not counted
+    - `char_counts (dict)`: number of occurrences of every character in the corpus
+    - `num_characters (int)`: number of characters in the corpus
+    - `current_pmi_matrix (PMIMatrix | dict)`: the matrix to start from, updated in place if it is a PMIMatrix
+    - `num_remaining (int, optional)`: most re-estimations to run
+    - `tolerance (float, optional)`: smallest change of a PMI value that triggers realignment
+    - `realignment_pool (RealignmentPool, optional)`: workers that hold the same potential cognates (see
+            `open_realignment_pool`) and realign them in parallel. Everything runs in this process by default.
+
+    Returns:
+    - `PMIMatrix`: the re-estimated PMI matrix (`current_pmi_matrix`, or a new matrix if it was a dict)
+    """
+    if not isinstance(potential_cognates, CognateCorpus):
+        potential_cognates = CognateCorpus.from_pairs(potential_cognates)
+    if realignment_pool is None:
+        cognates = AlignedCognates(potential_cognates)
+    elif realignment_pool.potential_cognates.pairs != potential_cognates.pairs:
+        raise ValueError("The realignment pool holds other potential cognates.")
+    else:
+        cognates = realignment_pool
+
+    pmi_matrix = PMIMatrix.of(current_pmi_matrix)
+    aligned_with = pmi_matrix.scores.copy()
+    # the first round aligns every pair
+    moved = None
+    for remaining in range(num_remaining, 0, -1):
+        with instrumentation.stage('realign potential cognates'):
+            counts, num_alignments, num_realigned = cognates.round(pmi_matrix.scores, open_gap_score,
+                                                                   extend_gap_score, theta_pmi, moved)
+        instrumentation.log('reestimation iteration',
+                            f"number remaining: {remaining} (realigned {num_realigned} / {len(potential_cognates)} "
+                            f"pairs)",
+                            remaining=remaining, realigned=num_realigned, pairs=len(potential_cognates))
+
+        # the probable cognates are used to re-estimate the pmi_matrix
+        with instrumentation.stage('update PMI matrix'):
+            pmi_matrix.update_from_counts(counts, char_counts, num_characters, num_alignments)
+
+        current = pmi_matrix.scores
+        moved = ~(np.abs(current - aligned_with) <= tolerance) & ~(np.isnan(current) & np.isnan(aligned_with))
+        if not moved.any():
+            instrumentation.log('reestimation converged', f"converged, {remaining - 1} re-estimations skipped",
+                                skipped=remaining - 1)
+            break
+        aligned_with[moved] = current[moved]
+
+    return pmi_matrix
+
+
+class AlignedCognates:
+    """
+    This class holds encoded potential cognates with their current alignments, kept between the rounds of a
+    re-estimation so that only the pairs whose alignment can change are realigned.
+
+    State:
+    - `codes1, lengths1, codes2, lengths2 (np.ndarray)`: the encoded words of every pair (see
+            `needleman_wunsch.encode_pairs`)
+    - `weights (np.ndarray)`: number of times every pair appears among the potential cognates
+    - `has_char1, has_char2 (np.ndarray)`: (pairs x NUM_SYMBOLS) mask of the characters of every first and second word
+    - `pair_pmi_scores (np.ndarray)`: score of the current alignment of every pair (-200 if it has none)
+    - `aligned1, aligned2 (np.ndarray)`: (pairs x longest possible alignment) codes of the current alignments,
+            padded with `wordstore.GAP`
+
+    Constructor:
+    - `potential_cognates: CognateCorpus`
+
+    Example:
+    ```py
+    cognates = AlignedCognates(potential_cognates)
+    counts, num_alignments, _ = cognates.round(pmi_matrix.scores, -2.4, -1.3, 7.5)
+    pmi_matrix.update_from_counts(counts, char_counts, num_characters, num_alignments)
+    ```
+    """
+
+    def __init__(self, potential_cognates: CognateCorpus) -> None:
+        self.codes1, self.lengths1, self.codes2, self.lengths2 = encode_pairs(potential_cognates.pairs)
+        self.weights = potential_cognates.counts
+        self.has_char1 = self.__characters_present(self.codes1, self.lengths1)
+        self.has_char2 = self.__characters_present(self.codes2, self.lengths2)
+        self.pair_pmi_scores = np.zeros(len(self.lengths1))
+        width = int((self.lengths1 + self.lengths2).max(initial=0))
+        self.aligned1 = np.full((len(self.lengths1), width), GAP, dtype=np.uint8)
+        self.aligned2 = np.full((len(self.lengths1), width), GAP, dtype=np.uint8)
+
+    def round(self, pmi_scores: np.ndarray, open_gap_score: float, extend_gap_score: float, theta_pmi: float,
+              moved: np.ndarray = None) -> tuple[np.ndarray, int, int]:
+        """
+        One round of the re-estimation: realign the pairs an alignment of which can have changed, and count the
+        aligned characters of the probable cognates.
+
+        Parameters:
+        - `pmi_scores (np.ndarray)`: the dense PMI matrix to align with
+        - `open_gap_score, extend_gap_score, theta_pmi (float)`: see `reestimate_pmi_matrix`
+        - `moved (np.ndarray, optional)`: (NUM_SYMBOLS x NUM_SYMBOLS) mask of the character pairs whose score changed
+                since the last round. Every pair is realigned without it.
+
+        Returns:
+        - `tuple[np.ndarray, int, int]`: the counts and number of aligned character pairs of the probable cognates
+                (see `count_aligned_characters`), and the number of pairs that were realigned
+        """
+        if moved is None:
+            realign = np.ones(len(self.lengths1), dtype=bool)
         else:
+            # a pair can align code1 with code2 if code1 is in its first word and code2 in its second
+            realign = ((self.has_char1.astype(np.float32) @ moved.astype(np.float32)) * self.has_char2).sum(axis=1) > 0
+        pairs = np.nonzero(realign)[0]
+        if len(pairs):
+            scores, aligned1, aligned2, _, found = align_batch(
+                self.codes1[pairs], self.lengths1[pairs], self.codes2[pairs], self.lengths2[pairs], pmi_scores,
+                open_gap_score, extend_gap_score)
+            # pairs without an alignment (an empty word) count as -200 and align no characters
+            self.pair_pmi_scores[pairs] = np.where(found, scores, -200)
+            self.aligned1[pairs], self.aligned2[pairs] = GAP, GAP
+            self.aligned1[pairs, :aligned1.shape[1]] = np.where(found[:, None], aligned1, GAP)
+            self.aligned2[pairs, :aligned2.shape[1]] = np.where(found[:, None], aligned2, GAP)
 
-            pair_pmi_score, aligned_pair = alignment_cache[cache_key]
+        probable = self.pair_pmi_scores >= theta_pmi
+        counts, num_alignments = count_aligned_characters(self.aligned1[probable], self.aligned2[probable],
+                                                          self.weights[probable])
+        return counts, num_alignments, len(pairs)
 
-        if pair_pmi_score >= theta_pmi:
-            # this is used to generate this PMI matrix
-            aligned_cognate_pairs_within_threshold.append(aligned_pair)
+    @staticmethod
+    def __characters_present(codes: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        """(words x NUM_SYMBOLS) mask of the characters that appear in every word."""
+        present = np.zeros((len(lengths), NUM_SYMBOLS + 1), dtype=bool)
+        in_word = np.arange(codes.shape[1])[None, :] < lengths[:, None]
+        present[np.arange(len(lengths))[:, None], np.where(in_word, codes, NUM_SYMBOLS)] = True
+        return present[:, :NUM_SYMBOLS]
 
-    # the probable cognates are be used to re-estimate the pmi_matrix
-    num_alignments = 0
-    valid_alignments_count = Counter()
-    for aligned_pair in aligned_cognate_pairs_within_threshold:
-        word1, word2 = aligned_pair
-        for char1, char2 in zip(word1, word2):
 
-            if char1 == '-' or char2 == '-':
-                continue
+class RealignmentPool:
+    """
+    This class holds worker processes that each keep a slice of the potential cognates, and their alignments, for
+    the whole life of the pool (see `open_realignment_pool`). Every round of a re-estimation sends each worker the
+    current PMI matrix and gets back the counts of its probable cognates: no words or alignments cross processes
+    after the start, and all workers realign at the same time.
 
-            # just valid alignments
-            num_alignments += 1
+    Between re-estimations the same workers run other tasks (`map`, `imap_unordered`), so a caller that needs both
+    keeps one set of processes (see `objective_evaluator.open_objective_pool`).
 
-            sorted_c1, sorted_c2 = tuple(sorted([char1, char2]))
-            valid_alignments_count[(sorted_c1, sorted_c2)] += 1
+    State:
+    - `potential_cognates (CognateCorpus)`: all the potential cognates
+    - `connections (list)`: one end of the pipe of every worker
+    - `processes (list[multiprocessing.Process])`: the workers
+    - `local (AlignedCognates)`: the potential cognates, when everything runs in this process (no workers)
 
-    pmi_matrix = current_pmi_matrix
-    # update it
-    for (alignment_char1, alignment_char2), alignment_count in valid_alignments_count.items():
-        pmi_matrix[(alignment_char1, alignment_char2)] = math.log((alignment_count / num_alignments) /
-                                                                  (
-            (char_counts[alignment_char1] / num_characters)
-            * (char_counts[alignment_char2] / num_characters)
-        ))
+    Example:
+    ```py
+    with open_realignment_pool(potential_cognates, num_workers=8) as realignment_pool:
+        pmi_matrix = reestimate_pmi_matrix(potential_cognates, -2.4, -1.3, 7.5, char_counts, num_characters,
+                                           default_pmi_matrix.copy(), realignment_pool=realignment_pool)
+    ```
+    """
 
-    if num_remaining == 1:
-        return pmi_matrix
+    def __init__(self, potential_cognates: CognateCorpus, connections: list, processes: list,
+                 local: AlignedCognates = None) -> None:
+        self.potential_cognates = potential_cognates
+        self.connections = connections
+        self.processes = processes
+        self.local = local
 
-    else:
-        return reestimate_pmi_matrix(potential_cognates, open_gap_score, extend_gap_score, theta_pmi, char_counts, num_characters, pmi_matrix, num_remaining - 1)
+    def round(self, pmi_scores: np.ndarray, open_gap_score: float, extend_gap_score: float, theta_pmi: float,
+              moved: np.ndarray = None) -> tuple[np.ndarray, int, int]:
+        """`AlignedCognates.round` over all slices, their counts added up."""
+        if self.local is not None:
+            return self.local.round(pmi_scores, open_gap_score, extend_gap_score, theta_pmi, moved)
+        for connection in self.connections:
+            connection.send(('round', (pmi_scores, open_gap_score, extend_gap_score, theta_pmi, moved)))
+        # every worker answers before an error is raised, so the next round starts clean
+        results = [connection.recv() for connection in self.connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        counts = np.zeros((NUM_SYMBOLS, NUM_SYMBOLS), dtype=np.int64)
+        num_alignments = num_realigned = 0
+        for result in results:
+            counts += result[0]
+            num_alignments += result[1]
+            num_realigned += result[2]
+        return counts, num_alignments, num_realigned
+
+    def map(self, function, items) -> list:
+        """`function` of every item, computed by the workers (or in this process without workers), in order."""
+        results = [None] * len(items)
+        for position, result in self.__run(function, items):
+            results[position] = result
+        return results
+
+    def imap_unordered(self, function, items):
+        """`function` of every item, computed by the workers, in the order they finish."""
+        for _, result in self.__run(function, items):
+            yield result
+
+    def __run(self, function, items):
+        """Hand the next item to every worker that is done, until all are computed. Yields (position, result)."""
+        if self.local is not None:
+            yield from enumerate(map(function, items))
+            return
+        pending = enumerate(items)
+        busy, error = {}, None
+        for connection in self.connections:
+            for position, item in pending:
+                connection.send(('call', (function, item)))
+                busy[connection] = position
+                break
+        while busy:
+            for connection in wait(list(busy)):
+                result = connection.recv()
+                position = busy.pop(connection)
+                if isinstance(result, Exception):
+                    # the other workers finish their item before the error is raised, so the pool stays usable
+                    error, pending = error or result, iter(())
+                elif error is None:
+                    yield position, result
+                for next_position, item in pending:
+                    connection.send(('call', (function, item)))
+                    busy[connection] = next_position
+                    break
+        if error is not None:
+            raise error
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections, self.processes = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+def open_realignment_pool(potential_cognates: CognateCorpus, num_workers: int = None, initializer=None,
+                          initargs: tuple = ()) -> RealignmentPool:
+    """
+    Start the workers that realign the potential cognates for `reestimate_pmi_matrix`.
+
+    The pairs are split into one contiguous slice per worker, of about the same alignment work (the product of the
+    lengths of the words), and every slice is sent to its worker once.
+
+    Parameters:
+    - `potential_cognates (CognateCorpus)`: the potential cognates to realign
+    - `num_workers (int, optional)`: number of worker processes. Defaults to the number of CPU cores,
+            1 realigns everything in this process.
+    - `initializer, initargs (optional)`: called as `initializer(*initargs)` in every worker (in this process
+            without workers) before any task, like the initializer of a `multiprocessing.Pool`
+
+    Returns:
+    - `RealignmentPool`: the workers, to pass to `reestimate_pmi_matrix` and close when done
+    """
+    num_workers = min(num_workers or multiprocessing.cpu_count(), max(len(potential_cognates), 1))
+    if num_workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return RealignmentPool(potential_cognates, [], [], local=AlignedCognates(potential_cognates))
+
+    work = np.cumsum([len(word1) * len(word2) for word1, word2 in potential_cognates.pairs])
+    bounds = [0, *np.searchsorted(work, work[-1] * np.arange(1, num_workers) / num_workers).tolist(),
+              len(potential_cognates)]
+    connections, processes = [], []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=__serve_realignment, daemon=True,
+            args=(worker_connection, CognateCorpus(potential_cognates.pairs[start:stop],
+                                                   potential_cognates.counts[start:stop]), initializer, initargs))
+        process.start()
+        worker_connection.close()
+        connections.append(connection)
+        processes.append(process)
+    return RealignmentPool(potential_cognates, connections, processes)
+
+
+def __serve_realignment(connection, potential_cognates: CognateCorpus, initializer=None, initargs: tuple = ()):
+    """
+    Main loop of a realignment worker: answer every round with the counts of its slice, and every call with its
+    result, until sent None.
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    cognates = AlignedCognates(potential_cognates)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        kind, arguments = message
+        try:
+            if kind == 'round':
+                connection.send(cognates.round(*arguments))
+            else:
+                function, item = arguments
+                connection.send(function(item))
+        except Exception as exception:
+            connection.send(exception)
+    connection.close()
+
+
+def count_aligned_characters(aligned1: np.ndarray, aligned2: np.ndarray,
+                             weights: np.ndarray) -> tuple[np.ndarray, int]:
+    """
+    Count the aligned character pairs of a batch of alignments in one pass, as `PMIMatrix.update_from_counts`
+    takes them.
+
+    Parameters:
+    - `aligned1, aligned2 (np.ndarray)`: the aligned codes of every pair (as `needleman_wunsch.align_batch` returns
+            them), gaps and padding are not counted
+    - `weights (np.ndarray)`: how often every alignment counts, alignments that count 0 times are not read
+
+    Returns:
+    - `tuple[np.ndarray, int]`: (NUM_SYMBOLS x NUM_SYMBOLS) weighted count of every (character of the first word,
+            character of the second word) pair, and the number of aligned character pairs (their total)
+    """
+    weights = np.asarray(weights)
+    counted = weights != 0
+    return __count_alignments(__aligned_columns(aligned1[counted], aligned2[counted]), weights[counted])
+
+
+def __aligned_columns(aligned1: np.ndarray, aligned2: np.ndarray) -> np.ndarray:
+    """The aligned character pair of every column (code1 * NUM_SYMBOLS + code2), -1 for gaps."""
+    # alignments are padded with gaps, so only aligned characters remain
+    aligned1, aligned2 = aligned1.astype(np.int64), aligned2.astype(np.int64)
+    return np.where((aligned1 != GAP) & (aligned2 != GAP), aligned1 * NUM_SYMBOLS + aligned2, -1)
+
+
+def __count_alignments(aligned_columns: np.ndarray, weights: np.ndarray) -> tuple[np.ndarray, int]:
+    """
+    (NUM_SYMBOLS x NUM_SYMBOLS) weighted count of every aligned character pair, in the order it was aligned, and
+    their total. One bincount over the aligned columns of all alignments (dropping the gap columns first is faster
+    than counting them in a spare bin).
+    """
+    aligned = aligned_columns >= 0
+    counts = np.bincount(aligned_columns[aligned], minlength=NUM_SYMBOLS * NUM_SYMBOLS,
+                         weights=np.broadcast_to(weights[:, None], aligned_columns.shape)[aligned])
+    counts = counts.astype(np.int64).reshape(NUM_SYMBOLS, NUM_SYMBOLS)
+    return counts, int(counts.sum())
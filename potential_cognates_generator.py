@@ -1,26 +1,127 @@
+import numpy as np
+
+from cognate_corpus import CognateCorpus
 from language import Language
-from levenshtein import get_closest_cognates
+from ldn_cache import LDNCache
+from levenshtein import get_paired_edit_distances
+from wordstore import NUM_SYMBOLS, WordStore, store_languages
 
 
-def generate_potential_cognates(probably_related_languages: list[tuple[Language, Language]]) -> list:
+def generate_potential_cognates(probably_related_languages: list[tuple[Language, Language]],
+                                cache: LDNCache = None) -> list:
     """
     Generates potential cognates between pairs of probably related languages.
 
+    For every concept that both languages attest, the pair of words with the lowest LDN is a potential
+    cognate (the first such pair on ties, like `levenshtein.get_closest_cognates`). The words are read from
+    the WordStore behind the languages and all candidate word pairs are measured in one batch.
+
     Parameters:
     - `probably_related_languages (list[tuple[Language, Language]])`: A list of language pairs, each represented as
             a tuple of two Language objects. These pairs are likely to be related languages or dialects.
+    - `cache (LDNCache, optional)`: if given, and it belongs to the store of the languages, word pairs measured
+            earlier in the run (for example by the probably-related scan) are looked up in it, and the ones measured
+            here are added to the rows it already has. A language takes part in many pairings, so its words come back often.
 
     Returns:
     - `list (list[tuple[str, str]])`: A list containing the potential cognates between the words in the word lists of the probably related.
         Each element of the list is a tuple containing the two words considered as potential cognates.
     """
-    potential_cognates = []
+    if not probably_related_languages:
+        return []
+
+    store, id1, id2 = __closest_word_pairs(probably_related_languages, cache)
+    vocabulary = store.vocabulary
+    return [(vocabulary[word_id1], vocabulary[word_id2]) for word_id1, word_id2 in zip(id1.tolist(), id2.tolist())]
+
+
+def generate_weighted_cognates(probably_related_languages: list[tuple[Language, Language]],
+                               cache: LDNCache = None) -> CognateCorpus:
+    """
+    Generates the potential cognates like `generate_potential_cognates`, as a `CognateCorpus`: every distinct
+    (sorted) pair of words once, with the number of times it is a potential cognate.
+
+    The pairs are counted on the interned word ids of the store, so no string pair is built for the duplicates.
+    The result is `CognateCorpus.from_pairs(generate_potential_cognates(probably_related_languages))`.
+
+    Parameters:
+    - `probably_related_languages, cache`: see `generate_potential_cognates`
+
+    Returns:
+    - `CognateCorpus`: the weighted potential cognates
+    """
+    if not probably_related_languages:
+        return CognateCorpus([], [])
+
+    store, id1, id2 = __closest_word_pairs(probably_related_languages, cache)
+    vocabulary = store.vocabulary
+
+    # rank of every word in string order, so sorting ranks sorts the pairs like sorted() sorts the words
+    by_spelling = np.array(sorted(range(len(vocabulary)), key=vocabulary.__getitem__), dtype=np.int64)
+    rank = np.empty_like(by_spelling)
+    rank[by_spelling] = np.arange(len(by_spelling))
+    first, second = np.minimum(rank[id1], rank[id2]), np.maximum(rank[id1], rank[id2])
+    pair_keys, counts = np.unique(first * len(vocabulary) + second, return_counts=True)
+    first, second = np.divmod(pair_keys, len(vocabulary))
+
+    return CognateCorpus([(vocabulary[word_id1], vocabulary[word_id2]) for word_id1, word_id2
+                          in zip(by_spelling[first].tolist(), by_spelling[second].tolist())], counts)
+
+
+def __closest_word_pairs(probably_related_languages: list[tuple[Language, Language]],
+                         cache: LDNCache) -> tuple[WordStore, np.ndarray, np.ndarray]:
+    """
+    Find the potential cognate of every concept of every pairing.
+
+    Returns:
+    - `tuple[WordStore, np.ndarray, np.ndarray]`: the store and the vocabulary ids of both words of every potential cognate
+    """
+    store, indices = store_languages(
+        [language for pairing in probably_related_languages for language in pairing])
+    indices1, indices2 = indices[0::2], indices[1::2]
+
+    word1, word2, group = __candidate_word_pairs(store, indices1, indices2)
+
+    codes, lengths = store.vocabulary_codes, store.vocabulary_lengths
+    id1, id2 = store.word_ids[word1], store.word_ids[word2]
+    if cache is not None and cache.store is store:
+        distances = cache.paired_edit_distances(id1, id2)
+    else:
+        distances = get_paired_edit_distances(codes[id1], lengths[id1], codes[id2], lengths[id2],
+                                              alphabet_size=NUM_SYMBOLS)
+    LDN_values = distances / np.maximum(lengths[id1], lengths[id2])
+
+    # candidates are already in (group, word1, word2) order, so a stable sort on LDN
+    #   within each group keeps the first minimum first
+    order = np.lexsort((LDN_values, group))
+    first = order[np.concatenate(([True], np.diff(group[order]) != 0))]
+
+    return store, id1[first], id2[first]
+
+
+def __candidate_word_pairs(store, indices1: np.ndarray, indices2: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    List every (word of L1, word of L2) pair of every concept attested in both languages of every pairing.
+
+    Returns:
+    - `tuple[np.ndarray, np.ndarray, np.ndarray]`: store word index of the first and second word, and a group number
+        that increases with (pairing, concept). Within a group, candidates come in word1-major order.
+    """
+    num_concepts = np.minimum(np.diff(store.language_offsets)[indices1],
+                              np.diff(store.language_offsets)[indices2])
+    pairing = np.repeat(np.arange(len(indices1)), num_concepts)
+    concept = np.arange(num_concepts.sum()) - np.repeat(np.cumsum(num_concepts) - num_concepts, num_concepts)
+
+    slot1 = store.language_offsets[indices1[pairing]] + concept
+    slot2 = store.language_offsets[indices2[pairing]] + concept
+    count1 = np.diff(store.concept_offsets)[slot1]
+    count2 = np.diff(store.concept_offsets)[slot2]
 
-    for pairing in probably_related_languages:
-        L1, L2 = pairing
-        for concept1, concept2 in zip(L1.word_list, L2.word_list):
-            cognate = get_closest_cognates(concept1, concept2)
-            if cognate != None:
-                potential_cognates.append(cognate)
+    # missing concepts have no words, so they produce no candidates
+    sizes = count1 * count2
+    group = np.repeat(np.arange(len(sizes)), sizes)
+    within = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    word1 = store.concept_offsets[slot1][group] + within // count2[group]
+    word2 = store.concept_offsets[slot2][group] + within % count2[group]
 
-    return potential_cognates
+    return word1, word2, group
@@ -1,31 +1,19 @@
-import multiprocessing
-from itertools import combinations
+from collections import Counter
+
 import matplotlib.pyplot as plt
 
 
-from dERC_LDNcalculator import calculate_dERC_LDN
+import instrumentation
+from distance_matrix_generator import DEFAULT_CHUNK_SIZE, condensed_pairs, generate_distance_matrix, scan_all_pairs, \
+    scan_candidate_pairs, scan_related_pairs
 from language import Language
+from ldn_cache import DEFAULT_CACHE_BYTES
+from lsh_index import NGramLSHIndex
 
 
-def __check_dERC_LDN_of_pairing(pairing: tuple[Language, Language]):
-    """
-    Calculates the dERC/LDN of a pair of languages and returns the pair if the distance is below a provided threshold.
-
-    Parameters:
-    - `pairing (tuple[Language, Language])`: A tuple containing two Language objects representing the pair of languages.
-    - `theta_dERC (float, optional)`: The threshold value for dERC/LDN distance. If the calculated distance
-            between the languages is below or equal to this value, the pair will be returned. Default is 0.70.
-
-    Returns:
-    - `tuple[Language, Language] or None`: If the dERC/LDN distance between the languages in the pairing is
-            less than or equal to theta_dERC, returns the same input pairing. Otherwise, returns None.
-    """
-    L1, L2 = pairing
-    dERC_of_pairing = calculate_dERC_LDN(L1, L2)
-    return (pairing, dERC_of_pairing)
-
-
-def get_related_languages(training_set: dict[str, list[Language]], test_set: dict[str, list[Language]], theta_dERC=.70):
+def get_related_languages(training_set: dict[str, list[Language]], test_set: dict[str, list[Language]], theta_dERC=.70,
+                          num_workers: int = None, chunk_size: int = DEFAULT_CHUNK_SIZE, distance_matrix_path: str = None,
+                          bounded: bool = False, cache_bytes: int = None, min_collisions: int = None):
     """
     Writes to a file a list of pairs of languages that are related, meaning their dERC/LDN is under the provided threshold.
 
@@ -36,6 +24,22 @@ def get_related_languages(training_set: dict[str, list[Language]], test_set: dic
             This parameter is required to enforce best practices by keeping the training_set and test_set separate yet together.
     - `theta_dERC` (float, optional): The threshold value for dERC/LDN distance. If the calculated distance between two languages
             is below or equal to this value, the pair will be considered related. Default is 0.70.
+    - `num_workers (int, optional)`: number of worker processes for the all-pairs scan. Defaults to the number of CPU cores.
+    - `chunk_size (int, optional)`: approximate number of language pairs handed to a worker at a time.
+    - `distance_matrix_path (str, optional)`: if given, the full distance matrix is also saved there
+            (see `distance_matrix_generator.generate_distance_matrix`), so other thresholds can be read back
+            with `load_distance_matrix` instead of scanning again.
+    - `bounded (bool, optional)`: only decide which pairs are within `theta_dERC`, with the threshold-aware
+            dERC/LDN (see `dERC_LDNcalculator.calculate_dERC_LDN_within`). The related pairs are the same, but most
+            pairs are never fully scored, so there is no score distribution to plot or matrix to save.
+    - `cache_bytes (int, optional)`: size bound of the word-pair LDN cache of every worker (see `ldn_cache.LDNCache`),
+            0 disables it. Defaults to `ldn_cache.DEFAULT_CACHE_BYTES`, and to 0 for the `bounded` scan
+            (see `distance_matrix_generator.scan_related_pairs`).
+    - `min_collisions (int, optional)`: if given, only the candidate pairs of an n-gram LSH index are scored
+            (see `lsh_index.NGramLSHIndex`), the pairs colliding in at least this many buckets. The recall knob:
+            lower finds more of the related pairs and scores more pairs. On the training set, 5 scores 7% of the
+            pairs and finds 99.65% of the related ones at 0.65 (see `lsh_index.recall_report`). Cannot be combined
+            with `bounded` or `distance_matrix_path`.
 
     Note:
     - The training_set and test_set should be organized as dictionaries where the keys represent language families (e.g., language families or language groups),
@@ -55,23 +59,49 @@ def get_related_languages(training_set: dict[str, list[Language]], test_set: dic
     # This will find language pairs with dERC/LDN distance less than or equal to 0.65 and save them to a file.
     ```
     """
+    # the bounded scan runs without caches unless one is asked for, see scan_related_pairs
+    bounded_cache_bytes = 0 if cache_bytes is None else cache_bytes
+    if cache_bytes is None:
+        cache_bytes = DEFAULT_CACHE_BYTES
     languages_list = [language  # Language class
                       for language_family in training_set.values()
                       for language in language_family]  # for language object in family
 
-    probably_related_languages = []
-    # Create a multiprocessing Pool with the number of CPU cores
-    num_processes = multiprocessing.cpu_count()
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        # Map the check_dERC_of_pairing function to the combinations of concept_lists_list
-        results = pool.map(__check_dERC_LDN_of_pairing,
-                           combinations(languages_list, 2))
-
-        # Collect the results of probably related languages in probably_related_languages
-        probably_related_languages = [
-            pairing for pairing, score in results if score <= theta_dERC]
-
-        scores = [score for pairing, score in results]
+    if min_collisions is not None:
+        if bounded or distance_matrix_path is not None:
+            raise ValueError("min_collisions scores candidate pairs only, there is no bounded scan or full matrix.")
+        # score only the pairs the LSH index proposes, exactly
+        first, second = NGramLSHIndex(languages_list).candidate_pairs(min_collisions)
+        scores = scan_candidate_pairs(languages_list, first, second, num_workers=num_workers, chunk_size=chunk_size,
+                                      cache_bytes=cache_bytes)
+        instrumentation.log('related pairs scan', f"scored {len(first)} candidate pairs",
+                            candidates=len(first))
+        related = scores <= theta_dERC
+        return [(languages_list[i], languages_list[j])
+                for i, j in zip(first[related].tolist(), second[related].tolist())]
+
+    # score every pair once, in parallel, into a condensed distance matrix (see distance_matrix_generator)
+    first, second = condensed_pairs(len(languages_list))
+    if bounded:
+        statistics = Counter()
+        related = scan_related_pairs(languages_list, theta_dERC, num_workers=num_workers, chunk_size=chunk_size,
+                                     statistics=statistics, cache_bytes=bounded_cache_bytes)
+        instrumentation.log('related pairs scan', f"pairs decided per stage: {dict(statistics)}",
+                            statistics=dict(statistics))
+        return [(languages_list[i], languages_list[j])
+                for i, j in zip(first[related].tolist(), second[related].tolist())]
+
+    if distance_matrix_path is None:
+        scores = scan_all_pairs(languages_list, num_workers=num_workers, chunk_size=chunk_size,
+                                cache_bytes=cache_bytes)
+    else:
+        scores = generate_distance_matrix(languages_list, distance_matrix_path, num_workers=num_workers,
+                                          chunk_size=chunk_size, cache_bytes=cache_bytes).distances
+
+    # Collect the probably related languages, in the order of combinations(languages_list, 2)
+    related = scores <= theta_dERC
+    probably_related_languages = [(languages_list[i], languages_list[j])
+                                  for i, j in zip(first[related].tolist(), second[related].tolist())]
 
     # plot scoree
     plot_scores(scores)
@@ -84,13 +114,13 @@ def plot_scores(data_list: list[float]):
     Plot the distribution of a list of floats.
 
     Parameters:
-        data_list (list): A list of floats.
+        data_list (list): A list (or array) of floats.
 
     Returns:
         None
     """
     # Check if data_list is not empty
-    if not data_list:
+    if len(data_list) == 0:
         raise ValueError(
             "The input list is empty. Please provide a non-empty list of floats.")
 
@@ -0,0 +1,485 @@
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import socket
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import instrumentation
+from corpus_file import TEST_SET_PATH, TRAINING_SET_PATH, load_corpus
+from dERC_LDNcalculator import calculate_dERC_LDN_batch
+from dERC_PMIcalculator import calculate_dERC_PMI_batch
+from distance_matrix_generator import DISTANCE_MATRIX_PATH, DistanceMatrix, condensed_index, load_distance_matrix
+from driver import build_pipeline
+from language import Language
+from ldn_cache import DEFAULT_CACHE_BYTES, LDNCache
+from needleman_wunsch import align_scores, encode_pairs, pmi_array
+from pmi_matrix import PMI_MATRIX_PATH, PMIMatrix
+from wordstore import encode_word, store_languages
+
+
+DEFAULT_SOCKET_PATH = "./materials/dERC_query.sock"
+# seconds a query waits for others to be batched with, and the most queries in one batch
+DEFAULT_MAX_DELAY = 0.002
+DEFAULT_MAX_BATCH = 256
+# most languages (or word pairs) scored by one task of the worker pool
+DEFAULT_TASK_SIZE = 256
+MEASURES = ('LDN', 'PMI')
+
+# set in every worker process by __init_worker, so the corpus and the PMI matrix are only shipped once per worker
+__worker_languages = None
+__worker_cache = None
+__worker_pmi = None
+
+
+class MicroBatcher:
+    """
+    This class gathers the items submitted by concurrent coroutines into batches, so they are computed by one
+    vectorized call instead of one call each.
+
+    The first item of a batch starts a timer of `max_delay` seconds, the batch is run when it runs out or when
+    `max_batch` items are waiting, whichever comes first. Batches run concurrently with each other and with the
+    items gathered for the next one.
+
+    State:
+    - `run_batch (callable)`: coroutine function, `await run_batch(items)` returns the result of every item
+    - `max_delay (float)`: seconds an item waits for others
+    - `max_batch (int)`: most items in one batch
+
+    Constructor:
+    - `run_batch: callable`
+    - `max_delay: float`, optional
+    - `max_batch: int`, optional
+
+    Example:
+    ```py
+    batcher = MicroBatcher(score_pairs)
+    scores = await asyncio.gather(*(batcher.submit(pair) for pair in pairs))  # a single call to score_pairs
+    ```
+    """
+
+    def __init__(self, run_batch, max_delay: float = DEFAULT_MAX_DELAY, max_batch: int = DEFAULT_MAX_BATCH) -> None:
+        self.run_batch = run_batch
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.__pending = []
+        self.__timer = None
+        self.__running = set()
+
+    async def submit(self, item):
+        """Add an item to the next batch and wait for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__pending.append((item, future))
+        if len(self.__pending) >= self.max_batch:
+            self.__flush()
+        elif self.__timer is None:
+            self.__timer = loop.call_later(self.max_delay, self.__flush)
+        return await future
+
+    def __flush(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        batch, self.__pending = self.__pending, []
+        if batch:
+            # keep a reference, the event loop only keeps weak ones to its tasks
+            task = asyncio.ensure_future(self.__run(batch))
+            self.__running.add(task)
+            task.add_done_callback(self.__running.discard)
+
+    async def __run(self, batch: list):
+        instrumentation.count('query batches')
+        instrumentation.count('queries batched', len(batch))
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class QueryService:
+    """
+    This class answers dERC queries about a fixed set of languages, with everything loaded once (see
+    `open_query_service`).
+
+    Distances that are in the distance matrix are looked up. The others are scored by the worker pool: the
+    (language, language) pairs of concurrent queries are micro-batched (see `MicroBatcher`) and the pairs of a
+    batch that share their first language are scored in one `calculate_dERC_*_batch` call. Word pairs are aligned
+    the same way, the pairs of a batch in one `needleman_wunsch.align_scores` call.
+
+    State:
+    - `names (list[str])`: the languages, in the order they are scored in: those of the distance matrix first, in
+            its order, so a pair is scored as (earlier language, later language) like the matrix was
+    - `distance_matrix (DistanceMatrix)`: dERC/LDN of the matrix languages, None if there is none
+    - `has_pmi (bool)`: whether there is a PMI matrix and gap scores for dERC/PMI and word pair queries
+    - `executor (concurrent.futures.Executor)`: the worker pool
+    - `distance_batchers (dict[str, MicroBatcher])`: batches the (row, column) language pairs to score, by measure
+    - `alignment_batcher (MicroBatcher)`: batches the word pairs to align
+
+    Example:
+    ```py
+    with open_query_service(languages, distance_matrix, pmi_matrix, -2.5, -1.7) as service:
+        answer = await service.answer({'query': 'nearest', 'language': 'ENGLISH', 'k': 5})
+    ```
+    """
+
+    def __init__(self, names: list[str], distance_matrix: DistanceMatrix, has_pmi: bool, executor,
+                 distance_batchers: dict, alignment_batcher: MicroBatcher) -> None:
+        self.names = list(names)
+        self.distance_matrix = distance_matrix
+        self.has_pmi = has_pmi
+        self.executor = executor
+        self.distance_batchers = distance_batchers
+        self.alignment_batcher = alignment_batcher
+        self.__positions = {name: position for position, name in enumerate(self.names)}
+
+    def index(self, name: str) -> int:
+        if name not in self.__positions:
+            raise ValueError(f"Unknown language '{name}'.")
+        return self.__positions[name]
+
+    async def distance(self, name1: str, name2: str, measure: str = 'LDN') -> float:
+        """The dERC of two languages, scored as (earlier language, later language)."""
+        i, j = sorted((self.index(name1), self.index(name2)))
+        self.__check_measure(measure)
+        if i == j:
+            return 0.0
+        if measure == 'LDN' and self.__in_matrix(j):
+            return float(self.distance_matrix.distances[condensed_index(i, j, len(self.distance_matrix))])
+        return float(await self.distance_batchers[measure].submit((i, j)))
+
+    async def nearest(self, name: str, k: int = 10, measure: str = 'LDN') -> list[tuple[str, float]]:
+        """
+        The `k` languages closest to a language, closest first. The distances that are not in the distance matrix
+        are scored with the language first, so all of them are batched together.
+        """
+        row = self.index(name)
+        self.__check_measure(measure)
+        distances = np.full(len(self.names), np.nan)
+        others = np.delete(np.arange(len(self.names)), row)
+        if measure == 'LDN' and self.__in_matrix(row):
+            in_matrix = others[self.__in_matrix(others)]
+            distances[in_matrix] = self.distance_matrix.distances[
+                condensed_index(np.minimum(row, in_matrix), np.maximum(row, in_matrix), len(self.distance_matrix))]
+            others = others[~self.__in_matrix(others)]
+        batcher = self.distance_batchers[measure]
+        distances[others] = await asyncio.gather(*(batcher.submit((row, column)) for column in others.tolist()))
+        distances[row] = np.inf
+        closest = np.argsort(distances, kind='stable')[:max(0, min(k, len(self.names) - 1))]
+        return [(self.names[position], float(distances[position])) for position in closest.tolist()]
+
+    async def pmi_score(self, word1: str, word2: str) -> float:
+        """The score of the alignment of two words with the PMI matrix and gap scores, None if a word is empty."""
+        if not self.has_pmi:
+            raise ValueError("The service has no PMI matrix.")
+        # checked here, a word that is not ASCIIPMA would fail the whole batch
+        encode_word(word1)
+        encode_word(word2)
+        score = await self.alignment_batcher.submit((word1, word2))
+        return None if math.isnan(score) else float(score)
+
+    async def answer(self, request: dict) -> dict:
+        """
+        Answer one query, a dict with a `query` and its arguments:
+        - `{'query': 'distance', 'language1': str, 'language2': str, 'measure': 'LDN' | 'PMI'}`
+        - `{'query': 'nearest', 'language': str, 'k': int, 'measure': 'LDN' | 'PMI'}`
+        - `{'query': 'pmi', 'word1': str, 'word2': str}`
+
+        Returns:
+        - `dict`: `{'result': ...}`, or `{'error': message}` for a query that cannot be answered. The `id` of the
+                request, if any, is sent back.
+        """
+        try:
+            query = request.get('query')
+            if query == 'distance':
+                result = await self.distance(request['language1'], request['language2'], request.get('measure', 'LDN'))
+            elif query == 'nearest':
+                result = await self.nearest(request['language'], int(request.get('k', 10)),
+                                            request.get('measure', 'LDN'))
+            elif query == 'pmi':
+                result = await self.pmi_score(request['word1'], request['word2'])
+            else:
+                raise ValueError(f"Unknown query '{query}'.")
+            response = {'result': result}
+        except Exception as error:
+            # the query fails, not the connection
+            response = {'error': f"{type(error).__name__}: {error}"}
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def __in_matrix(self, positions):
+        return positions < (len(self.distance_matrix) if self.distance_matrix is not None else 0)
+
+    def __check_measure(self, measure: str):
+        if measure not in MEASURES:
+            raise ValueError(f"Unknown measure '{measure}', expected one of {MEASURES}.")
+        if measure == 'PMI' and not self.has_pmi:
+            raise ValueError("The service has no PMI matrix.")
+
+
+def open_query_service(languages: list[Language], distance_matrix: DistanceMatrix = None, pmi_matrix=None,
+                       open_gap_score: float = None, extend_gap_score: float = None, num_workers: int = None,
+                       max_delay: float = DEFAULT_MAX_DELAY, max_batch: int = DEFAULT_MAX_BATCH,
+                       task_size: int = DEFAULT_TASK_SIZE, cache_bytes: int = DEFAULT_CACHE_BYTES) -> QueryService:
+    """
+    Start the workers of a query service.
+
+    The languages (as a WordStore) and the PMI matrix are sent to every worker once, through the pool initializer,
+    and stay there for every query. The workers are started before the function returns, so the first query does not
+    wait for them. Every worker keeps an LDN cache of the word pairs it scored (see
+    `ldn_cache.LDNCache`), which a long-running service keeps reusing.
+
+    Parameters:
+    - `languages (list[Language])`: the languages the queries can name, with unique names
+    - `distance_matrix (DistanceMatrix, optional)`: dERC/LDN of (some of) the languages, looked up instead of scored
+    - `pmi_matrix (optional)`: PMI matrix of dERC/PMI and word pair queries, as a `PMIMatrix` or dict
+    - `open_gap_score, extend_gap_score (float, optional)`: gap scores of the PMI alignments, needed with `pmi_matrix`
+    - `num_workers (int, optional)`: number of worker processes. Defaults to the number of CPU cores, 1 scores
+            in a thread of this process.
+    - `max_delay (float, optional)`, `max_batch (int, optional)`: see `MicroBatcher`
+    - `task_size (int, optional)`: most languages (or word pairs) scored by one task of the worker pool
+    - `cache_bytes (int, optional)`: size bound of the LDN cache of every worker, 0 disables it
+
+    Returns:
+    - `QueryService`: the service, to serve (see `serve`) and close when done
+    """
+    if pmi_matrix is not None and (open_gap_score is None or extend_gap_score is None):
+        raise ValueError("A PMI matrix needs its open and extend gap scores.")
+    by_name = {language.name: language for language in languages}
+    if len(by_name) != len(languages):
+        raise ValueError("Language names must be unique to be queried.")
+    matrix_names = distance_matrix.names if distance_matrix is not None else []
+    if any(name not in by_name for name in matrix_names):
+        raise ValueError("Every language of the distance matrix must be one of the languages.")
+    matrix_set = set(matrix_names)
+    names = matrix_names + [language.name for language in languages if language.name not in matrix_set]
+
+    store, indices = store_languages([by_name[name] for name in names])
+    pmi = (pmi_array(pmi_matrix), open_gap_score, extend_gap_score) if pmi_matrix is not None else None
+    num_workers = num_workers or multiprocessing.cpu_count()
+    if num_workers == 1:
+        __init_worker(store, indices, pmi, cache_bytes)
+        executor = ThreadPoolExecutor(max_workers=1)
+    else:
+        executor = ProcessPoolExecutor(max_workers=num_workers, initializer=__init_worker,
+                                       initargs=(store, indices, pmi, cache_bytes))
+        # start and load the workers now: workers started later would inherit (and hold open) client connections
+        executor.submit(__worker_ready).result()
+
+    distance_batchers = {measure: MicroBatcher(lambda items, measure=measure: __score_pairs(
+        executor, measure, items, num_workers, task_size), max_delay, max_batch) for measure in MEASURES}
+    alignment_batcher = MicroBatcher(lambda items: __align_pairs(executor, items, num_workers, task_size),
+                                     max_delay, max_batch)
+    return QueryService(names, distance_matrix, pmi is not None, executor, distance_batchers, alignment_batcher)
+
+
+async def serve(service: QueryService, socket_path: str = DEFAULT_SOCKET_PATH, host: str = None, port: int = None):
+    """
+    Serve queries until cancelled: on a Unix socket, or on TCP if `port` is given.
+
+    Every line a client sends is a JSON query (see `QueryService.answer`), answered by one JSON line. The queries of
+    a connection are answered concurrently, so a client may send many before reading, and match the answers to
+    the queries by their `id`.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        pending = set()
+
+        async def respond(line: bytes):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("A query is a JSON object.")
+            except ValueError as error:
+                response = {'error': f"ValueError: {error}"}
+            else:
+                response = await service.answer(request)
+            writer.write(json.dumps(response).encode() + b'\n')
+
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    task = asyncio.ensure_future(respond(line))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    if port is not None:
+        server = await asyncio.start_server(handle, host, port)
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(handle, socket_path)
+    instrumentation.log('query server started', f"serving {len(service.names)} languages on "
+                        f"{socket_path if port is None else f'{host}:{port}'}", languages=len(service.names))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def query(requests: list[dict], socket_path: str = DEFAULT_SOCKET_PATH) -> list[dict]:
+    """
+    Send queries to a running server (see `serve`) over its Unix socket, all at once, and return the answers in
+    the order of the queries.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        lines = [json.dumps({**request, 'id': position}) for position, request in enumerate(requests)]
+        connection.sendall(''.join(line + '\n' for line in lines).encode())
+        connection.shutdown(socket.SHUT_WR)
+        with connection.makefile('rb') as file:
+            answers = [json.loads(file.readline()) for _ in requests]
+    answers.sort(key=lambda answer: answer.pop('id'))
+    return answers
+
+
+async def __score_pairs(executor, measure: str, items: list[tuple[int, int]], num_workers: int,
+                        task_size: int) -> list[float]:
+    """Score (row, column) language pairs, those that share a row in one batch call, spread over the workers."""
+    rows = defaultdict(set)
+    for row, column in items:
+        rows[row].add(column)
+    segments = [(row, np.array(sorted(columns))) for row, columns in rows.items()]
+    tasks = __pack(segments, lambda segment: len(segment[1]),
+                   lambda segment, start, stop: (segment[0], segment[1][start:stop]), num_workers, task_size)
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, __score_segments, measure, task)
+                                     for task in tasks))
+    scores = {}
+    for task, task_scores in zip(tasks, results):
+        for (row, columns), row_scores in zip(task, task_scores):
+            scores.update(zip(zip([row] * len(columns), columns.tolist()), row_scores.tolist()))
+    return [scores[item] for item in items]
+
+
+async def __align_pairs(executor, items: list[tuple[str, str]], num_workers: int, task_size: int) -> list[float]:
+    """Align word pairs with the PMI matrix, every distinct pair once, spread over the workers."""
+    word_pairs = list(dict.fromkeys(items))
+    tasks = __pack([word_pairs], len, lambda pairs, start, stop: pairs[start:stop], num_workers, task_size)
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, __align_words, task[0]) for task in tasks))
+    scores = dict(zip(word_pairs, np.concatenate(results).tolist()))
+    return [scores[item] for item in items]
+
+
+def __pack(segments: list, size, cut, num_workers: int, task_size: int) -> list[list]:
+    """
+    Cut segments of work into tasks: at most `task_size` items each, and at least enough tasks to keep every
+    worker busy when there are enough items.
+
+    Returns:
+    - `list[list]`: the pieces of segments (cut with `cut(segment, start, stop)`) every task holds
+    """
+    total = sum(size(segment) for segment in segments)
+    per_task = max(1, min(task_size, math.ceil(total / num_workers)))
+    tasks, task, task_total = [], [], 0
+    for segment in segments:
+        start = 0
+        while start < size(segment):
+            stop = min(size(segment), start + per_task - task_total)
+            task.append(cut(segment, start, stop))
+            task_total += stop - start
+            start = stop
+            if task_total == per_task:
+                tasks.append(task)
+                task, task_total = [], 0
+    if task:
+        tasks.append(task)
+    return tasks
+
+
+def __init_worker(store, indices: np.ndarray, pmi: tuple, cache_bytes: int):
+    global __worker_languages, __worker_cache, __worker_pmi
+    __worker_languages = [store[index] for index in indices.tolist()]
+    __worker_cache = LDNCache(store, max_bytes=cache_bytes) if cache_bytes else None
+    __worker_pmi = pmi
+
+
+def __worker_ready() -> bool:
+    return True
+
+
+def __score_segments(measure: str, segments: list[tuple[int, np.ndarray]]) -> list[np.ndarray]:
+    scores = []
+    for row, columns in segments:
+        others = [__worker_languages[column] for column in columns.tolist()]
+        if measure == 'LDN':
+            keywords = {} if __worker_cache is None else {'cache': __worker_cache}
+            scores.append(np.asarray(calculate_dERC_LDN_batch(__worker_languages[row], others, **keywords)))
+        else:
+            scores.append(np.asarray(calculate_dERC_PMI_batch(__worker_languages[row], others, *__worker_pmi)))
+    return scores
+
+
+def __align_words(word_pairs: list[tuple[str, str]]) -> np.ndarray:
+    return align_scores(*encode_pairs(word_pairs), *__worker_pmi)
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Serve dERC queries about the corpus on a Unix socket (or TCP).")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None, help="serve on TCP instead of the Unix socket")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--pipeline', action='store_true',
+                        help="serve the artifacts of the pipeline (see driver.build_pipeline), which must be up to date")
+    parser.add_argument('--distance-matrix', default=DISTANCE_MATRIX_PATH)
+    parser.add_argument('--pmi-matrix', default=PMI_MATRIX_PATH)
+    parser.add_argument('--open-gap', type=float, default=None)
+    parser.add_argument('--extend-gap', type=float, default=None)
+    arguments = parser.parse_args()
+
+    if arguments.pipeline:
+        pipeline = build_pipeline()
+        if not pipeline.is_up_to_date('final_pmi_matrix'):
+            parser.error("the pipeline is not up to date, run driver.py first")
+        training_set, test_set = pipeline['sets']
+        served_matrix = pipeline['distance_matrix']
+        served_pmi = pipeline['final_pmi_matrix']
+        open_gap, extend_gap, _ = pipeline['optimization']['x']
+    else:
+        training_set, test_set = load_corpus(TRAINING_SET_PATH), load_corpus(TEST_SET_PATH)
+        served_matrix = load_distance_matrix(arguments.distance_matrix) \
+            if os.path.exists(arguments.distance_matrix) else None
+        has_gaps = arguments.open_gap is not None and arguments.extend_gap is not None
+        served_pmi = PMIMatrix.load(arguments.pmi_matrix) if has_gaps and os.path.exists(arguments.pmi_matrix) else None
+        open_gap, extend_gap = arguments.open_gap, arguments.extend_gap
+
+    served_languages = [language for language_set in (training_set, test_set)
+                        for family in language_set.values() for language in family]
+    with open_query_service(served_languages, served_matrix, served_pmi, open_gap, extend_gap,
+                            num_workers=arguments.workers) as query_service:
+        try:
+            asyncio.run(serve(query_service, arguments.socket, arguments.host, arguments.port))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,90 @@
+"""
+The original, one pair at a time dERC implementations, kept as the reference the batch engines are tested against.
+They score every word pair with python-Levenshtein and Bio.pairwise2, as the code did before the engines existed.
+"""
+import bisect
+import math
+import warnings
+from itertools import product
+
+import Levenshtein
+
+from language import Language
+
+
+def calculate_dERC_LDN(L1: Language, L2: Language) -> float:
+    """The dERC/LDN of two languages, see `dERC_LDNcalculator.calculate_dERC_LDN`."""
+    def calculate_LDN(word_list1: list[str], word_list2: list[str], average: bool) -> float:
+        LDN_values = [Levenshtein.distance(word1, word2) / max(len(word1), len(word2))
+                      for word1 in word_list1 for word2 in word_list2]
+        return sum(LDN_values) / len(LDN_values) if average else min(LDN_values)
+
+    return __calculate_dERC(L1.word_list, L2.word_list, calculate_LDN)
+
+
+def calculate_dERC_PMI(L1: Language, L2: Language, pmi_matrix: dict[tuple[str, str], float], open_gap_score: float,
+                       extend_gap_score: float) -> float:
+    """The dERC/PMI of two languages, see `dERC_PMIcalculator.calculate_dERC_PMI`."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from Bio import pairwise2
+
+    def get_PMI(word1: str, word2: str) -> float:
+        alignments = pairwise2.align.globalcs(word1, word2, open=open_gap_score, extend=extend_gap_score,
+                                              match_fn=lambda char1, char2: pmi_matrix[tuple(sorted((char1, char2)))])
+        return alignments[0].score if alignments else -200
+
+    def calculate_PMI(word_list1: list[str], word_list2: list[str], average: bool) -> float:
+        # negative because normally bigger PMI is better but for LDN
+        #   smaller is better so that's how it is calibrated
+        PMI_values = [get_PMI(word1, word2) for word1 in word_list1 for word2 in word_list2]
+        return -(sum(PMI_values) / len(PMI_values) if average else max(PMI_values))
+
+    return __calculate_dERC(L1.word_list, L2.word_list, calculate_PMI)
+
+
+def __calculate_dERC(L1_words: list[list[str]], L2_words: list[list[str]], score) -> float:
+    on_diagonal = [score(concepts1, concepts2, average=False)
+                   for concepts1, concepts2 in zip(L1_words, L2_words)
+                   if 'XXX' not in concepts1 and 'XXX' not in concepts2]
+
+    off_diagonal = [score(concepts1, concepts2, average=True)
+                    for (i, concepts1), (j, concepts2) in product(enumerate(L1_words), enumerate(L2_words))
+                    if i != j and 'XXX' not in concepts1 and 'XXX' not in concepts2]
+
+    off_diagonal.sort()
+
+    normalized_ranks = [__calculate_normalized_rank(diagonal, off_diagonal) for diagonal in on_diagonal]
+
+    N = len(on_diagonal)
+    if N == 0:
+        return 1
+
+    ER = -sum(math.log(normalized_rank) for normalized_rank in normalized_ranks) / N
+
+    Nmax = len(L1_words)
+    ERmax = -(math.log(1 / ((Nmax * Nmax) - Nmax + 1)))
+    ERmin = 0
+
+    ERC = math.sqrt(N) * (ER - 1)
+    ERCmax = math.sqrt(Nmax) * (ERmax - 1)
+    ERCmin = math.sqrt(Nmax) * (ERmin - 1)
+
+    return (ERCmax - ERC) / (ERCmax - ERCmin)
+
+
+def __calculate_normalized_rank(diagonal_entry: float, off_diagonal_list: list[float]) -> float:
+    """The normalized rank of a diagonal entry among the sorted off-diagonal entries."""
+    less_than_or_equal_count = bisect.bisect_right(off_diagonal_list, diagonal_entry)
+    less_than_count = bisect.bisect_left(off_diagonal_list, diagonal_entry)
+
+    total_entries = len(off_diagonal_list)
+    normalized_rank = 1
+
+    rank_count = less_than_or_equal_count - less_than_count + 1
+
+    for value in range(less_than_count + 1, less_than_or_equal_count + 2):
+        normalized_value = (value / (total_entries + 1)) ** (1 / rank_count)
+        normalized_rank *= normalized_value
+
+    return normalized_rank
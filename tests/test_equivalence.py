@@ -0,0 +1,440 @@
+"""
+Equivalence checks of the vectorized paths against the straightforward computations they replace, on fixed
+samples of materials/test_set.corpus and materials/training_set.corpus.
+"""
+import asyncio
+import io
+import os
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+import reference_dERC
+from align import get_PMI, get_PMI_scores
+from benchmarks import load_output_parameters
+from concept_bootstrap import bootstrap_dERC, bootstrap_samples, concept_score_matrices
+from corpus_file import load_corpus
+from dERC_LDNcalculator import calculate_dERC_LDN, calculate_dERC_LDN_batch, calculate_dERC_LDN_within
+from dERC_PMIcalculator import calculate_dERC_PMI, calculate_dERC_PMI_batch
+from distance_matrix_generator import DistanceMatrix, condensed_index
+from driver import add_languages, build_pipeline, default_pmi_matrix_stage, save_sets
+from objective_evaluator import evaluate_objective, open_objective_pool
+from language import Language
+from lsh_index import NGramLSHIndex
+from needleman_wunsch import align_batch, encode_pairs, identity_array, pmi_dict
+from pmi_matrix_generator import AlignedCognates, open_realignment_pool, reestimate_pmi_matrix
+from potential_cognates_generator import generate_weighted_cognates
+from query_server import MicroBatcher, __pack, open_query_service
+from tree_builder import Tree, neighbor_joining, read_newick
+from wordstore import CHARS, decode_word
+
+
+MATERIALS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'materials')
+TEST_SET_PATH = os.path.join(MATERIALS_PATH, 'test_set.corpus')
+TRAINING_SET_PATH = os.path.join(MATERIALS_PATH, 'training_set.corpus')
+
+
+@pytest.fixture(scope='module')
+def languages() -> list[Language]:
+    return [language for family in load_corpus(TEST_SET_PATH).values() for language in family]
+
+
+@pytest.fixture(scope='module')
+def training_languages() -> list[Language]:
+    return [language for family in load_corpus(TRAINING_SET_PATH).values() for language in family]
+
+
+@pytest.fixture(scope='module')
+def potential_cognates() -> tuple:
+    # neighbours within sampled families stand in for the probably related pairs
+    families = [family for family in load_corpus(TRAINING_SET_PATH).values() if len(family) >= 2]
+    families = random.Random(0).sample(families, 10)
+    related_pairs = [(L1, L2) for family in families for L1, L2 in zip(family, family[1:])][:60]
+    corpus = generate_weighted_cognates(related_pairs)
+    return related_pairs, corpus, default_pmi_matrix_stage((dict(enumerate(families)), None), corpus)
+
+
+def __random_scores(seed: int) -> np.ndarray:
+    # one decimal, like the PMI matrices, so ties between paths do happen
+    generator = np.random.default_rng(seed)
+    scores = np.round(generator.uniform(-3, 3, size=(len(CHARS), len(CHARS))), 1)
+    return (scores + scores.T) / 2
+
+
+def __word_pairs(languages: list[Language], num_pairs: int, seed: int) -> list[tuple[str, str]]:
+    generator = random.Random(seed)
+    word_pairs = []
+    while len(word_pairs) < num_pairs:
+        L1, L2 = generator.sample(languages, 2)
+        concept = generator.randrange(len(L1.word_list))
+        if 'XXX' not in L1.word_list[concept] and 'XXX' not in L2.word_list[concept]:
+            word_pairs.append((L1.word_list[concept][0], L2.word_list[concept][0]))
+    return word_pairs
+
+
+@pytest.mark.parametrize('seed, scores, open_gap_score, extend_gap_score', [
+    (0, identity_array(2.0, -1.0), -2.5, -1.7),
+    (1, identity_array(0, -1), -1, -1),
+    (2, __random_scores(2), -2.0, -0.5),
+])
+@pytest.mark.parametrize('batch_size', [1, 200])
+def test_align_batch_matches_pairwise2(languages, seed, scores, open_gap_score, extend_gap_score, batch_size):
+    # batches of 1 take the scalar path, larger ones the vectorized one
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from Bio import pairwise2
+
+    word_pairs = __word_pairs(languages, 200, seed)
+    code = {char: index for index, char in enumerate(CHARS)}
+    for start in range(0, len(word_pairs), batch_size):
+        batch = word_pairs[start:start + batch_size]
+        result, aligned1, aligned2, aligned_lengths, found = align_batch(*encode_pairs(batch), scores,
+                                                                           open_gap_score, extend_gap_score)
+        for pair, (word1, word2) in enumerate(batch):
+            alignments = pairwise2.align.globalcs(word1, word2, lambda a, b: scores[code[a], code[b]],
+                                                  open_gap_score, extend_gap_score)
+            assert found[pair]
+            assert result[pair] == pytest.approx(alignments[0][2])
+            assert decode_word(aligned1[pair, :aligned_lengths[pair]]) == alignments[0][0]
+            assert decode_word(aligned2[pair, :aligned_lengths[pair]]) == alignments[0][1]
+
+
+@pytest.mark.parametrize('seed', [3, 4])
+def test_get_PMI_matches_pairwise2(languages, seed):
+    # a dict PMI matrix takes the single-pair path of get_PMI, and of get_PMI_scores for a few pairs
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from Bio import pairwise2
+
+    pmi_matrix = pmi_dict(__random_scores(seed))
+    word_pairs = __word_pairs(languages, 100, seed)
+    for word1, word2 in word_pairs:
+        alignments = pairwise2.align.globalcs(word1, word2, lambda a, b: pmi_matrix[tuple(sorted((a, b)))],
+                                              -2.0, -0.5)
+        score, aligned_words = get_PMI(word1, word2, pmi_matrix, -2.0, -0.5)
+        assert score == pytest.approx(alignments[0][2])
+        assert aligned_words == tuple(alignments[0][:2])
+        assert get_PMI_scores([(word1, word2)], pmi_matrix, -2.0, -0.5)[0] == score
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_dERC_LDN_batch_matches_reference(training_languages, seed):
+    sample = random.Random(seed).sample(training_languages, 8)
+    L1, others = sample[0], sample[1:]
+    expected = [reference_dERC.calculate_dERC_LDN(L1, L2) for L2 in others]
+    np.testing.assert_allclose(calculate_dERC_LDN_batch(L1, others), expected, rtol=0, atol=1e-12)
+    assert calculate_dERC_LDN(L1, others[0]) == pytest.approx(expected[0], rel=0, abs=1e-12)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_dERC_PMI_batch_matches_reference(training_languages, seed):
+    pmi_matrix, open_gap_score, extend_gap_score, _ = load_output_parameters(os.path.join(MATERIALS_PATH,
+                                                                                          'output.txt'))
+    sample = random.Random(seed).sample(training_languages, 4)
+    L1, others = sample[0], sample[1:]
+    expected = [reference_dERC.calculate_dERC_PMI(L1, L2, pmi_matrix, open_gap_score, extend_gap_score)
+                for L2 in others]
+    np.testing.assert_allclose(calculate_dERC_PMI_batch(L1, others, pmi_matrix, open_gap_score, extend_gap_score),
+                               expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('theta_dERC', [0.5, 0.65, 0.7, 0.8])
+def test_dERC_LDN_within_matches_full_scoring(languages, theta_dERC):
+    sample = random.Random(0).sample(languages, 60)
+    for row in range(len(sample) - 1):
+        L1, others = sample[row], sample[row + 1:]
+        expected = calculate_dERC_LDN_batch(L1, others) <= theta_dERC
+        np.testing.assert_array_equal(calculate_dERC_LDN_within(L1, others, theta_dERC), expected)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_bootstrap_dERC_matches_resampled_word_lists(languages, seed):
+    sample = random.Random(seed).sample(languages, 8)
+    L1, others = sample[0], sample[1:]
+    samples = bootstrap_samples(num_replicates=6, num_concepts=len(L1.word_list), seed=seed)
+    same_concept, cells = concept_score_matrices(L1, others)
+    dERC = bootstrap_dERC(same_concept, cells, samples, num_concepts=len(L1.word_list))
+
+    for replicate, concepts in enumerate(samples.tolist()):
+        resampled = [Language(language.name, [language.word_list[concept] for concept in concepts])
+                     for language in sample]
+        np.testing.assert_array_equal(dERC[replicate], calculate_dERC_LDN_batch(resampled[0], resampled[1:]))
+
+
+def test_reestimate_pmi_matrix_matches_realigning_every_pair(potential_cognates):
+    _, corpus, default_pmi = potential_cognates
+    _, open_gap_score, extend_gap_score, theta_pmi = load_output_parameters(os.path.join(MATERIALS_PATH,
+                                                                                         'output.txt'))
+    char_counts, num_characters = default_pmi['char_counts'], default_pmi['num_characters']
+
+    # every iteration aligns every pair from scratch
+    pmi_matrix = default_pmi['default_pmi_matrix'].copy()
+    expected = []
+    for _ in range(6):
+        counts, num_alignments, _ = AlignedCognates(corpus).round(pmi_matrix.scores, open_gap_score,
+                                                                  extend_gap_score, theta_pmi)
+        pmi_matrix.update_from_counts(counts, char_counts, num_characters, num_alignments)
+        expected.append(pmi_matrix.scores.copy())
+
+    # on this sample the fifth iteration realigns about two thirds of the pairs and the sixth is skipped
+    for num_remaining in (1, 2, 5, 6):
+        result = reestimate_pmi_matrix(corpus, open_gap_score, extend_gap_score, theta_pmi, char_counts,
+                                       num_characters, default_pmi['default_pmi_matrix'].copy(), num_remaining,
+                                       tolerance=0)
+        np.testing.assert_array_equal(result.scores, expected[num_remaining - 1])
+
+
+def test_realignment_pool_matches_serial_reestimation(potential_cognates):
+    _, corpus, default_pmi = potential_cognates
+    _, open_gap_score, extend_gap_score, theta_pmi = load_output_parameters(os.path.join(MATERIALS_PATH,
+                                                                                         'output.txt'))
+    arguments = (corpus, open_gap_score, extend_gap_score, theta_pmi, default_pmi['char_counts'],
+                 default_pmi['num_characters'])
+    expected = reestimate_pmi_matrix(*arguments, default_pmi['default_pmi_matrix'].copy(), 6)
+    with open_realignment_pool(corpus, num_workers=2) as realignment_pool:
+        assert len(realignment_pool.processes) == 2
+        # the workers keep their alignments between re-estimations, so a second one must not reuse them
+        for _ in range(2):
+            result = reestimate_pmi_matrix(*arguments, default_pmi['default_pmi_matrix'].copy(), 6,
+                                           realignment_pool=realignment_pool)
+            np.testing.assert_array_equal(result.scores, expected.scores)
+
+
+def test_objective_pool_matches_serial_evaluation(potential_cognates):
+    related_pairs, corpus, default_pmi = potential_cognates
+    arguments = (corpus, related_pairs[:12], default_pmi['char_counts'], default_pmi['num_characters'],
+                 default_pmi['default_pmi_matrix'], 3)
+    # several points re-estimate one per worker, a single point realigns with all the workers
+    points = [[-2.5, -1.7, 4.4], [-2.0, -1.0, 7.0], [1.0, -1.0, 5.0]]
+    with open_objective_pool(*arguments, num_workers=1) as objective_pool:
+        expected = evaluate_objective(objective_pool, points)
+    with open_objective_pool(*arguments, num_workers=2) as objective_pool:
+        assert len(objective_pool.pool.processes) == 2
+        np.testing.assert_array_equal(evaluate_objective(objective_pool, points), expected)
+        np.testing.assert_array_equal(evaluate_objective(objective_pool, points[1:2]), expected[1:2])
+
+
+def test_add_languages_matches_full_run(tmp_path):
+    corpus = load_corpus(TEST_SET_PATH)
+    training_set = {family: list(corpus[family]) for family in ('Teb', 'KT', 'Son', 'CK')}
+    test_set = {'Zap': list(corpus['Zap'])}
+    # new families only, so the languages come last in both matrices (dERC is not quite symmetric)
+    new_set = {family: list(corpus[family]) for family in ('Mat', 'Kay')}
+    word_list = corpus['Mat'][0].word_list
+    unusable = {'Mat': [Language('MAT_PROTO', word_list), Language('MAT_BAD', [['ma\u00f1o']] + word_list[1:])],
+                'Oth': [Language('OTHER', word_list)]}
+
+    def pipeline(name: str, training_set: dict):
+        paths = [str(tmp_path / f'{name}_training.corpus'), str(tmp_path / f'{name}_test.corpus')]
+        save_sets(training_set, test_set, *paths)
+        return build_pipeline(directory=str(tmp_path / name), training_path=paths[0], test_path=paths[1])
+
+    extended = pipeline('extended', training_set)
+    extended.run('potential_cognates')
+    rejected = []
+    related_pairs = add_languages(extended, {'Mat': new_set['Mat'] + unusable['Mat'], 'Kay': new_set['Kay'],
+                                             'Oth': unusable['Oth']}, num_workers=1, rejected=rejected)
+    full = pipeline('full', {**training_set, **new_set})
+    full.run('potential_cognates')
+
+    assert sorted(name for _, name, _ in rejected) == ['MAT_BAD', 'MAT_PROTO', 'OTHER']
+    assert [language.name for language in extended['sets'][0]['Mat']] == [language.name
+                                                                         for language in new_set['Mat']]
+    assert extended['distance_matrix'].names == full['distance_matrix'].names
+    np.testing.assert_array_equal(extended['distance_matrix'].distances, full['distance_matrix'].distances)
+    new_names = {language.name for family in new_set.values() for language in family}
+    expected_pairs = [pair for pair in full['distance_matrix'].related_pairs(theta_dERC=0.65) if pair[1] in new_names]
+    assert related_pairs and sorted(related_pairs) == sorted(expected_pairs)
+    assert extended['potential_cognates'].pairs == full['potential_cognates'].pairs
+    np.testing.assert_array_equal(extended['potential_cognates'].counts, full['potential_cognates'].counts)
+
+
+@pytest.mark.parametrize('num_bands, band_size', [(8, 2), (24, 3)])
+def test_lsh_collisions_match_comparing_every_pair(languages, num_bands, band_size):
+    sample = random.Random(0).sample(languages, 300)
+    index = NGramLSHIndex(sample, num_bands=num_bands, band_size=band_size)
+
+    # (languages x concepts x bands) band values, -1 for missing concepts, compared for every pair of languages
+    indexed = index.slot_language >= 0
+    num_concepts = index.slot_concept[indexed].max() + 1
+    bands = np.full((len(sample), num_concepts, num_bands, band_size), -1, dtype=np.int64)
+    bands[index.slot_language[indexed], index.slot_concept[indexed]] = \
+        index.signatures[:, indexed].T.reshape(-1, num_bands, band_size)
+    present = bands[:, :, 0, 0] >= 0
+    expected = np.concatenate([
+        ((bands[row + 1:] == bands[row]).all(axis=3) & (present[row + 1:] & present[row])[:, :, None]).sum(axis=(1, 2))
+        for row in range(len(sample) - 1)])
+
+    positions, counts = index.collisions()
+    np.testing.assert_array_equal(positions, np.nonzero(expected)[0])
+    np.testing.assert_array_equal(counts, expected[expected > 0])
+
+
+def __random_distance_matrix(num_leaves: int, seed: int) -> DistanceMatrix:
+    generator = np.random.default_rng(seed)
+    # names with Newick's special characters, which have to be quoted
+    names = [f"L{leaf}" if leaf % 3 else f"L {leaf} ('x')" for leaf in range(num_leaves)]
+    return DistanceMatrix(names, generator.uniform(0.1, 1.0, size=num_leaves * (num_leaves - 1) // 2))
+
+
+def __naive_neighbor_joining(distance_matrix: DistanceMatrix) -> dict:
+    """Neighbor joining building the whole Q matrix every step, as (split -> branch length)."""
+    distances = np.zeros((len(distance_matrix), len(distance_matrix)))
+    distances[np.triu_indices(len(distance_matrix), 1)] = distance_matrix.distances
+    distances += distances.T
+    clusters = [frozenset([name]) for name in distance_matrix.names]
+    branches = []
+    while len(clusters) > 3:
+        size = len(clusters)
+        sums = distances.sum(axis=1)
+        q = (size - 2) * distances - sums[:, None] - sums[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = np.unravel_index(np.argmin(q), q.shape)
+        length_i = distances[i, j] / 2 + (sums[i] - sums[j]) / (2 * (size - 2))
+        branches += [(clusters[i], length_i), (clusters[j], distances[i, j] - length_i)]
+        new_row = (distances[i] + distances[j] - distances[i, j]) / 2
+        kept = [k for k in range(size) if k not in (i, j)]
+        distances = np.vstack((np.column_stack((distances[np.ix_(kept, kept)], new_row[kept])),
+                               np.append(new_row[kept], 0)))
+        clusters = [clusters[k] for k in kept] + [clusters[i] | clusters[j]]
+    (d_01, d_02), d_12 = distances[0, 1:], distances[1, 2]
+    branches += [(clusters[0], (d_01 + d_02 - d_12) / 2), (clusters[1], (d_01 + d_12 - d_02) / 2),
+                 (clusters[2], (d_02 + d_12 - d_01) / 2)]
+    return {__split(cluster, distance_matrix.names): length for cluster, length in branches}
+
+
+def __split(side, names: list[str]) -> frozenset:
+    # both sides, so a split has one key however the tree is rooted
+    return frozenset([frozenset(side), frozenset(names) - frozenset(side)])
+
+
+def __tree_splits(tree: Tree) -> dict:
+    names = np.array(tree.names, dtype=object)
+    return {__split(names[below], tree.names): tree.lengths[node]
+            for node, below in enumerate(tree.leaf_sets()) if node != tree.root}
+
+
+@pytest.mark.parametrize('num_leaves, seed', [(3, 0), (4, 1), (10, 2), (40, 3), (120, 4)])
+def test_neighbor_joining_matches_naive_neighbor_joining(num_leaves, seed):
+    distance_matrix = __random_distance_matrix(num_leaves, seed)
+    expected = __naive_neighbor_joining(distance_matrix)
+
+    splits = __tree_splits(neighbor_joining(distance_matrix))
+    assert splits.keys() == expected.keys()
+    np.testing.assert_allclose([splits[split] for split in expected], list(expected.values()), rtol=1e-9, atol=1e-12)
+
+
+def test_newick_round_trip(tmp_path):
+    tree = neighbor_joining(__random_distance_matrix(50, 5))
+    support = np.random.default_rng(5).uniform(size=len(tree.children))
+    support[:len(tree)] = np.nan
+
+    # the inner node labels written from the support are skipped when reading
+    text = tree.to_newick(precision=17, support=support)
+    read = read_newick(text)
+    assert sorted(read.names) == sorted(tree.names)
+    assert __tree_splits(read) == __tree_splits(tree)
+    assert read.to_newick(precision=17) == tree.to_newick(precision=17)
+
+    # writing in small pieces does not change the text
+    output = io.StringIO()
+    tree.write_newick(output, precision=17, buffer_size=3, support=support)
+    assert output.getvalue() == text
+
+    path = str(tmp_path / 'tree.nwk')
+    tree.save(path)
+    assert __tree_splits(Tree.load(path)) == __tree_splits(tree)
+
+
+def test_micro_batcher_batches_concurrent_items():
+    batches = []
+
+    async def run_batch(items):
+        batches.append(items)
+        if 'fail' in items:
+            raise ValueError("failed batch")
+        return [item * 2 for item in items]
+
+    async def submit_all(batcher, items):
+        return await asyncio.gather(*(batcher.submit(item) for item in items), return_exceptions=True)
+
+    # full batches run at once, the rest when the delay runs out
+    results = asyncio.run(submit_all(MicroBatcher(run_batch, max_delay=0.01, max_batch=4), list(range(10))))
+    assert results == [item * 2 for item in range(10)]
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+    # a failing batch fails its own items only
+    batches.clear()
+    results = asyncio.run(submit_all(MicroBatcher(run_batch, max_delay=0.01, max_batch=2), ['a', 'fail', 'b']))
+    assert [type(result) for result in results[:2]] == [ValueError, ValueError] and results[2] == 'bb'
+
+
+@pytest.mark.parametrize('sizes, num_workers, task_size', [
+    ([5, 0, 17, 3], 4, 256), ([5, 0, 17, 3], 1, 4), ([300, 1], 2, 64), ([2], 8, 256), ([], 2, 256)])
+def test_pack_cuts_every_segment_into_bounded_tasks(sizes, num_workers, task_size):
+    segments = [(position, list(range(size))) for position, size in enumerate(sizes)]
+    tasks = __pack(segments, lambda segment: len(segment[1]),
+                   lambda segment, start, stop: (segment[0], segment[1][start:stop]), num_workers, task_size)
+
+    # the pieces, in order, are the segments again
+    pieces = {}
+    for position, items in (piece for task in tasks for piece in task):
+        pieces.setdefault(position, []).extend(items)
+    assert pieces == {position: items for position, items in segments if items}
+    task_sizes = [sum(len(items) for _, items in task) for task in tasks]
+    assert all(0 < size <= task_size for size in task_sizes)
+    assert len(tasks) >= min(num_workers, sum(sizes))
+
+
+def test_query_service_matches_direct_scoring(training_languages):
+    pmi_matrix, open_gap_score, extend_gap_score, _ = load_output_parameters(os.path.join(MATERIALS_PATH,
+                                                                                          'output.txt'))
+    sample = random.Random(2).sample(training_languages, 7)
+    # the first four are looked up in the distance matrix, the others are scored
+    in_matrix = sample[:4]
+    distance_matrix = DistanceMatrix([language.name for language in in_matrix], np.array(
+        [calculate_dERC_LDN(L1, L2) for row, L1 in enumerate(in_matrix) for L2 in in_matrix[row + 1:]]))
+    word1, word2 = sample[0].word_list[0][0], sample[5].word_list[0][0]
+
+    async def answer_all(service, requests):
+        return await asyncio.gather(*(service.answer(request) for request in requests))
+
+    with open_query_service(list(reversed(sample)), distance_matrix, pmi_matrix, open_gap_score, extend_gap_score,
+                            num_workers=1, max_delay=0.01) as service:
+        # pairs are scored as (earlier language, later language) in the order of the service
+        assert service.names[:4] == distance_matrix.names
+        by_name = {language.name: language for language in sample}
+        ordered = [by_name[name] for name in service.names]
+        pairs = [(row, column) for row in range(len(ordered)) for column in range(row + 1, len(ordered))]
+        requests = [{'query': 'distance', 'language1': ordered[column].name, 'language2': ordered[row].name,
+                     'measure': measure} for measure in ('LDN', 'PMI') for row, column in pairs]
+        requests += [{'query': 'nearest', 'language': name, 'k': 3} for name in (ordered[0].name, ordered[6].name)]
+        requests += [{'query': 'pmi', 'word1': word1, 'word2': word2, 'id': 'pmi'},
+                     {'query': 'distance', 'language1': 'NOT_A_LANGUAGE', 'language2': ordered[0].name},
+                     {'query': 'pmi', 'word1': word1, 'word2': 'pa\u00f1'}]
+        answers = asyncio.run(answer_all(service, requests))
+
+    expected_LDN = [calculate_dERC_LDN(ordered[row], ordered[column]) for row, column in pairs]
+    expected_PMI = [calculate_dERC_PMI(ordered[row], ordered[column], pmi_matrix, open_gap_score, extend_gap_score)
+                    for row, column in pairs]
+    distances = [answer['result'] for answer in answers[:2 * len(pairs)]]
+    np.testing.assert_allclose(distances, expected_LDN + expected_PMI, rtol=0, atol=1e-12)
+    # the matrix distances are looked up as they were stored
+    matrix_pairs = list(zip(*np.triu_indices(4, 1)))
+    assert [distances[pairs.index((row, column))] for row, column in matrix_pairs] == \
+        [float(distance_matrix.distances[condensed_index(row, column, 4)]) for row, column in matrix_pairs]
+
+    for answer, row in zip(answers[2 * len(pairs):2 * len(pairs) + 2], (0, 6)):
+        others = [column for column in range(len(ordered)) if column != row]
+        scores = [expected_LDN[pairs.index((min(row, column), max(row, column)))] for column in others]
+        closest = np.argsort(scores, kind='stable')[:3]
+        assert [name for name, _ in answer['result']] == [ordered[others[position]].name for position in closest]
+        np.testing.assert_allclose([score for _, score in answer['result']], np.array(scores)[closest], atol=1e-12)
+
+    pmi_answer, unknown_answer, not_asciipma_answer = answers[-3:]
+    assert pmi_answer == {'result': pytest.approx(get_PMI(word1, word2, pmi_matrix, open_gap_score,
+                                                          extend_gap_score)[0]), 'id': 'pmi'}
+    assert unknown_answer == {'error': "ValueError: Unknown language 'NOT_A_LANGUAGE'."}
+    assert not_asciipma_answer == {'error': "ValueError: 'pa\u00f1' contains symbols that are not ASCIIPMA."}
@@ -0,0 +1,423 @@
+import io
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+
+from distance_matrix_generator import DistanceMatrix
+
+
+NJ_TREE_PATH = "./materials/nj_tree.nwk"
+UPGMA_TREE_PATH = "./materials/upgma_tree.nwk"
+
+# rows of the Q matrix evaluated at once by the bounded search of neighbor_joining
+__SEARCH_CHUNK = 32
+
+
+class Tree:
+    """
+    This class holds a phylogenetic tree over a list of languages, with branch lengths.
+
+    Nodes are numbered: the languages (leaves) are 0 ... n - 1 in the order of `names`, the inner nodes follow in the
+    order they were created, and the root is created last.
+
+    State:
+    - `names (list[str])`: name of every leaf
+    - `children (list[list[int]])`: children of every node, empty for leaves
+    - `lengths (np.ndarray)`: length of the branch from every node to its parent (0 for the root)
+    - `root (int)`: the root node
+
+    Constructor:
+    - `names: list[str]`
+    - `children: list[list[int]]`
+    - `lengths: np.ndarray`
+    - `root: int`, optional: the last node by default
+
+    Example:
+    ```py
+    tree = neighbor_joining(load_distance_matrix())
+    with open(NJ_TREE_PATH, 'w') as file:
+        tree.write_newick(file)
+    ```
+    """
+
+    # characters that make a Newick name quoted
+    __NEWICK_SPECIAL = set(" \t\n'()[]:;,")
+
+    def __init__(self, names: list[str], children: list[list[int]], lengths, root: int = None) -> None:
+        self.names = list(names)
+        self.children = children
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+        self.root = len(children) - 1 if root is None else root
+
+    def __len__(self):
+        return len(self.names)
+
+    def write_newick(self, file, precision: int = 6, buffer_size: int = 4096, support: np.ndarray = None):
+        """
+        Stream the tree in Newick format, `(A:0.1,B:0.2)...;`, to an open text file. The tree is walked without
+        recursion and written in pieces of about `buffer_size` tokens, so its depth and size are not limited.
+
+        Parameters:
+        - `file`: anything with a `write(str)` method
+        - `precision (int, optional)`: significant digits of the branch lengths
+        - `buffer_size (int, optional)`: tokens collected between writes
+        - `support (np.ndarray, optional)`: support of every node between 0 and 1 (see `split_support`), written
+                as a percentage in the label of the inner nodes where it is not NaN, `(A:0.1,B:0.2)87:0.05`
+        """
+        pieces = []
+        # (node, index of the next child to write), the root has no branch length
+        stack = [(self.root, 0)]
+        while stack:
+            node, next_child = stack.pop()
+            children = self.children[node]
+            if next_child < len(children):
+                pieces.append('(' if next_child == 0 else ',')
+                stack.append((node, next_child + 1))
+                stack.append((children[next_child], 0))
+                continue
+            if children:
+                pieces.append(')')
+                if support is not None and not np.isnan(support[node]):
+                    pieces.append(str(round(100 * float(support[node]))))
+            else:
+                pieces.append(self.__newick_name(self.names[node]))
+            if stack:
+                pieces.append(f":{self.lengths[node]:.{precision}g}")
+            if len(pieces) >= buffer_size:
+                file.write(''.join(pieces))
+                pieces.clear()
+        pieces.append(';\n')
+        file.write(''.join(pieces))
+
+    def to_newick(self, precision: int = 6, support: np.ndarray = None) -> str:
+        output = io.StringIO()
+        self.write_newick(output, precision, support=support)
+        return output.getvalue()
+
+    def leaf_sets(self) -> np.ndarray:
+        """
+        The leaves below every node.
+
+        Returns:
+        - `np.ndarray`: (nodes x leaves) True where the leaf is below (or is) the node
+        """
+        below = np.zeros((len(self.children), len(self.names)), dtype=bool)
+        below[np.arange(len(self.names)), np.arange(len(self.names))] = True
+        # every node is filled in after its children, without recursion
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                for child in self.children[node]:
+                    below[node] |= below[child]
+            elif self.children[node]:
+                stack.append((node, True))
+                stack.extend((child, False) for child in self.children[node])
+        return below
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as file:
+            self.write_newick(file, precision=17)
+
+    @classmethod
+    def load(cls, path: str) -> 'Tree':
+        """Read a tree written by `save` (or any Newick tree with named leaves)."""
+        with open(path, 'r', encoding='utf-8') as file:
+            return read_newick(file.read())
+
+    @classmethod
+    def __newick_name(cls, name: str) -> str:
+        if any(char in cls.__NEWICK_SPECIAL for char in name):
+            return "'" + name.replace("'", "''") + "'"
+        return name
+
+
+def neighbor_joining(distance_matrix: DistanceMatrix) -> Tree:
+    """
+    Build the neighbor-joining tree (Saitou and Nei) of a distance matrix.
+
+    Every step joins the pair (i, j) with the smallest `Q(i, j) = (m - 2) * d(i, j) - r(i) - r(j)`, where m is the
+    number of nodes left and r(i) the sum of the distances of i. Instead of building the whole Q matrix every step,
+    the search is bounded, in the spirit of RapidNJ: every row keeps a lower bound of `min_j (m - 2) * d(i, j) - r(j)`,
+    exact when the row was last evaluated and lowered by the most a join can change it since. Rows are evaluated (a
+    chunk at a time, vectorized) in order of their bound minus r(i), and the search stops as soon as no row left can
+    beat the best pair found, which on phylogenetic data is after a chunk or two. The active distances are kept in
+    one block that shrinks by a row and a column every step, so a step costs O(m) besides the rows evaluated.
+
+    The last three nodes are joined under a root with three children. Branch lengths are not clamped, so they can
+    be negative for distances that are far from additive.
+
+    Parameters:
+    - `distance_matrix (DistanceMatrix)`: the distances (condensed, see `distance_matrix_generator`), without NaN
+
+    Returns:
+    - `Tree`: the unrooted tree, rooted at its last join
+    """
+    names = distance_matrix.names
+    num_leaves = len(names)
+    if num_leaves < 3:
+        return __join_all(distance_matrix)
+
+    distances = __square(distance_matrix)
+    np.fill_diagonal(distances, np.inf)
+    children = [[] for _ in range(num_leaves)]
+    lengths = [0.0] * num_leaves
+    # slot of the active block -> node of the tree
+    nodes = np.arange(num_leaves)
+    row_sums = np.where(np.isinf(distances), 0, distances).sum(axis=1)
+    # a lower bound of min_j (m - 2) * d(i, j) - r(j) of every row, -inf until the row is first evaluated
+    row_bounds = np.full(num_leaves, -np.inf)
+    max_distance = float(np.max(distances, where=np.isfinite(distances), initial=0))
+
+    size = num_leaves
+    while size > 3:
+        block = distances[:size, :size]
+        sums = row_sums[:size]
+        i, j = __closest_pair(block, sums, row_bounds[:size], size)
+        d_ij = block[i, j]
+        length_i = d_ij / 2 + (sums[i] - sums[j]) / (2 * (size - 2))
+        length_j = d_ij - length_i
+        children.append([int(nodes[i]), int(nodes[j])])
+        lengths[nodes[i]], lengths[nodes[j]] = length_i, length_j
+        lengths.append(0.0)
+
+        # distances of the new node, in slot i (d(k, i) and d(k, j) are replaced by d(k, new) in every sum)
+        others = np.ones(size, dtype=bool)
+        others[[i, j]] = False
+        new_row = (block[i] + block[j] - d_ij) / 2
+        removed = block[i, others] + block[j, others] - new_row[others]
+        sums[others] -= removed
+        sums[i] = new_row[others].sum()
+        max_distance = max(max_distance, float(new_row[others].max()))
+        # (m - 2) * d(k, l) - r(l) changes by d(i, l) + d(j, l) - d(new, l) - d(k, l) >= min(removed) - max_distance
+        #   for every remaining l, so the bounds stay valid; the new node is a column of its own
+        row_bounds[:size] += removed.min() - max_distance
+        row_bounds[:size] = np.minimum(row_bounds[:size], (size - 3) * new_row - sums[i])
+        row_bounds[i] = -np.inf
+        new_row[[i, j]] = np.inf
+        block[i, :] = new_row
+        block[:, i] = new_row
+        nodes[i] = len(children) - 1
+
+        # the last slot moves into slot j
+        last = size - 1
+        if j != last:
+            block[j, :] = block[last, :]
+            block[:, j] = block[:, last]
+            block[j, j] = np.inf
+            nodes[j] = nodes[last]
+            sums[j] = sums[last]
+            row_bounds[j] = row_bounds[last]
+        size = last
+
+    # the last three nodes meet at the root
+    block = distances[:3, :3]
+    d_01, d_02, d_12 = block[0, 1], block[0, 2], block[1, 2]
+    for slot, length in enumerate([(d_01 + d_02 - d_12) / 2, (d_01 + d_12 - d_02) / 2, (d_02 + d_12 - d_01) / 2]):
+        lengths[nodes[slot]] = length
+    children.append([int(node) for node in nodes[:3]])
+    lengths.append(0.0)
+    return Tree(names, children, lengths)
+
+
+def upgma(distance_matrix: DistanceMatrix) -> Tree:
+    """
+    Build the UPGMA tree (average linkage) of a distance matrix, with scipy's O(n^2) linkage.
+
+    The tree is rooted and ultrametric: a join at distance d sits at height d / 2, and every branch is the
+    difference of the heights of its ends.
+
+    Parameters:
+    - `distance_matrix (DistanceMatrix)`: the distances (condensed, see `distance_matrix_generator`), without NaN
+
+    Returns:
+    - `Tree`: the rooted tree
+    """
+    names = distance_matrix.names
+    num_leaves = len(names)
+    if num_leaves < 3:
+        return __join_all(distance_matrix)
+    merges = linkage(np.asarray(distance_matrix.distances, dtype=np.float64), method='average')
+
+    # scipy numbers the clusters like Tree numbers its nodes: leaves first, then every merge
+    heights = np.concatenate((np.zeros(num_leaves), merges[:, 2] / 2))
+    children = [[] for _ in range(num_leaves)] + [[int(first), int(second)] for first, second in merges[:, :2]]
+    lengths = np.zeros(len(children))
+    for node, (first, second) in enumerate(merges[:, :2].astype(np.int64).tolist(), start=num_leaves):
+        lengths[first] = heights[node] - heights[first]
+        lengths[second] = heights[node] - heights[second]
+    return Tree(names, children, lengths)
+
+
+def split_support(tree: Tree, replicate_trees: list[Tree]) -> np.ndarray:
+    """
+    The fraction of the replicate trees (e.g. of bootstrap replicates, see `concept_bootstrap.bootstrap_tree`) that
+    have the split of every branch of the tree, the bipartition of the leaves it separates. Trees are compared as
+    unrooted, with their leaves matched by name.
+
+    Parameters:
+    - `tree (Tree)`: the tree whose branches are supported
+    - `replicate_trees (list[Tree])`: trees over the same leaves
+
+    Returns:
+    - `np.ndarray`: support of every node of `tree` between 0 and 1, NaN for the leaves and the root, whose splits
+            are in every tree
+    """
+    positions = {name: position for position, name in enumerate(tree.names)}
+    counts = {}
+    splits = __split_keys(tree.leaf_sets())
+    for split in splits:
+        counts.setdefault(split, 0)
+    for replicate_tree in replicate_trees:
+        order = np.argsort([positions[name] for name in replicate_tree.names])
+        for split in set(__split_keys(replicate_tree.leaf_sets()[:, order])):
+            if split in counts:
+                counts[split] += 1
+
+    support = np.array([counts[split] for split in splits], dtype=np.float64) / max(1, len(replicate_trees))
+    support[:len(tree.names)] = np.nan
+    support[tree.root] = np.nan
+    return support
+
+
+def read_newick(text: str) -> Tree:
+    """
+    Parse a Newick tree with named leaves (as `Tree.write_newick` writes them). Inner node names are ignored and
+    missing branch lengths are 0.
+
+    Returns:
+    - `Tree`: the tree, its leaves numbered in the order they appear
+    """
+    names, leaf_children, leaf_lengths = [], [], []
+    inner_children, inner_lengths = [], []
+    # inner nodes are numbered after all leaves, so they are kept apart (as negative ids) until the end
+    stack = []
+    position = 0
+    last = None
+    text = text.strip()
+    while position < len(text):
+        char = text[position]
+        if char == '(':
+            inner_children.append([])
+            inner_lengths.append(0.0)
+            stack.append(-len(inner_children))
+            position += 1
+        elif char == ',':
+            position += 1
+        elif char == ')':
+            last = stack.pop()
+            position += 1
+            # inner node names are skipped
+            position = __skip_name(text, position)
+            if stack:
+                inner_children[-stack[-1] - 1].append(last)
+        elif char == ':':
+            end = position + 1
+            while end < len(text) and text[end] not in ',():;':
+                end += 1
+            length = float(text[position + 1:end])
+            if last < 0:
+                inner_lengths[-last - 1] = length
+            else:
+                leaf_lengths[last] = length
+            position = end
+        elif char == ';':
+            break
+        elif char.isspace():
+            position += 1
+        else:
+            name, position = __read_name(text, position)
+            names.append(name)
+            leaf_children.append([])
+            leaf_lengths.append(0.0)
+            last = len(names) - 1
+            if stack:
+                inner_children[-stack[-1] - 1].append(last)
+    if stack:
+        raise ValueError("Unbalanced parentheses in the Newick tree.")
+
+    num_leaves = len(names)
+
+    # inner node k (created k-th) becomes node num_leaves + k, the root (the first one opened) goes last
+    def renumber(node: int) -> int:
+        if node >= 0:
+            return node
+        created = -node - 1
+        return num_leaves + (len(inner_children) - 1 if created == 0 else created - 1)
+
+    ordered = inner_children[1:] + inner_children[:1]
+    ordered_lengths = inner_lengths[1:] + inner_lengths[:1]
+    children = leaf_children + [[renumber(child) for child in node_children] for node_children in ordered]
+    return Tree(names, children, leaf_lengths + ordered_lengths)
+
+
+def __closest_pair(block: np.ndarray, sums: np.ndarray, row_bounds: np.ndarray, size: int) -> tuple[int, int]:
+    """
+    The (i, j) with the smallest Q value, searching the rows in order of their lower bound. Every row that is
+    evaluated gets its exact minimum as its new bound.
+    """
+    bounds = row_bounds - sums
+    order = np.argsort(bounds, kind='stable')
+    best, best_i, best_j = np.inf, -1, -1
+    for start in range(0, size, __SEARCH_CHUNK):
+        if bounds[order[start]] > best:
+            break
+        rows = order[start:start + __SEARCH_CHUNK]
+        partial = (size - 2) * block[rows] - sums[None, :]
+        columns = partial.argmin(axis=1)
+        row_bounds[rows] = partial[np.arange(len(rows)), columns]
+        values = row_bounds[rows] - sums[rows]
+        row = int(values.argmin())
+        if values[row] < best:
+            best, best_i, best_j = values[row], int(rows[row]), int(columns[row])
+    return min(best_i, best_j), max(best_i, best_j)
+
+
+def __split_keys(leaf_sets: np.ndarray) -> list[bytes]:
+    """Every node's split as bytes, the side without the first leaf, so both sides of a split get one key."""
+    sides = leaf_sets ^ leaf_sets[:, :1]
+    return [row.tobytes() for row in np.packbits(sides, axis=1)]
+
+
+def __square(distance_matrix: DistanceMatrix) -> np.ndarray:
+    num_leaves = len(distance_matrix)
+    square = np.zeros((num_leaves, num_leaves))
+    i, j = np.triu_indices(num_leaves, 1)
+    condensed = np.asarray(distance_matrix.distances, dtype=np.float64)
+    if np.isnan(condensed).any():
+        raise ValueError("The distance matrix has NaN distances, a tree cannot be built from it.")
+    square[i, j] = condensed
+    square[j, i] = condensed
+    return square
+
+
+def __join_all(distance_matrix: DistanceMatrix) -> Tree:
+    """The tree of fewer than three languages: a root over all of them, at half their distance."""
+    num_leaves = len(distance_matrix)
+    length = float(distance_matrix.distances[0]) / 2 if num_leaves == 2 else 0.0
+    return Tree(distance_matrix.names, [[] for _ in range(num_leaves)] + [list(range(num_leaves))],
+                [length] * num_leaves + [0.0])
+
+
+def __read_name(text: str, position: int) -> tuple[str, int]:
+    if text[position] == "'":
+        name = []
+        position += 1
+        while True:
+            end = text.index("'", position)
+            name.append(text[position:end])
+            if text.startswith("''", end):
+                name.append("'")
+                position = end + 2
+            else:
+                return ''.join(name), end + 1
+    end = position
+    while end < len(text) and text[end] not in ',():;':
+        end += 1
+    return text[position:end].strip(), end
+
+
+def __skip_name(text: str, position: int) -> int:
+    if position < len(text) and text[position] not in ',():;':
+        _, position = __read_name(text, position)
+    return position
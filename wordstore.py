@@ -0,0 +1,368 @@
+import numpy as np
+
+from language import Language
+
+
+# ASCIIPMA symbols used by the ASJP word lists, in the order of the ASJP documentation.
+#   p, b, f, v, m, w, 8, 4, t, d, s, z, c, n, r, l, S, Z, C, j, T, 5, y, k, g, x, N, q, G, X, h, 7, L, !, i, e, E, 3, a, u, o
+CHARS = ['p', 'b', 'f', 'v', 'm', 'w', '8', '4', 't', 'd', 's', 'z', 'c', 'n', 'r', 'l', 'S', 'Z', 'C', 'j',
+         'T', '5', 'y', 'k', 'g', 'x', 'N', 'q', 'G', 'X', 'h', '7', 'L', '!', 'i', 'e', 'E', '3', 'a', 'u', 'o']
+NUM_SYMBOLS = len(CHARS)
+# code of the alignment gap '-', one past the last symbol
+GAP = NUM_SYMBOLS
+
+CHAR_CODES = {char: code for code, char in enumerate(CHARS)}
+
+__UNKNOWN = 255
+__ENCODE_TABLE = np.full(256, __UNKNOWN, dtype=np.uint8)
+__ENCODE_TABLE[[ord(char) for char in CHARS]] = np.arange(NUM_SYMBOLS, dtype=np.uint8)
+__DECODE_TABLE = np.frombuffer(''.join(CHARS).encode() + b'-', dtype=np.uint8)
+
+
+def encode_word(word: str) -> np.ndarray:
+    """
+    This function maps a word onto the symbol codes 0 ... 40
+
+    Parameters:
+    - word (str): word made of ASCIIPMA symbols
+
+    Returns:
+    np.ndarray: uint8 code of every symbol of the word
+    """
+    codes = __ENCODE_TABLE[np.frombuffer(word.encode('latin-1'), dtype=np.uint8)]
+    if (codes == __UNKNOWN).any():
+        raise ValueError(f"'{word}' contains symbols that are not ASCIIPMA.")
+    return codes
+
+
+def decode_word(codes: np.ndarray) -> str:
+    """
+    This function turns symbol codes (gap code included) back into a word
+
+    Parameters:
+    - codes (np.ndarray): symbol codes
+
+    Returns:
+    str: the decoded word
+    """
+    return __DECODE_TABLE[np.asarray(codes, dtype=np.intp)].tobytes().decode()
+
+
+class WordStore:
+    """
+    This class keeps every word of a corpus of languages in one flat uint8 buffer of symbol codes.
+
+    Concept c of language i owns the concept slot `language_offsets[i] + c`, and concept slot s owns the
+    words `concept_offsets[s]` ... `concept_offsets[s + 1]`. Missing ('XXX') concepts own no words and are
+    flagged once in `missing`, so scorers never have to scan for the sentinel.
+
+    Identical spellings are interned: `word_ids` maps every word to its entry of the vocabulary, which is
+    kept as a padded code matrix ready for the batched kernels.
+
+    State:
+    - `names (list[str])`: name of every language
+    - `family_names (list[str])`: name of every language family
+    - `family (np.ndarray)`: index into `family_names` of every language
+    - `symbols (np.ndarray)`: the codes of all words back to back
+    - `word_offsets (np.ndarray)`: word w is `symbols[word_offsets[w]:word_offsets[w + 1]]`
+    - `concept_offsets (np.ndarray)`: first word of every concept slot
+    - `language_offsets (np.ndarray)`: first concept slot of every language
+    - `missing (np.ndarray)`: (languages x concepts) True for 'XXX' concepts and past a language's last concept
+    - `word_ids (np.ndarray)`: vocabulary id of every word
+    - `vocabulary_codes (np.ndarray)`: (vocabulary x longest word) padded codes of every distinct word
+    - `vocabulary_lengths (np.ndarray)`: length of every distinct word
+
+    Constructor:
+    - `names: list[str]`
+    - `word_lists: list[list[list[str]]]`
+    - `family_names: list[str]`, optional
+    - `family: list[int]`, optional
+
+    Use `WordStore.from_languages` and `WordStore.from_sets` to build one from Language objects.
+
+    Example:
+    ```py
+    store = WordStore.from_sets(training_set)
+    english = store[store.index('ENGLISH')]  # a Language view into the store
+    print(english.word_list)
+    ```
+    """
+
+    def __init__(self, names: list[str], word_lists: list[list[list[str]]],
+                 family_names: list[str] = None, family: list[int] = None) -> None:
+        self.names = list(names)
+        self.family_names = list(family_names) if family_names is not None else ['']
+        self.family = np.asarray(family if family is not None else np.zeros(len(self.names)),
+                                 dtype=np.int64)
+
+        num_concepts = [len(word_list) for word_list in word_lists]
+        max_concepts = max(num_concepts, default=0)
+        self.missing = np.ones((len(self.names), max_concepts), dtype=bool)
+        self.language_offsets = np.concatenate(([0], np.cumsum(num_concepts))).astype(np.int64)
+
+        ids = {}
+        words = []
+        concept_sizes = []
+        for language_index, word_list in enumerate(word_lists):
+            for concept_index, concept in enumerate(word_list):
+                if 'XXX' in concept:
+                    concept_sizes.append(0)
+                    continue
+                self.missing[language_index, concept_index] = False
+                concept_sizes.append(len(concept))
+                words.extend(concept)
+
+        word_lengths = np.fromiter((len(word) for word in words), dtype=np.int64, count=len(words))
+        self.word_offsets = np.concatenate(([0], np.cumsum(word_lengths))).astype(np.int64)
+        self.concept_offsets = np.concatenate(([0], np.cumsum(concept_sizes))).astype(np.int64)
+        self.symbols = encode_word(''.join(words)) if words else np.zeros(0, dtype=np.uint8)
+        self.word_ids = np.fromiter((ids.setdefault(word, len(ids)) for word in words),
+                                    dtype=np.int64, count=len(words))
+
+        self.__pad_vocabulary(len(ids))
+        self.__index_words()
+
+    def __pad_vocabulary(self, vocabulary_size: int):
+        """Copy the codes of the first occurrence of every distinct word into the padded vocabulary matrix."""
+        first = np.zeros(vocabulary_size, dtype=np.int64)
+        first[self.word_ids[::-1]] = np.arange(len(self.word_ids))[::-1]
+        self.vocabulary_lengths = self.word_offsets[first + 1] - self.word_offsets[first]
+        self.vocabulary_codes = np.zeros((vocabulary_size, self.vocabulary_lengths.max(initial=0)),
+                                         dtype=np.uint8)
+        for position in range(self.vocabulary_codes.shape[1]):
+            rows = np.nonzero(self.vocabulary_lengths > position)[0]
+            self.vocabulary_codes[rows, position] = self.symbols[self.word_offsets[first[rows]] + position]
+
+    def __index_words(self):
+        """Derive the language, concept and synonym position of every word from the offset arrays."""
+        num_slots = len(self.concept_offsets) - 1
+        slot_sizes = np.diff(self.concept_offsets)
+        slot_language = np.repeat(np.arange(len(self.names)), np.diff(self.language_offsets))
+        slot_concept = np.arange(num_slots) - self.language_offsets[slot_language]
+
+        self.word_slot = np.repeat(np.arange(num_slots), slot_sizes)
+        self.word_language = slot_language[self.word_slot]
+        self.word_concept = slot_concept[self.word_slot]
+        self.word_synonym = np.arange(len(self.word_ids)) - self.concept_offsets[self.word_slot]
+        self.word_counts = np.zeros(self.missing.shape, dtype=np.int64)
+        self.word_counts[slot_language, slot_concept] = slot_sizes
+        self.__vocabulary = None
+
+    @classmethod
+    def from_arrays(cls, names: list[str], family_names: list[str], family: np.ndarray, symbols: np.ndarray,
+                    word_offsets: np.ndarray, concept_offsets: np.ndarray, language_offsets: np.ndarray,
+                    missing: np.ndarray, word_ids: np.ndarray, vocabulary_size: int) -> 'WordStore':
+        """
+        Rebuild a store from its arrays (see the State of `WordStore`) without encoding any word, e.g. from a
+        corpus file (see `corpus_file.load_corpus`). The arrays are used as they are, they may be read-only views.
+        The vocabulary matrix is filled from the first occurrence of every word id.
+        """
+        store = cls.__new__(cls)
+        store.names = list(names)
+        store.family_names = list(family_names)
+        store.family = family
+        store.symbols = symbols
+        store.word_offsets = word_offsets
+        store.concept_offsets = concept_offsets
+        store.language_offsets = language_offsets
+        store.missing = missing
+        store.word_ids = word_ids
+        store.__pad_vocabulary(vocabulary_size)
+        store.__index_words()
+        return store
+
+    @classmethod
+    def from_languages(cls, languages: list[Language]) -> 'WordStore':
+        return cls([language.name for language in languages],
+                   [language.word_list for language in languages])
+
+    @classmethod
+    def from_sets(cls, language_set: dict[str, list[Language]]) -> 'WordStore':
+        languages = [language for family in language_set.values() for language in family]
+        family = [family_index for family_index, family in enumerate(language_set.values())
+                  for _ in family]
+        return cls([language.name for language in languages],
+                   [language.word_list for language in languages],
+                   list(language_set), family)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index: int) -> 'StoredLanguage':
+        return StoredLanguage(self, index)
+
+    def __iter__(self):
+        return (StoredLanguage(self, index) for index in range(len(self)))
+
+    def index(self, name: str) -> int:
+        return self.names.index(name)
+
+    def as_sets(self) -> dict[str, list['StoredLanguage']]:
+        """Return the languages grouped by family, in the `dict[str, list[Language]]` shape used by driver.py."""
+        language_set = {family_name: [] for family_name in self.family_names}
+        for language in self:
+            language_set[self.family_names[self.family[language.index]]].append(language)
+        return language_set
+
+    @property
+    def vocabulary(self) -> list[str]:
+        """Every distinct word as a string, decoded once per store."""
+        if self.__vocabulary is None:
+            # the padded matrix is decoded in one go and cut into the words
+            width = self.vocabulary_codes.shape[1]
+            text = decode_word(self.vocabulary_codes.ravel())
+            self.__vocabulary = [text[row * width:row * width + length]
+                                 for row, length in enumerate(self.vocabulary_lengths.tolist())]
+        return self.__vocabulary
+
+    def num_concepts(self, index: int) -> int:
+        return int(self.language_offsets[index + 1] - self.language_offsets[index])
+
+    def concept_words(self, index: int, concept: int) -> np.ndarray:
+        """Return the vocabulary ids of the words of one concept of one language (empty if missing)."""
+        slot = self.language_offsets[index] + concept
+        return self.word_ids[self.concept_offsets[slot]:self.concept_offsets[slot + 1]]
+
+    def word_list(self, index: int) -> list[list[str]]:
+        """Decode the word list of a language, with 'XXX' for missing concepts."""
+        vocabulary = self.vocabulary
+        # one slice of the word ids per language, not one per concept
+        ends = self.concept_offsets[self.language_offsets[index]:self.language_offsets[index + 1] + 1].tolist()
+        word_ids = self.word_ids[ends[0]:ends[-1]].tolist()
+        return [[vocabulary[word_id] for word_id in word_ids[start - ends[0]:end - ends[0]]] or ['XXX']
+                for start, end in zip(ends[:-1], ends[1:])]
+
+    def layout(self, indices) -> 'WordLayout':
+        return WordLayout(self, indices)
+
+
+class StoredLanguage(Language):
+    """
+    A Language that is a view into a WordStore. `word_list` is decoded from the store the first time it is asked
+    for, and kept (the store does not change).
+
+    Pickles as a plain Language, so passing one to another process does not copy the whole store.
+    """
+
+    def __init__(self, store: WordStore, index: int) -> None:
+        self.store = store
+        self.index = index
+        self.__word_list = None
+
+    @property
+    def name(self) -> str:
+        return self.store.names[self.index]
+
+    @property
+    def word_list(self) -> list[list[str]]:
+        if self.__word_list is None:
+            self.__word_list = self.store.word_list(self.index)
+        return self.__word_list
+
+    def __reduce__(self):
+        return (Language, (self.name, self.word_list))
+
+
+class EncodedLanguage(Language):
+    """
+    A Language whose words are kept as symbol codes, one small buffer per language instead of a str per word.
+    `word_list` is decoded when asked for. This is the encoded record `dictionaryhandler.read_languages` yields.
+
+    State:
+    - `name (str)`: name of the language
+    - `symbols (np.ndarray)`: the codes of all words of the language back to back ('XXX' included)
+    - `word_lengths (np.ndarray)`: length of every word
+    - `concept_sizes (np.ndarray)`: number of words of every concept
+
+    Constructor:
+    - `name: str`
+    - `word_list: list[list[str]]`, made of ASCIIPMA symbols only
+    """
+
+    def __init__(self, name: str, word_list: list[list[str]]) -> None:
+        words = [word for concept in word_list for word in concept]
+        self.name = name
+        self.symbols = encode_word(''.join(words)) if words else np.zeros(0, dtype=np.uint8)
+        self.word_lengths = np.fromiter((len(word) for word in words), dtype=np.uint8, count=len(words))
+        self.concept_sizes = np.fromiter((len(concept) for concept in word_list), dtype=np.uint8,
+                                         count=len(word_list))
+
+    @property
+    def word_list(self) -> list[list[str]]:
+        ends = np.cumsum(self.word_lengths, dtype=np.int64).tolist()
+        words = [decode_word(self.symbols[end - length:end]) for end, length in zip(ends, self.word_lengths.tolist())]
+        concept_ends = np.cumsum(self.concept_sizes, dtype=np.int64).tolist()
+        return [words[end - size:end] for end, size in zip(concept_ends, self.concept_sizes.tolist())]
+
+
+class WordLayout:
+    """
+    This class describes where the words of a selection of a store's languages sit, in flat array form.
+
+    Every word of every selected language is one occurrence. Each occurrence records the language
+    (position in the selection), the concept and the synonym position it came from, and the id of
+    its spelling in `vocabulary`.
+
+    State:
+    - `vocabulary (np.ndarray)`: store vocabulary ids of the distinct words of the selection
+    - `language (np.ndarray)`: position in the selection of the language of every occurrence
+    - `concept (np.ndarray)`: concept index of every occurrence
+    - `synonym (np.ndarray)`: position of the occurrence within its concept
+    - `word_id (np.ndarray)`: index into `vocabulary` of every occurrence
+    - `word_counts (np.ndarray)`: (languages x concepts) number of words per concept
+    - `valid (np.ndarray)`: (languages x concepts) False for 'XXX' concepts and for padding
+    - `num_concepts (np.ndarray)`: number of concepts of every language (should be 40 always)
+
+    Constructor:
+    - `store: WordStore`
+    - `indices`: indices of the selected languages in the store
+    """
+
+    def __init__(self, store: WordStore, indices) -> None:
+        indices = np.atleast_1d(np.asarray(indices, dtype=np.int64))
+        first_word = store.concept_offsets[store.language_offsets[indices]]
+        last_word = store.concept_offsets[store.language_offsets[indices + 1]]
+        sizes = last_word - first_word
+        words = np.repeat(first_word - np.concatenate(([0], np.cumsum(sizes)[:-1])), sizes) \
+            + np.arange(sizes.sum())
+
+        self.store = store
+        self.language = np.repeat(np.arange(len(indices)), sizes)
+        self.concept = store.word_concept[words]
+        self.synonym = store.word_synonym[words]
+        self.vocabulary, self.word_id = np.unique(store.word_ids[words], return_inverse=True)
+        self.word_counts = store.word_counts[indices]
+        self.valid = ~store.missing[indices]
+        self.num_concepts = np.diff(store.language_offsets)[indices]
+
+    def __len__(self):
+        return len(self.num_concepts)
+
+    @property
+    def codes(self) -> tuple[np.ndarray, np.ndarray]:
+        """Padded codes and lengths of the distinct words of the selection."""
+        return (self.store.vocabulary_codes[self.vocabulary],
+                self.store.vocabulary_lengths[self.vocabulary])
+
+
+def store_languages(languages: list[Language]) -> tuple[WordStore, np.ndarray]:
+    """
+    Find the WordStore that holds the given languages.
+
+    If every language is a view into the same store that store is used as is, otherwise the languages are
+    encoded into a new one (a Language object that is passed more than once is only encoded once).
+
+    Parameters:
+    - `languages (list[Language])`: the languages
+
+    Returns:
+    - `tuple[WordStore, np.ndarray]`: the store and the index of every language in it
+    """
+    stores = {id(language.store) for language in languages if isinstance(language, StoredLanguage)}
+    if len(stores) == 1 and all(isinstance(language, StoredLanguage) for language in languages):
+        return languages[0].store, np.array([language.index for language in languages], dtype=np.int64)
+    positions = {}
+    indices = np.array([positions.setdefault(id(language), len(positions)) for language in languages],
+                       dtype=np.int64)
+    unique_languages = {id(language): language for language in languages}
+    return WordStore.from_languages([unique_languages[key] for key in positions]), indices